@@ -24,32 +24,112 @@ char metal_serial_read();
 }
 #endif
 
+/* With METAL_SERIAL_FRAMED the target's output is sent in frames with a sequence number and a CRC,
+ * so the host can drop corrupted frames and resume at the next message.
+ * This requires src/metal/serial/framing.c to be linked in. */
+#if !defined(METAL_SERIAL_FRAMED)
+#define METAL_SERIAL_FRAMED 0
+#endif
+
+#if METAL_SERIAL_FRAMED
+
+#if defined(__cplusplus)
+extern "C" {
+#endif
+
+void metal_serial_frame_put(char);
+void metal_serial_frame_message();
+void metal_serial_frame_flush();
+
+#if defined(__cplusplus)
+}
+#endif
+
+#define METAL_SERIAL_PUT(value) metal_serial_frame_put(value)
+/* the host only answers once it got the whole message, so everything pending goes out before blocking */
+#define METAL_SERIAL_GET() (metal_serial_frame_flush(), metal_serial_read())
+#define METAL_SERIAL_MESSAGE() metal_serial_frame_message();
+#define METAL_SERIAL_FLUSH() metal_serial_frame_flush();
+
+#else
+
+#define METAL_SERIAL_PUT(value) metal_serial_write(value)
+#define METAL_SERIAL_GET() metal_serial_read()
+#define METAL_SERIAL_MESSAGE()
+#define METAL_SERIAL_FLUSH()
+
+#endif
+
+/* Version 2 of the protocol sends ints as zigzag LEB128 varints and locations as the
+ * offset from metal_serial_write, which is far more compact on slow links. */
+#if !defined(METAL_SERIAL_VERSION)
+#define METAL_SERIAL_VERSION 1
+#endif
+
+#if METAL_SERIAL_VERSION == 2
+#define METAL_SERIAL_VERSION_STRING "__metal_serial_version_2"
+#else
 #define METAL_SERIAL_VERSION_STRING "__metal_serial_version_1"
+#endif
 
 #define METAL_SERIAL_WRITE_BYTE(value) \
-    metal_serial_write(value);
+    METAL_SERIAL_PUT(value);
 
 #define METAL_SERIAL_READ_BYTE(value) \
-    {value = metal_serial_read();}
+    {value = METAL_SERIAL_GET();}
+
+#if METAL_SERIAL_VERSION == 2
+
+#define METAL_SERIAL_WRITE_INT(value)                                           \
+{                                                                               \
+    uintmax_t metal_serial_zz = ((value) < 0) ? ((~(uintmax_t)(value)) << 1u) | 1u \
+                                              : ((uintmax_t)(value)) << 1u;     \
+    do                                                                          \
+    {                                                                           \
+        char metal_serial_byte = (char)(metal_serial_zz & 0x7Fu);               \
+        metal_serial_zz >>= 7u;                                                 \
+        if (metal_serial_zz != 0u)                                              \
+            metal_serial_byte |= 0x80;                                          \
+        METAL_SERIAL_PUT(metal_serial_byte);                                    \
+    } while (metal_serial_zz != 0u);                                            \
+}
+
+
+#define METAL_SERIAL_READ_INT(value)                                            \
+{                                                                               \
+    uintmax_t metal_serial_zz = 0u;                                             \
+    unsigned int metal_serial_shift = 0u;                                       \
+    char metal_serial_byte;                                                     \
+    do                                                                          \
+    {                                                                           \
+        metal_serial_byte = METAL_SERIAL_GET();                                 \
+        metal_serial_zz |= ((uintmax_t)(metal_serial_byte & 0x7F)) << metal_serial_shift; \
+        metal_serial_shift += 7u;                                               \
+    } while (metal_serial_byte & 0x80);                                         \
+    (value) = (metal_serial_zz & 1u) ? ~(metal_serial_zz >> 1u) : (metal_serial_zz >> 1u); \
+}
+
+#else
 
 #define METAL_SERIAL_WRITE_INT(value)                       \
 {                                                           \
-    metal_serial_write(sizeof(value));                      \
+    METAL_SERIAL_PUT(sizeof(value));                        \
     unsigned int idx;                                       \
     for (idx = 0u; idx < sizeof(value); idx++)              \
-         metal_serial_write((value) >> (idx << 3u));        \
+         METAL_SERIAL_PUT((value) >> (idx << 3u));          \
 }
 
 
 #define METAL_SERIAL_READ_INT(value)                        \
 {                                                           \
-    const char sz = metal_serial_read();                    \
+    const char sz = METAL_SERIAL_GET();                     \
     (value) = 0;                                            \
     unsigned int idx;                                       \
     for (idx = 0u; idx < sz; idx++)                         \
-         (value) |= (metal_serial_read() & 0xFF) << (idx << 3u);     \
+         (value) |= (METAL_SERIAL_GET() & 0xFF) << (idx << 3u);      \
 }
 
+#endif
 
 #define METAL_SERIAL_WRITE_STR(value)                  \
     {                                                  \
@@ -57,7 +137,7 @@ char metal_serial_read();
         while((value)[strlen++] != '\0');              \
         unsigned int idx;                              \
         for (idx = 0u; idx<strlen; idx++)              \
-            metal_serial_write((value)[idx]);          \
+            METAL_SERIAL_PUT((value)[idx]);            \
     }                                                  \
 
 
@@ -67,7 +147,7 @@ char metal_serial_read();
         int null_terminated = 0;                        \
         for (; idx_<(buffer_size - 1); idx_++)          \
         {                                               \
-            const char next = metal_serial_read();      \
+            const char next = METAL_SERIAL_GET();       \
             (value)[idx_] = next;                       \
             if (next == '\0')                           \
             {                                           \
@@ -78,7 +158,7 @@ char metal_serial_read();
         if (!null_terminated)                           \
         {                                               \
             (value)[buffer_size-1] = '\0';              \
-            while (metal_serial_read() != '\0');        \
+            while (METAL_SERIAL_GET() != '\0');         \
         }                                               \
         METAL_SERIAL_WRITE_INT(idx_);                   \
     }                                                   \
@@ -89,7 +169,7 @@ char metal_serial_read();
     {                                               \
         unsigned int idx;                           \
         for (idx = 0u; idx < size; idx++)           \
-        metal_serial_write(((char*)(pointer))[idx]); }
+        METAL_SERIAL_PUT(((char*)(pointer))[idx]); }
 
 #define METAL_SERIAL_READ_MEMORY(pointer, buffer_size, read_size)  \
     { \
@@ -100,9 +180,9 @@ char metal_serial_read();
         if (read_size > buffer_size)                        \
             read_size = buffer_size;                        \
         for (idx = 0u; idx < read_size; idx++)              \
-            ((char*)(pointer))[idx] = metal_serial_read();  \
+            ((char*)(pointer))[idx] = METAL_SERIAL_GET();   \
         for (idx = read_size; idx < size; idx++)            \
-            (void)metal_serial_read();                      \
+            (void)METAL_SERIAL_GET();                       \
         METAL_SERIAL_WRITE_INT(read_size);                  \
     }
 
@@ -113,13 +193,36 @@ char metal_serial_read();
 #define METAL_SERIAL_WRITE_PTR(value) METAL_SERIAL_WRITE_INT((uintptr_t)value)
 #endif
 
+#if METAL_SERIAL_VERSION == 2
+
+#if defined(__cplusplus)
+#define METAL_SERIAL_WRITE_OFFSET(value) \
+    METAL_SERIAL_WRITE_INT((std::intptr_t)((std::uintptr_t)(value) - (std::uintptr_t)&metal_serial_write))
+#else
+#define METAL_SERIAL_WRITE_OFFSET(value) \
+    METAL_SERIAL_WRITE_INT((intptr_t)((uintptr_t)(value) - (uintptr_t)&metal_serial_write))
+#endif
+
 #define METAL_SERIAL_WRITE_LOCATION_IMPL(CNT) \
     { \
         __asm("__metal_serial_" #CNT ":" ); \
+        METAL_SERIAL_MESSAGE() \
+        extern const int __location_ ##CNT __asm("__metal_serial_" #CNT);   \
+        METAL_SERIAL_WRITE_OFFSET(&__location_ ##CNT);  \
+    }
+
+#else
+
+#define METAL_SERIAL_WRITE_LOCATION_IMPL(CNT) \
+    { \
+        __asm("__metal_serial_" #CNT ":" ); \
+        METAL_SERIAL_MESSAGE() \
         extern const int __location_ ##CNT __asm("__metal_serial_" #CNT);   \
         METAL_SERIAL_WRITE_PTR(&__location_ ##CNT);  \
     }
 
+#endif
+
 #define METAL_SERIAL_WRITE_LOCATION_IMPL2(CNT) METAL_SERIAL_WRITE_LOCATION_IMPL(CNT)
 
 #define METAL_SERIAL_WRITE_LOCATION() METAL_SERIAL_WRITE_LOCATION_IMPL2(__COUNTER__)
@@ -128,18 +231,19 @@ char metal_serial_read();
 
 #define METAL_SERIAL_INIT()                                                         \
   {                                                                                 \
+    METAL_SERIAL_MESSAGE()                                                          \
     unsigned int idx;                                                               \
     for (idx = 0u; idx < sizeof(METAL_SERIAL_VERSION_STRING); idx++)                \
-        metal_serial_write(METAL_SERIAL_VERSION_STRING[idx]);                       \
+        METAL_SERIAL_PUT(METAL_SERIAL_VERSION_STRING[idx]);                         \
     int metal_serial_init = 0x6C43;                                                 \
-    metal_serial_write(sizeof(metal_serial_init));                                  \
+    METAL_SERIAL_PUT(sizeof(metal_serial_init));                                    \
     char* p = (char*)&metal_serial_init;                                            \
     for (idx = 0u; idx < sizeof(metal_serial_init); idx++)                          \
-        metal_serial_write(p[idx]);                                                 \
+        METAL_SERIAL_PUT(p[idx]);                                                   \
     METAL_SERIAL_WRITE_PTR(&metal_serial_write);                                    \
     METAL_SERIAL_WRITE_LOCATION();                                                  \
   }
 
-#define METAL_SERIAL_EXIT(Value) METAL_SERIAL_WRITE_MARKER(metal.exit); METAL_SERIAL_WRITE_INT(Value);
+#define METAL_SERIAL_EXIT(Value) METAL_SERIAL_WRITE_MARKER(metal.exit); METAL_SERIAL_WRITE_INT(Value); METAL_SERIAL_FLUSH()
 
 #endif //METAL_SERIAL_MACROS_H
\ No newline at end of file
@@ -4,7 +4,7 @@ import gdb
 import os
 
 from metal.gdb.metal_break import Breakpoint
-from metal.newlib import Flags, map_errno, map_file_mode, map_open_flags
+from metal.newlib import Flags, MappedReads, error_number, map_errno, map_file_mode, map_open_flags
 
 
 class FStat(Breakpoint):
@@ -44,7 +44,7 @@ class FStat(Breakpoint):
             gdb.execute("set var res = 0")
             gdb.execute('set var err = 0')
         except OSError as e:
-            gdb.execute("set var err = {}".format(map_errno(int(str(e)), errno, Flags)))
+            gdb.execute("set var err = {}".format(map_errno(error_number(e), errno, Flags)))
 
 
 class Stat(Breakpoint):
@@ -82,7 +82,7 @@ class Stat(Breakpoint):
             gdb.execute("set var res = 0")
             gdb.execute('set var err = 0')
         except OSError as e:
-            gdb.execute("set var err = {}".format(map_errno(int(str(e)), errno, Flags)))
+            gdb.execute("set var err = {}".format(map_errno(error_number(e), errno, Flags)))
 
 
 class IsAtty(Breakpoint):
@@ -97,7 +97,7 @@ class IsAtty(Breakpoint):
             gdb.execute("set var res = {}".format(1 if self.os_.isatty(fd) else 0))
             gdb.execute('set var err = 0')
         except OSError as e:
-            gdb.execute("set var err = {}".format(map_errno(int(str(e)), errno, Flags)))
+            gdb.execute("set var err = {}".format(map_errno(error_number(e), errno, Flags)))
 
 
 class Link(Breakpoint):
@@ -113,7 +113,7 @@ class Link(Breakpoint):
             gdb.execute("set var res = 0")
             gdb.execute('set var err = 0')
         except OSError as e:
-            gdb.execute("set var err = {}".format(map_errno(int(str(e)), errno, Flags)))
+            gdb.execute("set var err = {}".format(map_errno(error_number(e), errno, Flags)))
 
 
 class Symlink(Breakpoint):
@@ -129,7 +129,7 @@ class Symlink(Breakpoint):
             gdb.execute("set var res = 0")
             gdb.execute('set var err = 0')
         except OSError as e:
-            gdb.execute("set var err = {}".format(map_errno(int(str(e)), errno, Flags)))
+            gdb.execute("set var err = {}".format(map_errno(error_number(e), errno, Flags)))
 
 
 class Unlink(Breakpoint):
@@ -144,12 +144,13 @@ class Unlink(Breakpoint):
             gdb.execute("set var res = {}".format(self.os_.unlink(name)))
             gdb.execute('set var err = 0')
         except OSError as e:
-            gdb.execute("set var err = {}".format(map_errno(int(str(e)), errno, Flags)))
+            gdb.execute("set var err = {}".format(map_errno(error_number(e), errno, Flags)))
 
 
 class Open(Breakpoint):
-    def __init__(self, os_=os):
+    def __init__(self, os_=os, reads=None):
         self.os_ = os_
+        self.reads = reads or MappedReads(os_, False)
         Breakpoint.__init__(self, "syscall.open")
 
     def stop(self, bp):
@@ -160,15 +161,18 @@ class Open(Breakpoint):
         mode = map_file_mode(int(str(next(itr))), Flags, self.os_)
 
         try:
-            gdb.execute("set var res = {}".format(self.os_.open(file, flags, mode)))
+            fd = self.os_.open(file, flags, mode)
+            self.reads.open(fd, flags)
+            gdb.execute("set var res = {}".format(fd))
             gdb.execute('set var err = 0')
         except OSError as e:
-            gdb.execute("set var err = {}".format(map_errno(int(str(e)), errno, Flags)))
+            gdb.execute("set var err = {}".format(map_errno(error_number(e), errno, Flags)))
 
 
 class LSeek(Breakpoint):
-    def __init__(self, os_=os):
+    def __init__(self, os_=os, reads=None):
         self.os_ = os_
+        self.reads = reads or MappedReads(os_, False)
         Breakpoint.__init__(self, "syscall.lseek")
 
     def stop(self, bp):
@@ -176,15 +180,18 @@ class LSeek(Breakpoint):
         file, ptr, dir_ = (arg.value(fr) for arg in fr.block() if arg.is_argument)
 
         try:
-            gdb.execute("set var res = {}".format(self.os_.lseek(file, ptr, dir_)))
+            file, ptr, dir_ = int(file), int(ptr), int(dir_)
+            pos = self.reads.lseek(file, ptr, dir_)
+            gdb.execute("set var res = {}".format(pos if pos is not None else self.os_.lseek(file, ptr, dir_)))
             gdb.execute('set var err = 0')
         except OSError as e:
-            gdb.execute("set var err = {}".format(map_errno(int(str(e)), errno, Flags)))
+            gdb.execute("set var err = {}".format(map_errno(error_number(e), errno, Flags)))
 
 
 class Write(Breakpoint):
-    def __init__(self, os_=os):
+    def __init__(self, os_=os, reads=None):
         self.os_ = os_
+        self.reads = reads or MappedReads(os_, False)
         Breakpoint.__init__(self, "syscall.write")
 
     def stop(self, bp):
@@ -198,15 +205,17 @@ class Write(Breakpoint):
 
         try:
             buf = gdb.selected_inferior().read_memory(ptr,  len_)
+            self.reads.release(int(file))
             gdb.execute("set var res = {}".format(self.os_.write(file, buf.tobytes())))
             gdb.execute("set var err = 0")
         except OSError as e:
-            gdb.execute("set var err = {}".format(map_errno(int(str(e)), errno, Flags)))
+            gdb.execute("set var err = {}".format(map_errno(error_number(e), errno, Flags)))
 
 
 class Read(Breakpoint):
-    def __init__(self, os_=os):
+    def __init__(self, os_=os, reads=None):
         self.os_ = os_
+        self.reads = reads or MappedReads(os_, False)
         Breakpoint.__init__(self, "syscall.read")
 
     def stop(self, bp):
@@ -222,17 +231,20 @@ class Read(Breakpoint):
         len_ = int(str(next(arg_values)))
 
         try:
-            buf = self.os_.read(file, len_)
+            buf = self.reads.read(file, len_)
+            if buf is None:
+                buf = self.os_.read(file, len_)
             gdb.selected_inferior().write_memory(ptr, buf, len(buf))
             gdb.execute("set var res = {}".format(len(buf)))
             gdb.execute('set var err = 0')
         except OSError as e:
-            gdb.execute("set var err = {}".format(map_errno(int(str(e)), errno, Flags)))
+            gdb.execute("set var err = {}".format(map_errno(error_number(e), errno, Flags)))
 
 
 class ReadAvailable(Breakpoint):
-    def __init__(self, os_=os):
+    def __init__(self, os_=os, reads=None):
         self.os_ = os_
+        self.reads = reads or MappedReads(os_, False)
         Breakpoint.__init__(self, "syscall.read_available")
 
     def stop(self, bp):
@@ -244,27 +256,31 @@ class ReadAvailable(Breakpoint):
         ptr = next(int(arg.value(fr).address) for arg in gb if arg.name == "read_buf")
 
         try:
-            if self.os_.isatty(file):
-                gdb.execute("set.var read_end = 0")  # No reading for terminal
-                return
+            # a mapped file knows how much is available without asking the os
+            buf = self.reads.read(file, len_)
+            if buf is None:
+                if self.os_.isatty(file):
+                    gdb.execute("set var read_end = 0")  # No reading for terminal
+                    return
 
-            cur = self.os_.lseek(file, 0, self.os_.SEEK_CUR)
-            end = self.os_.lseek(file, 0, self.os_.SEEK_END)
+                cur = self.os_.lseek(file, 0, self.os_.SEEK_CUR)
+                end = self.os_.lseek(file, 0, self.os_.SEEK_END)
 
-            available = end - cur
-            self.os_.lseek(file, cur, self.os_.SEEK_SET)
-            read_len = min(available, len_)
+                available = end - cur
+                self.os_.lseek(file, cur, self.os_.SEEK_SET)
+                read_len = min(available, len_)
 
-            buf = self.os_.read(file, read_len)
+                buf = self.os_.read(file, read_len)
             gdb.selected_inferior().write_memory(ptr, buf, len(buf))
             gdb.execute("set var read_end = {}".format(len(buf)))
         except OSError as e:
-            gdb.execute("set var err = {}".format(map_errno(int(str(e)), errno, Flags)))
+            gdb.execute("set var err = {}".format(map_errno(error_number(e), errno, Flags)))
 
 
 class Close(Breakpoint):
-    def __init__(self, os_=os):
+    def __init__(self, os_=os, reads=None):
         self.os_ = os_
+        self.reads = reads or MappedReads(os_, False)
         Breakpoint.__init__(self, "syscall.close")
 
     def stop(self, bp):
@@ -275,24 +291,26 @@ class Close(Breakpoint):
             if fd == Flags.STDERR_FILENO or fd == Flags.STDOUT_FILENO or fd == Flags.STDIN_FILENO:
                 gdb.execute("set var err = {}".format(Flags.EACCES))
             else:
+                self.reads.close(fd)
                 self.os_.close(fd)
                 gdb.execute("set var res = 0")
                 gdb.execute('set var err = 0')
         except OSError as e:
-            gdb.execute("set var err = {}".format(map_errno(int(str(e)), errno, Flags)))
+            gdb.execute("set var err = {}".format(map_errno(error_number(e), errno, Flags)))
 
 
 class NewlibBreakpoints:
-    def __init__(self, os_=os):
+    def __init__(self, os_=os, map_reads=None):
+        self.reads = MappedReads(os_, map_reads)
         self.fstat = FStat(os_)
         self.stat_ = Stat(os_)
         self.is_atty = IsAtty(os_)
         self.link = Link(os_)
         self.symlink = Symlink(os_)
         self.unlink = Unlink(os_)
-        self.open_ = Open(os_)
-        self.lseek = LSeek(os_)
-        self.write = Write(os_)
-        self.read = Read(os_)
-        self.read_available = ReadAvailable(os_)
-        self.close_ = Close(os_)
+        self.open_ = Open(os_, self.reads)
+        self.lseek = LSeek(os_, self.reads)
+        self.write = Write(os_, self.reads)
+        self.read = Read(os_, self.reads)
+        self.read_available = ReadAvailable(os_, self.reads)
+        self.close_ = Close(os_, self.reads)
@@ -5,6 +5,7 @@ import traceback
 import sys
 import gdb
 import metal
+from metal.unit import JsonLinesSink, Retention
 
 str = str
 if sys.version_info[0] < 3:
@@ -74,6 +75,83 @@ class SelectJsonSink(gdb.Parameter):
     show_doc = '''This sets the test data output sink.'''
 
 
+class SelectJsonLinesSink(gdb.Parameter):
+    def __init__(self, reporter):
+        super(SelectJsonLinesSink, self).__init__("metal-unit-jsonl-sink",
+                                                  gdb.COMMAND_DATA,
+                                                  gdb.PARAM_OPTIONAL_FILENAME)
+        self.value = None
+        self.sink = None
+        self.reporter = reporter
+
+    def get_set_string(self):
+        if self.sink is not None:
+            self.sink.close()
+
+        if self.value is None:
+            self.sink = None
+        elif self.value == 'stdout':
+            self.sink = JsonLinesSink(sys.stdout)
+        elif self.value == 'stderr':
+            self.sink = JsonLinesSink(sys.stderr)
+        else:
+            self.sink = JsonLinesSink(open(self.value, 'w'))
+
+        self.reporter.jsonl_sink = self.sink
+        return self.value
+
+    set_doc = '''Set output file.'''
+    show_doc = '''This sets the sink the test data gets streamed to as JSON lines while the test runs.'''
+
+
+class SummaryOnly(gdb.Parameter):
+    def __init__(self, reporter):
+        super(SummaryOnly, self).__init__("metal-unit-summary-only",
+                                          gdb.COMMAND_DATA,
+                                          gdb.PARAM_BOOLEAN)
+        self.value = False
+        self.reporter = reporter
+
+    def get_set_string(self):
+        self.reporter.summary_only = self.value
+        return str(self.value)
+
+    set_doc = '''Set summary only mode.'''
+    show_doc = '''This makes the test scopes only keep their counters instead of every single check.'''
+
+
+class SelectRetention(gdb.Parameter):
+    def __init__(self, reporter):
+        super(SelectRetention, self).__init__("metal-unit-retention",
+                                              gdb.COMMAND_DATA,
+                                              gdb.PARAM_ENUM, [Retention.all, Retention.failures, Retention.sample])
+        self.value = Retention.all
+        self.reporter = reporter
+
+    def get_set_string(self):
+        self.reporter.retention = self.value
+        return self.value
+
+    set_doc = '''Set the retention policy.'''
+    show_doc = '''This selects which checks are kept for the report: all, only failures or failures and a sample of the passing checks per location.'''
+
+
+class SampleSize(gdb.Parameter):
+    def __init__(self, reporter):
+        super(SampleSize, self).__init__("metal-unit-sample-size",
+                                         gdb.COMMAND_DATA,
+                                         gdb.PARAM_ZUINTEGER)
+        self.value = reporter.sample_size
+        self.reporter = reporter
+
+    def get_set_string(self):
+        self.reporter.sample_size = self.value
+        return str(self.value)
+
+    set_doc = '''Set the sample size.'''
+    show_doc = '''This sets how many passing checks per location are kept with the sample retention policy.'''
+
+
 class PrintLevel(gdb.Parameter):
     def __init__(self):
         super(PrintLevel, self).__init__("metal-unit-print-level",
@@ -167,6 +245,10 @@ class UnitBreakpoint(metal.gdb.Breakpoint):
 
         self.selectJsonSink = SelectJsonSink(reporter)
         self.SelectHrfSink = SelectHrfSink(reporter)
+        self.selectJsonLinesSink = SelectJsonLinesSink(reporter)
+        self.summaryOnly = SummaryOnly(reporter)
+        self.selectRetention = SelectRetention(reporter)
+        self.sampleSize = SampleSize(reporter)
         self.disableExitCode = DisableExitCode()
         self.reporter = reporter
 
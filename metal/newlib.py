@@ -1,4 +1,5 @@
 import errno
+import mmap
 import os
 import stat
 
@@ -329,94 +330,198 @@ class Flags:
     __ELASTERROR = 2000 # Users can add values starting here
 
 
+file_mode_bits = [
+    ('S_IRWXU',  ('S_IREAD', 'S_IWRITE')),
+    ('S_IRUSR',  ('S_IREAD',)),
+    ('S_IWUSR',  ('S_IWRITE',)),
+    ('S_IREAD',  ('S_IREAD',)),
+    ('S_IWRITE', ('S_IWRITE',)),
+] + [(name, (name,)) for name in ['S_IRWXU', 'S_IRUSR', 'S_IWUSR', 'S_IXUSR', 'S_IRWXG', 'S_IRGRP', 'S_IWGRP', 'S_IXGRP',
+                                  'S_IRWXO', 'S_IROTH', 'S_IWOTH', 'S_IXOTH', 'S_ISUID', 'S_ISGID', 'S_ISVTX', 'S_IEXEC', 'S_ENFMT',
+                                  'S_IFMT', 'S_IFDIR', 'S_IFCHR', 'S_IFBLK', 'S_IFREG', 'S_IFLNK', 'S_IFSOCK', 'S_IFIFO']]
+
+seek_flag_bits = [(name, (name,)) for name in ['SEEK_SET', 'SEEK_CUR', 'SEEK_END']]
+
+#O_ASYNC & O_LARGEFILE are left out
+open_flag_bits = [(name, (name,)) for name in ['O_APPEND', 'O_CREAT', 'O_EXCL', 'O_RDONLY', 'O_WRONLY', 'O_RDWR', 'O_NOCTTY', 'O_NONBLOCK', 'O_SYNC',
+                                               'O_CLOEXEC', 'O_DIRECT', 'O_DIRECTORY', 'O_DSYNC', 'O_NOATIME', 'O_NDELAY', 'O_PATH', 'O_TRUNC']]
+
+errno_codes = ['EPERM', 'ENOENT', 'ESRCH', 'EINTR', 'EIO', 'ENXIO', 'E2BIG', 'ENOEXEC', 'EBADF', 'ECHILD', 'EAGAIN', 'ENOMEM', 'EACCES', 'EFAULT', 'ENOTBLK',
+               'EBUSY', 'EEXIST', 'EXDEV', 'ENODEV', 'ENOTDIR', 'EISDIR', 'EINVAL', 'ENFILE', 'EMFILE', 'ENOTTY', 'ETXTBSY', 'EFBIG', 'ENOSPC', 'ESPIPE',
+               'EROFS', 'EMLINK', 'EPIPE', 'EDOM', 'ERANGE', 'ENOMSG', 'EIDRM', 'ECHRNG', 'EL2NSYNC', 'EL3HLT', 'EL3RST', 'ELNRNG', 'EUNATCH', 'ENOCSI',
+               'EL2HLT', 'EDEADLK', 'ENOLCK', 'EBADE', 'EBADR', 'EXFULL', 'ENOANO', 'EBADRQC', 'EBADSLT', 'EDEADLOCK', 'EBFONT', 'ENOSTR', 'ENODATA', 'ETIME',
+               'ENOSR', 'ENONET', 'ENOPKG', 'EREMOTE', 'ENOLINK', 'EADV', 'ESRMNT', 'ECOMM', 'EPROTO', 'EMULTIHOP', 'ELBIN', 'EDOTDOT', 'EBADMSG', 'EFTYPE',
+               'ENOTUNIQ', 'EBADFD', 'EREMCHG', 'ELIBACC', 'ELIBBAD', 'ELIBSCN', 'ELIBMAX', 'ELIBEXEC', 'ENOSYS', 'ENMFILE', 'ENOTEMPTY', 'ENAMETOOLONG',
+               'ELOOP', 'EOPNOTSUPP', 'EPFNOSUPPORT', 'ECONNRESET', 'ENOBUFS', 'EAFNOSUPPORT', 'EPROTOTYPE', 'ENOTSOCK', 'ENOPROTOOPT', 'ESHUTDOWN',
+               'ECONNREFUSED', 'EADDRINUSE', 'ECONNABORTED', 'ENETUNREACH', 'ENETDOWN', 'ETIMEDOUT', 'EHOSTDOWN', 'EHOSTUNREACH', 'EINPROGRESS', 'EALREADY',
+               'EDESTADDRREQ', 'EMSGSIZE', 'EPROTONOSUPPORT', 'ESOCKTNOSUPPORT', 'EADDRNOTAVAIL', 'ENETRESET', 'EISCONN', 'ENOTCONN', 'ETOOMANYREFS',
+               'EPROCLIM', 'EUSERS', 'EDQUOT', 'ESTALE', 'ENOTSUP', 'ENOMEDIUM', 'ENOSHARE', 'ECASECLASH', 'EILSEQ', 'EOVERFLOW', 'ECANCELED', 'ENOTRECOVERABLE',
+               'EOWNERDEAD', 'ESTRPIPE', 'EWOULDBLOCK']
+
+
+# Translates bit flags from one set of constants to another, e.g. Flags to os.
+# The masks are looked up once and every distinct value is only translated once, since targets use the same few flags over and over.
+# Constants of `to` that are missing or no int are only looked up when a value uses them, so they fail just like before.
+class BitMapping:
+    def __init__(self, bits, from_, to, base=0):
+        self.to = to
+        self.base = base
+        self.masks = []
+        for from_name, to_names in bits:
+            values = [getattr(to, name, None) for name in to_names]
+            out = None
+            if all(isinstance(value, int) for value in values):
+                out = 0
+                for value in values:
+                    out |= value
+            self.masks.append((getattr(from_, from_name), out, to_names))
+        self.cache = {}
+
+    def __call__(self, value):
+        try:
+            return self.cache[value]
+        except KeyError:
+            pass
+
+        out = self.base
+        for mask, bits, to_names in self.masks:
+            if value & mask:
+                if bits is None:
+                    for name in to_names:
+                        out |= getattr(self.to, name)
+                else:
+                    out |= bits
+        self.cache[value] = out
+        return out
+
+
+# Translates error numbers, anything unknown becomes EBADMSG
+class ErrnoMapping:
+    def __init__(self, from_, to):
+        self.to = to
+        self.table = {}
+        for ec in errno_codes:
+            if hasattr(from_, ec):
+                self.table.setdefault(getattr(from_, ec), getattr(to, ec) if hasattr(to, ec) else None)
+
+    def __call__(self, value):
+        ec = self.table.get(value)
+        if ec is None:
+            return self.to.EBADMSG
+        return ec
+
+
+# the errno of an OSError, which stubs often raise as OSError(code) where it only shows up in str(e)
+def error_number(e: OSError) -> int:
+    return e.errno if e.errno is not None else int(str(e))
+
+
+# compiled mappings by (kind, from_, to), so every os_ module passed to a hook gets its own
+mappings = {}
+
+
+def get_mapping(kind, from_, to, build):
+    key = (kind, from_, to)
+    mapping = mappings.get(key)
+    if mapping is None:
+        mapping = mappings[key] = build()
+    return mapping
+
+
 def map_file_mode(value, from_=Flags, to=stat):
-    out = 0
-    if value & from_.S_IRWXU:  out |= to.S_IREAD | to.S_IWRITE
-    if value & from_.S_IRUSR:  out |= to.S_IREAD
-    if value & from_.S_IWUSR:  out |= to.S_IWRITE
-    if value & from_.S_IREAD:  out |= to.S_IREAD
-    if value & from_.S_IWRITE: out |= to.S_IWRITE
-    if value & from_.S_IRWXU:  out |= to.S_IRWXU
-    if value & from_.S_IRUSR:  out |= to.S_IRUSR
-    if value & from_.S_IWUSR:  out |= to.S_IWUSR
-    if value & from_.S_IXUSR:  out |= to.S_IXUSR
-    if value & from_.S_IRWXG:  out |= to.S_IRWXG
-    if value & from_.S_IRGRP:  out |= to.S_IRGRP
-    if value & from_.S_IWGRP:  out |= to.S_IWGRP
-    if value & from_.S_IXGRP:  out |= to.S_IXGRP
-    if value & from_.S_IRWXO:  out |= to.S_IRWXO
-    if value & from_.S_IROTH:  out |= to.S_IROTH
-    if value & from_.S_IWOTH:  out |= to.S_IWOTH
-    if value & from_.S_IXOTH:  out |= to.S_IXOTH
-    if value & from_.S_ISUID:  out |= to.S_ISUID
-    if value & from_.S_ISGID:  out |= to.S_ISGID
-    if value & from_.S_ISVTX:  out |= to.S_ISVTX
-    if value & from_.S_IEXEC:  out |= to.S_IEXEC
-    if value & from_.S_ENFMT:  out |= to.S_ENFMT
-    if value & from_.S_IFMT:   out |= to.S_IFMT
-    if value & from_.S_IFDIR:  out |= to.S_IFDIR
-    if value & from_.S_IFCHR:  out |= to.S_IFCHR
-    if value & from_.S_IFBLK:  out |= to.S_IFBLK
-    if value & from_.S_IFREG:  out |= to.S_IFREG
-    if value & from_.S_IFLNK:  out |= to.S_IFLNK
-    if value & from_.S_IFSOCK: out |= to.S_IFSOCK
-    if value & from_.S_IFIFO:  out |= to.S_IFIFO
-
-    return out
+    return get_mapping('file_mode', from_, to, lambda: BitMapping(file_mode_bits, from_, to))(value)
+
 
 def map_seek_flags(value, from_=Flags, to=os):
-    out = 0
-    if value & from_.SEEK_SET: out |= to.SEEK_SET;
-    if value & from_.SEEK_CUR: out |= to.SEEK_CUR;
-    if value & from_.SEEK_END: out |= to.SEEK_END;
-    return out
+    return get_mapping('seek_flags', from_, to, lambda: BitMapping(seek_flag_bits, from_, to))(value)
 
 
 def map_open_flags(value, from_=Flags, to=os):
-    out = 0
-    if hasattr(to, "O_BINARY"): out |= to.O_BINARY
-    if value & from_.O_APPEND   : out |= to.O_APPEND
-    if value & from_.O_CREAT    : out |= to.O_CREAT
-    if value & from_.O_EXCL     : out |= to.O_EXCL
-    if value & from_.O_RDONLY   : out |= to.O_RDONLY
-    if value & from_.O_WRONLY   : out |= to.O_WRONLY
-    if value & from_.O_RDWR     : out |= to.O_RDWR
-    if value & from_.O_NOCTTY   : out |= to.O_NOCTTY
-    if value & from_.O_NONBLOCK : out |= to.O_NONBLOCK
-    if value & from_.O_SYNC     : out |= to.O_SYNC
-    #if value & from_.O_ASYNC    : out |= to.O_ASYNC
-    if value & from_.O_CLOEXEC  : out |= to.O_CLOEXEC
-    if value & from_.O_DIRECT   : out |= to.O_DIRECT
-    if value & from_.O_DIRECTORY: out |= to.O_DIRECTORY
-    if value & from_.O_DSYNC    : out |= to.O_DSYNC
-    #if value & from_.O_LARGEFILE: out |= to.O_LARGEFILE
-    if value & from_.O_NOATIME  : out |= to.O_NOATIME
-    if value & from_.O_NDELAY   : out |= to.O_NDELAY
-    if value & from_.O_PATH     : out |= to.O_PATH
-    if value & from_.O_TRUNC    : out |= to.O_TRUNC
-
-    return out
+    return get_mapping('open_flags', from_, to,
+                       lambda: BitMapping(open_flag_bits, from_, to, to.O_BINARY if hasattr(to, "O_BINARY") else 0))(value)
 
-def map_errno(value, from_=Flags, to=errno):
-    codes = ['EPERM', 'ENOENT', 'ESRCH', 'EINTR', 'EIO', 'ENXIO', 'E2BIG', 'ENOEXEC', 'EBADF', 'ECHILD', 'EAGAIN', 'ENOMEM', 'EACCES', 'EFAULT', 'ENOTBLK',
-             'EBUSY', 'EEXIST', 'EXDEV', 'ENODEV', 'ENOTDIR', 'EISDIR', 'EINVAL', 'ENFILE', 'EMFILE', 'ENOTTY', 'ETXTBSY', 'EFBIG', 'ENOSPC', 'ESPIPE',
-             'EROFS', 'EMLINK', 'EPIPE', 'EDOM', 'ERANGE', 'ENOMSG', 'EIDRM', 'ECHRNG', 'EL2NSYNC', 'EL3HLT', 'EL3RST', 'ELNRNG', 'EUNATCH', 'ENOCSI',
-             'EL2HLT', 'EDEADLK', 'ENOLCK', 'EBADE', 'EBADR', 'EXFULL', 'ENOANO', 'EBADRQC', 'EBADSLT', 'EDEADLOCK', 'EBFONT', 'ENOSTR', 'ENODATA', 'ETIME',
-             'ENOSR', 'ENONET', 'ENOPKG', 'EREMOTE', 'ENOLINK', 'EADV', 'ESRMNT', 'ECOMM', 'EPROTO', 'EMULTIHOP', 'ELBIN', 'EDOTDOT', 'EBADMSG', 'EFTYPE',
-             'ENOTUNIQ', 'EBADFD', 'EREMCHG', 'ELIBACC', 'ELIBBAD', 'ELIBSCN', 'ELIBMAX', 'ELIBEXEC', 'ENOSYS', 'ENMFILE', 'ENOTEMPTY', 'ENAMETOOLONG',
-             'ELOOP', 'EOPNOTSUPP', 'EPFNOSUPPORT', 'ECONNRESET', 'ENOBUFS', 'EAFNOSUPPORT', 'EPROTOTYPE', 'ENOTSOCK', 'ENOPROTOOPT', 'ESHUTDOWN',
-             'ECONNREFUSED', 'EADDRINUSE', 'ECONNABORTED', 'ENETUNREACH', 'ENETDOWN', 'ETIMEDOUT', 'EHOSTDOWN', 'EHOSTUNREACH', 'EINPROGRESS', 'EALREADY',
-             'EDESTADDRREQ', 'EMSGSIZE', 'EPROTONOSUPPORT', 'ESOCKTNOSUPPORT', 'EADDRNOTAVAIL', 'ENETRESET', 'EISCONN', 'ENOTCONN', 'ETOOMANYREFS',
-             'EPROCLIM', 'EUSERS', 'EDQUOT', 'ESTALE', 'ENOTSUP', 'ENOMEDIUM', 'ENOSHARE', 'ECASECLASH', 'EILSEQ', 'EOVERFLOW', 'ECANCELED', 'ENOTRECOVERABLE',
-             'EOWNERDEAD', 'ESTRPIPE', 'EWOULDBLOCK']
-
-    try:
-        ec = next(ec for ec in codes if hasattr(from_, ec) and value == getattr(from_, ec))
-
-        if not hasattr(to, ec):
-            return to.EBADMSG
-
-        return getattr(to, ec)
-    except StopIteration:
-        return to.EBADMSG
 
+def map_errno(value, from_=Flags, to=errno):
+    return get_mapping('errno', from_, to, lambda: ErrnoMapping(from_, to))(value)
+
+
+class MappedFile:
+    def __init__(self, mapped: mmap.mmap, position: int):
+        self.mapped = mapped
+        self.size = len(mapped)
+        self.position = position
+
+    def close(self):
+        self.mapped.close()
+
+
+# Serves reads of files opened read-only from a memory mapping, created once on open, so a read is a slice instead of a syscall.
+# Slices are returned as bytes, a view into the mapping would keep it from being closed.
+# The position is tracked here and handed back to the fd (release) before anything else uses it, e.g. a write;
+# the size is the one at open, so data appended through another fd isn't seen.
+# Opening any file for writing drops all mappings, since it might truncate a mapped file.
+# mmap needs real file descriptors, hence it's only enabled for the os module by default.
+class MappedReads:
+    def __init__(self, os_=os, enabled=None):
+        self.os_ = os_
+        self.enabled = os_ is os if enabled is None else enabled
+        self.files = {}
+
+    def open(self, fd: int, flags: int):
+        if not self.enabled:
+            return
+        if flags & (self.os_.O_WRONLY | self.os_.O_RDWR | self.os_.O_TRUNC):
+            self.release_all()
+            return
+        try:
+            mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # empty files, pipes, devices
+            return
+        self.files[fd] = MappedFile(mapped, self.os_.lseek(fd, 0, self.os_.SEEK_CUR))
+
+    def mapped(self, fd: int) -> bool:
+        return fd in self.files
+
+    # read up to size bytes, None if fd isn't mapped
+    def read(self, fd: int, size: int):
+        file = self.files.get(fd)
+        if file is None:
+            return None
+        start = min(file.position, file.size)
+        end = min(start + max(size, 0), file.size)
+        file.position = max(file.position, end)
+        return file.mapped[start:end]
+
+    # the new position, None if fd isn't mapped
+    def lseek(self, fd: int, offset: int, how: int):
+        file = self.files.get(fd)
+        if file is None:
+            return None
+        if how == self.os_.SEEK_SET:
+            position = offset
+        elif how == self.os_.SEEK_CUR:
+            position = file.position + offset
+        elif how == self.os_.SEEK_END:
+            position = file.size + offset
+        else:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+        if position < 0:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+        file.position = position
+        return position
+
+    def release(self, fd: int):
+        file = self.files.pop(fd, None)
+        if file is not None:
+            file.close()
+            self.os_.lseek(fd, file.position, self.os_.SEEK_SET)
+
+    def release_all(self):
+        for fd in list(self.files):
+            self.release(fd)
+
+    # the fd gets closed, so there's no position to hand back
+    def close(self, fd: int):
+        file = self.files.pop(fd, None)
+        if file is not None:
+            file.close()
@@ -1,10 +1,13 @@
-from metal.serial.hooks import Exit, Init, MacroHook
+from metal.serial.hooks import AsyncExit, AsyncMacroHook, Exit, Init, MacroHook
 
 from .elfreader import ELFReader, Marker, Symbol
 from .generate import generate
+from .cache import SerialInfoCache
 from .hooks import MacroHook
 from .engine import Engine
+from .framing import FrameGap, FramedInput, Gap
 from .interpret import SerialInfo
 from .read_symbols import Symbol, read_symbols
 from .preprocessor import MacroExpansion
-from .default_hooks import default_hooks
+from .default_hooks import default_hooks, async_default_hooks
+from .async_engine import AsyncEngine, SyncHookAdapter
@@ -11,9 +11,10 @@ class Argv(MacroHook):
 
     def invoke(self, engine: Engine, macro_expansion: MacroExpansion):
 
-        engine.write_int(len(self.argv))
         data = b'\0'.join(arg.encode() for arg in self.argv) + b'\0'
-        res = engine.write_memory(data)
+        with engine.corked():
+            engine.write_int(len(self.argv))
+            res = engine.write_memory(data)
         if res != len(data):
             print("***metal.serial***: Couldn't write all of argv, buffer size was {}".format(res), file=sys.stderr)
 
@@ -0,0 +1,281 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import typing
+
+from .elfreader import Marker
+from .engine import Engine, MarkerLookup, decode_zigzag, detect_endianness, encode_varint, bytes_needed, with_builtin_hooks
+from .framing import frame_sync
+from .generate import SerialInfo
+from .hooks import AsyncExit, AsyncMacroHook, Exit, MacroHook
+from .preprocessor import MacroExpansion
+from .reader import BufferedInput
+
+
+# Runs a plain MacroHook for the AsyncEngine: invoke happens in a worker thread on a ThreadedEngine,
+# whose reads block that thread until the event loop received the data.
+class SyncHookAdapter(AsyncMacroHook):
+    def __init__(self, hook: MacroHook):
+        super().__init__()
+        self.hook = hook
+        self.identifier = hook.identifier
+        self.buffers_output = hook.buffers_output
+
+    async def invoke(self, engine: 'AsyncEngine', macro_expansion: MacroExpansion):
+        await engine.run_sync(self.hook.invoke, macro_expansion)
+
+    def flush_output(self):
+        self.hook.flush_output()
+
+    def exit(self, exit_code: int):
+        self.hook.exit(exit_code)
+
+
+# Reads for a ThreadedEngine that run out of buffered data, they get scheduled on the event loop
+class ThreadInput:
+    def __init__(self, engine: 'AsyncEngine'):
+        self.engine = engine
+        self.pending: typing.Optional[concurrent.futures.Future] = None
+
+    def read1(self, size: int = -1) -> bytes:
+        self.pending = asyncio.run_coroutine_threadsafe(self.engine.receive(size), self.engine.loop)
+        try:
+            return self.pending.result()
+        finally:
+            self.pending = None
+
+    def cancel(self):
+        pending = self.pending
+        if pending is not None:
+            pending.cancel()
+
+
+class ThreadOutput:
+    def __init__(self, engine: 'AsyncEngine'):
+        self.engine = engine
+
+    def write(self, data: bytes) -> int:
+        self.engine.loop.call_soon_threadsafe(self.engine.write_raw, bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+# The blocking Engine interface for sync hooks, working on the connection an AsyncEngine negotiated
+class ThreadedEngine(Engine):
+    def __init__(self, engine: 'AsyncEngine'):
+        self.serial_info = engine.serial_info
+        self.macro_hooks = engine.macro_hooks
+        self.recorder = None
+        self.transport = None
+        self.input = engine.thread_input
+        self.reader = engine.reader
+        self.output = ThreadOutput(engine)
+        self._cork = None
+
+        self.select_protocol(engine.target_version)
+        self.int_length = engine.int_length
+        self.endianness = engine.endianness
+        self.base_pointer = engine.base_pointer
+        self.init_marker = engine.init_marker
+
+    @property
+    def gaps(self):
+        return []
+
+    @property
+    def skipped_bytes(self):
+        return 0
+
+
+# The Engine protocol over asyncio streams, so one event loop can drive many targets.
+# Reads are coroutines, writes go into the StreamWriter's buffer which gets drained before waiting for more input.
+# Hooks derived from AsyncMacroHook run on the loop, other hooks run in the executor through SyncHookAdapter.
+# Timeouts & cancellation work like for any other task, e.g. asyncio.wait_for(engine.run(), timeout).
+class AsyncEngine(MarkerLookup):
+    serial_info: SerialInfo
+    init_marker: typing.Optional[Marker]
+    target_version: str
+    protocol_version: int
+
+    endianness: str
+    base_pointer: int
+
+    macro_hooks: typing.List[typing.Callable[[], MacroHook]]
+
+    def __init__(self, serial_info: SerialInfo, reader: asyncio.StreamReader, writer: typing.Optional[asyncio.StreamWriter] = None,
+                 macro_hooks: typing.List[typing.Callable[[], MacroHook]] = None,
+                 executor: typing.Optional[concurrent.futures.Executor] = None, chunk_size: int = 64 * 1024):
+        if macro_hooks is None:
+            from metal.serial.default_hooks import async_default_hooks
+            macro_hooks = async_default_hooks
+        self.macro_hooks = with_builtin_hooks(macro_hooks, exit=AsyncExit)
+
+        self.serial_info = serial_info
+        self.stream = reader
+        self.writer = writer
+        self.executor = executor
+        self.chunk_size = chunk_size
+        self.init_marker = None
+
+        self.loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        # the buffer is shared with the ThreadedEngine, only one of them reads at any time
+        self.thread_input = ThreadInput(self)
+        self.reader = BufferedInput(self.thread_input, chunk_size)
+        self.__threaded: typing.Optional[ThreadedEngine] = None
+
+    # the target may be gone already, e.g. after it sent its exit code, in which case there's nothing left to deliver
+    async def drain(self):
+        if self.writer is not None:
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                pass
+
+    async def receive(self, size: int = -1) -> bytes:
+        await self.drain()
+        return await self.stream.read(max(size, self.chunk_size))
+
+    async def __receive_more(self):
+        data = await self.receive()
+        if not data:
+            raise EOFError('Input ended while more bytes were expected')
+        self.reader.feed(data)
+
+    async def fill(self, size: int):
+        while self.reader.available < size:
+            await self.__receive_more()
+
+    async def handshake(self):
+        self.loop = asyncio.get_running_loop()
+
+        await self.fill(1)
+        if self.reader.peek(1) == frame_sync[:1]:
+            raise Exception('The AsyncEngine does not support framed targets')
+
+        self.target_version = await self.read_string()
+        assert self.target_version in (Engine.version_string, Engine.version_string_v2)
+        self.protocol_version = 2 if self.target_version == Engine.version_string_v2 else 1
+
+        self.int_length = (await self.read_byte())[0]
+        endian_checker = await self.read(self.int_length)
+        self.endianness = detect_endianness(self.int_length, endian_checker)
+        if self.endianness is None:
+            raise Exception('Invalid endianness checker {}'.format(endian_checker))
+
+        metal_serial_write = await self.read_int()
+        self.base_pointer = metal_serial_write - self.serial_info.metal_serial_write.address
+        self.init_marker = self.find_marker(await self.read_location())
+
+    async def read(self, size: int) -> bytes:
+        await self.fill(size)
+        return self.reader.read(size)
+
+    async def read_byte(self) -> bytes:
+        return await self.read(1)
+
+    async def read_string(self) -> str:
+        while True:
+            end = self.reader.find(b'\x00')
+            if end >= 0:
+                return self.reader.read_until(b'\x00').decode()
+            await self.__receive_more()
+
+    async def read_int(self) -> int:
+        if self.protocol_version == 2:
+            return await self.read_varint()
+
+        await self.fill(1)
+        size = self.reader.peek(1)[0]
+        assert 0 < size < 16
+        await self.fill(1 + size)
+        return int.from_bytes(self.reader.read_prefixed(), byteorder=self.endianness)
+
+    async def read_varint(self) -> int:
+        while not self.reader.varint_length():
+            await self.__receive_more()
+        return decode_zigzag(self.reader.read_varint())
+
+    async def read_location(self) -> int:
+        if self.protocol_version == 2:
+            return self.serial_info.metal_serial_write.address + await self.read_varint()
+
+        p = await self.read_int()
+        if p < self.base_pointer:
+            raise Exception("The value read was {}, which doesn't seem to be a code location".format(p))
+        return p - self.base_pointer
+
+    async def read_memory(self) -> bytes:
+        sz = await self.read_int()
+        return await self.read(sz)
+
+    def write_raw(self, data: bytes):
+        self.writer.write(data)
+
+    # the StreamWriter buffers anyway, this only exists so hooks can be written like for the Engine
+    @contextlib.contextmanager
+    def corked(self):
+        yield self
+
+    def write_byte(self, param: bytes):
+        self.write_raw(param[:1])
+
+    async def write_string(self, param: str) -> int:
+        self.write_raw(param.encode() + b'\x00')
+        return await self.read_int()
+
+    def write_int(self, param: int):
+        if self.protocol_version == 2:
+            self.write_raw(encode_varint(param))
+        else:
+            if param < 0:
+                as_bytes = param.to_bytes(self.int_length, self.endianness, signed=True)
+            else:
+                as_bytes = param.to_bytes(bytes_needed(param), self.endianness)
+            self.write_raw(len(as_bytes).to_bytes(1, self.endianness) + as_bytes)
+
+    async def write_memory(self, input: bytes) -> int:
+        self.write_int(len(input))
+        self.write_raw(input)
+        return await self.read_int()
+
+    async def run_sync(self, function: typing.Callable[..., None], *args):
+        if self.__threaded is None:
+            self.__threaded = ThreadedEngine(self)
+        threaded = self.__threaded
+
+        # corked output of the sync hook has to go out before its thread waits for a reply
+        self.reader.before_block = threaded.flush_output
+        try:
+            await self.loop.run_in_executor(self.executor, functools.partial(function, threaded, *args))
+        except asyncio.CancelledError:
+            self.thread_input.cancel()
+            raise
+        finally:
+            self.reader.before_block = None
+
+    async def run(self) -> int:
+        if self.init_marker is None:
+            await self.handshake()
+
+        hooks = [Hook() for Hook in self.macro_hooks]
+        exit_code_hook = next(hook for hook in hooks if isinstance(hook, Exit))
+
+        plan = self.build_dispatch_plan([hook if isinstance(hook, AsyncMacroHook) else SyncHookAdapter(hook) for hook in hooks])
+
+        while exit_code_hook.running:
+            address = await self.read_location()
+            try:
+                invoke = plan[address]
+            except KeyError:
+                raise Exception("Can't determine location for 0x{:x}".format(address))
+            await invoke()
+
+        await self.drain()
+
+        for hook in hooks:
+            hook.exit(exit_code_hook.exit_code)
+
+        return exit_code_hook.exit_code
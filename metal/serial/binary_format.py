@@ -0,0 +1,284 @@
+import bisect
+import collections.abc
+import json
+import mmap
+import struct
+import sys
+
+from array import array
+from typing import BinaryIO, Callable, Dict, List, Optional, Union
+
+from metal.serial.elfreader import Marker, Symbol
+from metal.serial.generate import SerialInfo
+from metal.serial.preprocessor import LexToken, MacroExpansion
+
+# Binary SerialInfo layout, all values little endian and every section aligned to 8 bytes:
+#
+#   header
+#   string offsets        u32[string_count + 1]
+#   string data           utf-8
+#   metal_serial_write    address u64, name u32, type u32
+#   marker addresses      u64[marker_count], sorted
+#   markers               name, type, file, line, column, expansion (u32 each)
+#   expansions            name, file, line, first argument, argument count (u32 each)
+#   arguments             u32[argument_count]
+#   argument tokens       first token, token count (u32 each) per argument, only with FLAG_TOKENS
+#   tokens                value, lineno, type, lexpos, source (u32 each), only with FLAG_TOKENS
+#   symbols               address u64, name u32, type u32
+
+MAGIC = b'MTLSER'
+VERSION = 1
+
+FLAG_TOKENS = 0x1
+NO_EXPANSION = 0xFFFFFFFF
+
+header_struct = struct.Struct('<6sHHIIIIII')
+symbol_struct = struct.Struct('<QII')
+marker_struct = struct.Struct('<IIIIII')
+expansion_struct = struct.Struct('<IIIII')
+range_struct = struct.Struct('<II')
+token_struct = struct.Struct('<IIIII')
+
+
+def align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+def is_binary_serial_info(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class StringTableBuilder:
+    def __init__(self):
+        self.index: Dict[str, int] = {}
+        self.strings: List[bytes] = []
+
+    def __call__(self, value: Optional[str]) -> int:
+        value = value if value is not None else ''
+        try:
+            return self.index[value]
+        except KeyError:
+            self.index[value] = len(self.strings)
+            self.strings.append(value.encode())
+            return self.index[value]
+
+
+def write_binary(serial_info: SerialInfo, output: BinaryIO, tokens: bool = True):
+    intern = StringTableBuilder()
+
+    metal_serial_write = symbol_struct.pack(serial_info.metal_serial_write.address,
+                                            intern(serial_info.metal_serial_write.name),
+                                            intern(serial_info.metal_serial_write.symbol_type))
+
+    # the stable sort keeps the first of several markers at the same address first, like SerialInfo.find_marker
+    markers = sorted(serial_info.markers, key=lambda m: m.address)
+
+    expansion_numbers = {}
+    for i, expansion in enumerate(serial_info.expansions):
+        expansion_numbers.setdefault((expansion.file, expansion.line), i)
+
+    marker_addresses = bytearray()
+    marker_records = bytearray()
+    for marker in markers:
+        marker_addresses += struct.pack('<Q', marker.address)
+        marker_records += marker_struct.pack(intern(marker.name), intern(marker.symbol_type), intern(marker.file),
+                                             marker.line, marker.column,
+                                             expansion_numbers.get((marker.file, marker.line), NO_EXPANSION))
+
+    expansion_records = bytearray()
+    argument_records = bytearray()
+    range_records = bytearray()
+    token_records = bytearray()
+    argument_count = 0
+    token_count = 0
+    for expansion in serial_info.expansions:
+        expansion_records += expansion_struct.pack(intern(expansion.name), intern(expansion.file), expansion.line,
+                                                   argument_count, len(expansion.args))
+        for i, arg in enumerate(expansion.args):
+            argument_records += struct.pack('<I', intern(arg))
+            if tokens:
+                arg_tokens = expansion.args_token[i] if i < len(expansion.args_token) else []
+                range_records += range_struct.pack(token_count, len(arg_tokens))
+                for tk in arg_tokens:
+                    token_records += token_struct.pack(intern(tk.value), tk.lineno, intern(tk.type), tk.lexpos, intern(tk.source))
+                token_count += len(arg_tokens)
+        argument_count += len(expansion.args)
+
+    symbol_records = bytearray()
+    for symbol in serial_info.symbols:
+        symbol_records += symbol_struct.pack(symbol.address, intern(symbol.name), intern(symbol.symbol_type))
+
+    string_offsets = array('I', [0])
+    for s in intern.strings:
+        string_offsets.append(string_offsets[-1] + len(s))
+    if sys.byteorder != 'little':
+        string_offsets.byteswap()
+
+    sections = [string_offsets.tobytes(), b''.join(intern.strings), metal_serial_write, bytes(marker_addresses), bytes(marker_records),
+                bytes(expansion_records), bytes(argument_records)]
+    if tokens:
+        sections += [bytes(range_records), bytes(token_records)]
+    sections.append(bytes(symbol_records))
+
+    output.write(header_struct.pack(MAGIC, VERSION, FLAG_TOKENS if tokens else 0, len(intern.strings), len(markers),
+                                    len(serial_info.expansions), argument_count, len(serial_info.symbols), token_count))
+    written = header_struct.size
+    for section in sections:
+        padding = align(written) - written
+        output.write(b'\x00' * padding + section)
+        written += padding + len(section)
+
+
+class LazyList(collections.abc.Sequence):
+    def __init__(self, length: int, item: Callable[[int], object]):
+        self.__length = length
+        self.__item = item
+
+    def __len__(self):
+        return self.__length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.__item(i) for i in range(*index.indices(self.__length))]
+        if index < 0:
+            index += self.__length
+        if not 0 <= index < self.__length:
+            raise IndexError(index)
+        return self.__item(index)
+
+
+# A SerialInfo backed by a memory mapped binary file.
+# Markers, expansions and symbols are only turned into python objects when accessed,
+# lookups by address bisect the sorted marker address column in place.
+class MappedSerialInfo:
+    metal_serial_write: Symbol
+    has_tokens: bool
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.__mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.__view = memoryview(self.__mmap)
+        magic, version, flags, string_count, marker_count, expansion_count, argument_count, symbol_count, token_count = \
+            header_struct.unpack_from(self.__mmap, 0)
+
+        if magic != MAGIC:
+            raise Exception('{} is not a binary serial info file'.format(path))
+        if version != VERSION:
+            raise Exception('Unsupported binary serial info version {} in {}'.format(version, path))
+
+        self.has_tokens = bool(flags & FLAG_TOKENS)
+        offset = header_struct.size
+
+        def section(size: int) -> int:
+            nonlocal offset
+            start = align(offset)
+            offset = start + size
+            return start
+
+        string_offsets = section(4 * (string_count + 1))
+        self.__string_offsets = self.__column(string_offsets, string_count + 1, 'I')
+        self.__strings = section(self.__string_offsets[string_count])
+        serial_write = section(symbol_struct.size)
+        self.__marker_addresses = self.__column(section(8 * marker_count), marker_count, 'Q')
+        self.__markers = section(marker_struct.size * marker_count)
+        self.__expansions = section(expansion_struct.size * expansion_count)
+        self.__arguments = section(4 * argument_count)
+        if self.has_tokens:
+            self.__ranges = section(range_struct.size * argument_count)
+            self.__tokens = section(token_struct.size * token_count)
+        self.__symbols = section(symbol_struct.size * symbol_count)
+
+        self.__decoded_strings: Dict[int, str] = {}
+        self.__decoded_expansions: Dict[int, MacroExpansion] = {}
+
+        address, name, type_ = symbol_struct.unpack_from(self.__mmap, serial_write)
+        self.metal_serial_write = Symbol(self.string(name), address, self.string(type_))
+
+        self.markers = LazyList(marker_count, self.__marker)
+        self.expansions = LazyList(expansion_count, self.__expansion)
+        self.symbols = LazyList(symbol_count, self.__symbol)
+
+    def __column(self, offset: int, count: int, typecode: str):
+        data = self.__view[offset:offset + array(typecode).itemsize * count]
+        if sys.byteorder == 'little':
+            return data.cast(typecode)
+        column = array(typecode)
+        column.frombytes(data)
+        column.byteswap()
+        return column
+
+    def string(self, index: int) -> str:
+        try:
+            return self.__decoded_strings[index]
+        except KeyError:
+            start = self.__strings + self.__string_offsets[index]
+            end = self.__strings + self.__string_offsets[index + 1]
+            value = self.__decoded_strings[index] = self.__view[start:end].tobytes().decode()
+            return value
+
+    def __marker_record(self, index: int):
+        return marker_struct.unpack_from(self.__mmap, self.__markers + index * marker_struct.size)
+
+    def __marker(self, index: int) -> Marker:
+        name, type_, file, line, column, _ = self.__marker_record(index)
+        return Marker(self.string(name), self.__marker_addresses[index], self.string(type_), self.string(file), line, column)
+
+    def __expansion(self, index: int) -> MacroExpansion:
+        try:
+            return self.__decoded_expansions[index]
+        except KeyError:
+            pass
+
+        name, file, line, first_arg, arg_count = expansion_struct.unpack_from(self.__mmap, self.__expansions + index * expansion_struct.size)
+        args = [self.string(i) for i in struct.unpack_from('<{}I'.format(arg_count), self.__mmap, self.__arguments + 4 * first_arg)]
+        args_token = []
+        if self.has_tokens:
+            for arg in range(first_arg, first_arg + arg_count):
+                first_token, token_count = range_struct.unpack_from(self.__mmap, self.__ranges + arg * range_struct.size)
+                args_token.append([self.__token(i) for i in range(first_token, first_token + token_count)])
+
+        expansion = self.__decoded_expansions[index] = MacroExpansion(self.string(name), args, args_token, self.string(file), line)
+        return expansion
+
+    def __token(self, index: int) -> LexToken:
+        value, lineno, type_, lexpos, source = token_struct.unpack_from(self.__mmap, self.__tokens + index * token_struct.size)
+        return LexToken(self.string(value), lineno, self.string(type_), lexpos, self.string(source))
+
+    def __symbol(self, index: int) -> Symbol:
+        address, name, type_ = symbol_struct.unpack_from(self.__mmap, self.__symbols + index * symbol_struct.size)
+        return Symbol(self.string(name), address, self.string(type_))
+
+    def __marker_index(self, address: int) -> Optional[int]:
+        index = bisect.bisect_left(self.__marker_addresses, address)
+        if index < len(self.__marker_addresses) and self.__marker_addresses[index] == address:
+            return index
+        return None
+
+    def find_marker(self, address: int) -> Optional[Marker]:
+        index = self.__marker_index(address)
+        return self.__marker(index) if index is not None else None
+
+    def find_macro_expansion(self, marker: Marker) -> Optional[MacroExpansion]:
+        index = self.__marker_index(marker.address)
+        if index is not None:
+            _, _, file, line, _, expansion = self.__marker_record(index)
+            if self.string(file) == marker.file and line == marker.line:
+                return self.__expansion(expansion) if expansion != NO_EXPANSION else None
+
+        return next((expansion for expansion in self.expansions if expansion.file == marker.file and expansion.line == marker.line), None)
+
+    def to_serial_info(self) -> SerialInfo:
+        return SerialInfo(list(self.symbols), self.metal_serial_write, list(self.expansions), list(self.markers))
+
+    def to_dict(self, demangled_names: bool = False):
+        return self.to_serial_info().to_dict(demangled_names)
+
+
+def load_serial_info(path: str) -> Union[SerialInfo, MappedSerialInfo]:
+    if is_binary_serial_info(path):
+        return MappedSerialInfo(path)
+
+    with open(path) as f:
+        return SerialInfo.from_dict(json.load(f))
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from metal.serial.generate import SerialInfo
+
+
+def hash_file(path: str) -> Optional[str]:
+    try:
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+            return digest.hexdigest()
+    except OSError:
+        return None
+
+
+# On-disk cache of generated SerialInfo.
+# An entry is keyed by the binary's content and the preprocessor settings and stores the hash of every source and header
+# the preprocessor opened, so a hit is only reported if none of them changed. The least recently used entries get evicted
+# once the directory exceeds max_size bytes.
+class SerialInfoCache:
+    directory: str
+    max_size: int
+
+    suffix = '.serial-info.json'
+    default_max_size = 256 * 1024 * 1024
+
+    def __init__(self, directory: str, max_size: int = default_max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    @staticmethod
+    def key(binary: str, defines: List[str], paths: List[str], macros: List[str],
+            symbols: Union[str, Tuple[int, int]] = 'none') -> Optional[str]:
+        binary_hash = hash_file(binary)
+        if binary_hash is None:
+            return None
+
+        return hashlib.sha256(json.dumps({
+            'binary': binary_hash,
+            'defines': list(defines),
+            'paths': [os.path.abspath(p) for p in paths],
+            'macros': list(macros),
+            'symbols': symbols if isinstance(symbols, str) else list(symbols)
+        }).encode()).hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.suffix)
+
+    def load(self, key: str) -> Optional[SerialInfo]:
+        path = self.entry_path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # an entry written by another version or damaged otherwise is just a miss
+        try:
+            for dependency, digest in entry['dependencies'].items():
+                if hash_file(dependency) != digest:
+                    return None
+            serial_info = SerialInfo.from_dict(entry['serial_info'])
+        except (KeyError, TypeError, AttributeError, ValueError):
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return serial_info
+
+    def store(self, key: str, serial_info: SerialInfo, dependencies: Iterable[str]):
+        os.makedirs(self.directory, exist_ok=True)
+
+        hashes: Dict[str, Optional[str]] = {dep: hash_file(dep) for dep in sorted(set(dependencies))}
+        entry = {
+            'dependencies': {dep: digest for dep, digest in hashes.items() if digest is not None},
+            'serial_info': serial_info.to_dict()
+        }
+
+        path = self.entry_path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
@@ -4,4 +4,5 @@ from metal.serial import MacroHook, Init, Exit
 from metal.serial import newlib, unit
 
 
-default_hooks: __typing.List[__typing.Type[MacroHook]] = [newlib.Syscall, unit.Unit]
\ No newline at end of file
+default_hooks: __typing.List[__typing.Callable[[], MacroHook]] = [newlib.Syscall, unit.Unit]
+async_default_hooks: __typing.List[__typing.Callable[[], MacroHook]] = [newlib.Syscall, unit.AsyncUnit]
@@ -1,6 +1,8 @@
+import functools
+
 from os import path
 
-from typing import Optional, List, Tuple
+from typing import Dict, Optional, List, Tuple
 
 from elftools.dwarf.lineprogram import LineProgramEntry,  LineProgram
 from elftools.elf.elffile import ELFFile
@@ -12,9 +14,17 @@ warnings.filterwarnings("ignore",category=SyntaxWarning,module=r".*itanium_deman
 
 import itanium_demangler
 
+
+@functools.lru_cache(maxsize=None)
+def demangle(name: str) -> Optional[str]:
+    try:
+        return str(itanium_demangler.parse(name.split('@')[0]))
+    except:
+        return None
+
+
 class Symbol:
     name: str
-    demangled_name: Optional[str]
     address: int
     symbol_type: str
 
@@ -22,14 +32,18 @@ class Symbol:
         self.name = name
         self.address = address
         self.symbol_type = symbol_type
+        self._demangled_name = demangled_name
 
-        if demangled_name is None:
-            try:
-                self.demangled_name = str(itanium_demangler.parse(name.split('@')[0]))
-            except:
-                self.demangled_name = demangled_name
-        else:
-            self.demangled_name = demangled_name
+    # Demangling is expensive and rarely needed, so it only happens on first access.
+    @property
+    def demangled_name(self) -> Optional[str]:
+        if self._demangled_name is None:
+            self._demangled_name = demangle(self.name)
+        return self._demangled_name
+
+    @demangled_name.setter
+    def demangled_name(self, value: Optional[str]):
+        self._demangled_name = value
 
     def __str__(self):
         if self.demangled_name and self.name == self.demangled_name:
@@ -40,13 +54,15 @@ class Symbol:
     def __repr__(self):
         return self.__str__()
 
-    def to_dict(self):
-        return {
+    def to_dict(self, demangled_name: bool = True):
+        res = {
             'name' : self.name,
             'address' : self.address,
-            'symbol_type' : self.symbol_type,
-            'demangled_name': self.demangled_name
+            'symbol_type' : self.symbol_type
         }
+        if demangled_name:
+            res['demangled_name'] = self.demangled_name
+        return res
 
     @classmethod
     def from_dict(cls, param):
@@ -54,7 +70,7 @@ class Symbol:
             param['name'],
             param['address'],
             param['symbol_type'],
-            param['demangled_name'])
+            param.get('demangled_name'))
 
 
 class Marker(Symbol):
@@ -92,11 +108,13 @@ class Marker(Symbol):
 class CompileUnitInput:
     name: str
     compile_directory: str
+    markers: List[Marker]
 
     def __init__(self, name: str, compile_directory: str, files: List[str]):
         self.name = name
         self.compile_directory = compile_directory
         self.files = files
+        self.markers = []
 
     @property
     def absolute_path(self):
@@ -132,23 +150,37 @@ class ELFReader:
                 else:
                     return path.join('.', file_entry.name.decode())
 
-            cu_helper = [(cu, dbg.line_program_for_CU(cu)) for cu in dbg.iter_CUs()]
-
-            self.compile_units = [
-                CompileUnitInput(die.attributes['DW_AT_name'].value.decode(),
-                                 die.attributes['DW_AT_comp_dir'].value.decode(),
-                                 [file_entry_to_abs(fe, linep) for fe in linep['file_entry']])
-                for cu, linep in cu_helper for die in cu.iter_DIEs() if die.tag == 'DW_TAG_compile_unit'
-            ]
+            cu_helper = []
+            self.compile_units = []
+            for cu in dbg.iter_CUs():
+                linep = dbg.line_program_for_CU(cu)
+                die = cu.get_top_DIE()
+                compile_unit = None
+                if die.tag == 'DW_TAG_compile_unit':
+                    compile_unit = CompileUnitInput(die.attributes['DW_AT_name'].value.decode(),
+                                                    die.attributes['DW_AT_comp_dir'].value.decode(),
+                                                    [file_entry_to_abs(fe, linep) for fe in linep['file_entry']])
+                    self.compile_units.append(compile_unit)
+                cu_helper.append((compile_unit, linep))
 
             # find compile units
             self.markers = []
 
-            for msym in (sym for sym in self.symbols if sym.name.startswith('__metal_serial_')):
+            marker_symbols = [sym for sym in self.symbols if sym.name.startswith('__metal_serial_')]
+
+            # Decode every line program once and keep the first row for each marker address.
+            marker_addresses = set(sym.address for sym in marker_symbols)
+            line_index: Dict[int, Tuple[LineProgramEntry, LineProgram, Optional[CompileUnitInput]]] = {}
+            for (cu, linep) in cu_helper:
+                if linep is None:
+                    continue
+                for entry in linep.get_entries():
+                    if entry.state is not None and entry.state.address in marker_addresses and entry.state.address not in line_index:
+                        line_index[entry.state.address] = (entry, linep, cu)
+
+            for msym in marker_symbols:
                 try:
-                    nx : Tuple[LineProgramEntry, LineProgram] = next((entry, linep) for (cu, linep) in cu_helper for entry in linep.get_entries()
-                               if entry.state is not None and entry.state.address == msym.address)
-                    (loc, linep) = nx
+                    (loc, linep, compile_unit) = line_index[msym.address]
 
                     abs_file_entry = file_entry_to_abs(linep['file_entry'][loc.state.file - 1], linep)
 
@@ -158,15 +190,18 @@ class ELFReader:
                     #        print(msym.name, existing_marker.name)
                     #        raise Exception("Duplicate code markers found at {}({})".format(existing_marker.file, existing_marker.line))
 
-                    self.markers.append(Marker(
+                    marker = Marker(
                         msym.name,
                         msym.address,
                         msym.symbol_type,
                         abs_file_entry,
                         loc.state.line,
                         loc.state.column
-                    ))
-                except StopIteration:
+                    )
+                    self.markers.append(marker)
+                    if compile_unit is not None:
+                        compile_unit.markers.append(marker)
+                except KeyError:
                     raise Exception('Could not find code location for {} at 0x{:x} - this is most likely due to missing gdb symbols.'.format(msym.name, msym.address))
 
     def get_markers(self):
@@ -1,5 +1,8 @@
 import collections
+import contextlib
+import functools
 import re
+import sys
 
 import typing
 
@@ -7,11 +10,13 @@ import typing
 from subprocess import PIPE, Popen
 
 from .elfreader import Marker
+from .framing import FrameGap, FramedInput, Gap
 from .generate import SerialInfo
 from .hooks import MacroHook, Exit, Init
 from .location import Location
 from .preprocessor import MacroExpansion
 from .read_symbols import Symbol
+from .reader import BufferedInput
 
 from math import log
 
@@ -21,11 +26,126 @@ def bytes_needed(n: int ):
         return 1
     return int(log(n, 256)) + 1
 
-class Engine:
+
+def detect_endianness(int_length: int, endian_checker: bytes) -> typing.Optional[str]:
+    if int_length == 1:
+        if endian_checker == b'\x43':
+            return 'little'
+        elif endian_checker == b'\x6C':
+            return 'big'
+    elif int_length == 2:
+        if endian_checker == b'\x43\x6C':
+            return 'little'
+        elif endian_checker == b'\x6C\x43':
+            return 'big'
+    elif int_length == 4:
+        if endian_checker ==  b'\x43\x6C\x00\x00':
+            return 'little'
+        elif endian_checker == b'\x00\x00\x6C\x43':
+            return 'big'
+    elif int_length == 8:
+        if endian_checker == b'\x43\x6C\x00\x00\x00\x00\x00\x00':
+            return 'little'
+        elif endian_checker == b'\x00\x00\x00\x00\x00\x00\x6C\x43':
+            return 'big'
+    return None
+
+
+def decode_zigzag(value: int) -> int:
+    return -(value >> 1) - 1 if value & 1 else value >> 1
+
+
+def encode_varint(param: int) -> bytes:
+    value = ((-param - 1) << 1) | 1 if param < 0 else param << 1
+    data = bytearray()
+    while value > 0x7F:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+# the hook factories with Init & Exit added if they're missing, without touching the given list
+def with_builtin_hooks(macro_hooks: typing.List[typing.Callable[[], MacroHook]],
+                       init: typing.Type[MacroHook] = Init, exit: typing.Type[MacroHook] = Exit) -> typing.List[typing.Callable[[], MacroHook]]:
+    macro_hooks = list(macro_hooks)
+    if not any(isinstance(h, type) and issubclass(h, Init) for h in macro_hooks):
+        macro_hooks.append(init)
+    if not any(isinstance(h, type) and issubclass(h, Exit) for h in macro_hooks):
+        macro_hooks.append(exit)
+    return macro_hooks
+
+
+# calls invoke once the hooks holding back the target's output have written it, so their output stays in order
+def flushed(buffering: typing.List[MacroHook], invoke: typing.Callable[[], typing.Any]):
+    for hook in buffering:
+        hook.flush_output()
+    return invoke()
+
+
+# Resolving what the target sent against the SerialInfo, shared by Engine and AsyncEngine
+class MarkerLookup:
+    serial_info: SerialInfo
+
+    def find_symbol(self, addr: int) -> typing.Optional[str]:
+        for symbol in self.serial_info.symbols:
+            if symbol.address == addr:
+                return symbol.name
+
+    def find_marker(self, addr: int) -> Marker:
+        marker = self.serial_info.find_marker(addr)
+        if marker is None:
+            raise Exception("Can't determine location for 0x{:x}".format(addr))
+        return marker
+
+    def find_macro_expansion(self, marker: Marker) -> MacroExpansion:
+        expansion = self.serial_info.find_macro_expansion(marker)
+        if expansion is None:
+            raise Exception("{}({}) Can't find macro expansion.".format(marker.file, marker.line))
+        return expansion
+
+    def build_dispatch_plan(self, hooks: typing.List[MacroHook]) -> typing.Dict[int, typing.Callable[[], None]]:
+        hooks_by_identifier: typing.Dict[str, MacroHook] = {}
+        for hook in hooks:
+            hooks_by_identifier.setdefault(hook.identifier, hook)
+
+        # Markers that cannot be resolved only raise when the target actually reaches them,
+        # because a binary may well contain markers the selected hooks never see.
+        def fail(message: str):
+            raise Exception(message)
+
+        buffering = [hook for hook in hooks if hook.buffers_output]
+
+        plan = {}
+        for marker in self.serial_info.markers:
+            if marker.address in plan:
+                continue
+
+            macro_expansion = self.serial_info.find_macro_expansion(marker)
+            if macro_expansion is None:
+                plan[marker.address] = functools.partial(fail, "{}({}) Can't find macro expansion.".format(marker.file, marker.line))
+                continue
+
+            hook = hooks_by_identifier.get(macro_expansion.name)
+            if hook is None:
+                plan[marker.address] = functools.partial(fail, "Cannot find hook for macro '{}'".format(macro_expansion.name))
+                continue
+
+            invoke = functools.partial(hook.invoke, self, macro_expansion)
+            if buffering and not hook.buffers_output:
+                invoke = functools.partial(flushed, buffering, invoke)
+            plan[marker.address] = invoke
+
+        return plan
+
+
+class Engine(MarkerLookup):
 
     serial_info: SerialInfo
     init_marker: Marker
     version_string = '__metal_serial_version_1'
+    version_string_v2 = '__metal_serial_version_2'
+    protocol_version: int
 
     endianness: str
     base_pointer: int
@@ -33,55 +153,38 @@ class Engine:
     macro_hooks : typing.List[typing.Type[MacroHook]]
 
     def __init__(self, serial_info: SerialInfo, input: typing.IO, output: typing.Optional[typing.IO] = None,
-                 macro_hooks: typing.List[typing.Callable[[], MacroHook]] = None):
+                 macro_hooks: typing.List[typing.Callable[[], MacroHook]] = None,
+                 recorder: typing.Optional['CaptureWriter'] = None, framed: typing.Optional[bool] = None):
 
         if macro_hooks is None:
             from metal.serial import default_hooks
-            self.macro_hooks = default_hooks
-        else:
-            self.macro_hooks = macro_hooks
+            macro_hooks = default_hooks
+        self.macro_hooks = with_builtin_hooks(macro_hooks)
 
-        try:
-            next(h for h in self.macro_hooks if isinstance(h, Init))
-        except StopIteration:
-            self.macro_hooks.append(Init)
+        # framing is detected from the first byte the target sends, unless framed is given
+        self.transport = FramedInput(input, framed)
+        input = self.transport
 
-        try:
-            next(h for h in self.macro_hooks if isinstance(h, Exit))
-        except StopIteration:
-            self.macro_hooks.append(Exit)
+        self.recorder = recorder
+        if recorder is not None:
+            from metal.serial.replay import RecordingInput, RecordingOutput
+            input = RecordingInput(input, recorder)
+            if output is not None:
+                output = RecordingOutput(output, recorder)
 
         self.input = input
+        # pending output gets sent before blocking on input, so a reply read inside corked() can't deadlock
+        self.reader = BufferedInput(input, before_block=self.flush_output)
         self.output = output
+        self._cork: typing.Optional[bytearray] = None
         self.serial_info = serial_info
 
         # Initialize the connection
-        target_version = self.read_string()
-        assert target_version == Engine.version_string
+        self.select_protocol(self.read_string())
 
         self.int_length = int.from_bytes(self.read_byte(), 'big')
-        endian_checker = input.read(self.int_length)
-
-        if self.int_length == 1:
-            if endian_checker == b'\x43':
-                self.endianness = 'little'
-            elif endian_checker == b'\x6C':
-                self.endianness = 'big'
-        elif self.int_length == 2:
-            if endian_checker == b'\x43\x6C':
-                self.endianness = 'little'
-            elif endian_checker == b'\x6C\x43':
-                self.endianness = 'big'
-        elif self.int_length == 4:
-            if endian_checker ==  b'\x43\x6C\x00\x00':
-                self.endianness = 'little'
-            elif endian_checker == b'\x00\x00\x6C\x43':
-                self.endianness = 'big'
-        elif self.int_length == 8:
-            if endian_checker == b'\x43\x6C\x00\x00\x00\x00\x00\x00':
-                self.endianness = 'little'
-            elif endian_checker == b'\x00\x00\x00\x00\x00\x00\x6C\x43':
-                self.endianness = 'big'
+        endian_checker = self.reader.read(self.int_length)
+        self.endianness = detect_endianness(self.int_length, endian_checker)
 
         if self.endianness is None:
             raise Exception('Invalid endianness checker {}'.format(endian_checker))
@@ -95,37 +198,85 @@ class Engine:
 
         self.init_marker = self.find_marker(self.read_location())
 
+    def select_protocol(self, target_version: str):
+        assert target_version in (Engine.version_string, Engine.version_string_v2)
+
+        # v2 targets send varints and locations relative to metal_serial_write
+        self.protocol_version = 2 if target_version == Engine.version_string_v2 else 1
+        if self.protocol_version == 2:
+            self.read_int = self.read_varint
+            self.write_int = self.write_varint
+            self.read_location = self.read_location_offset
+
+    @property
+    def gaps(self) -> typing.List[Gap]:
+        return self.transport.gaps
+
+    @property
+    def skipped_bytes(self) -> int:
+        return self.transport.skipped_bytes
+
     def read_byte(self) -> bytes :
-        return self.input.read(1)
+        return self.reader.read(1)
+
+    def write_raw(self, data: bytes):
+        if self._cork is not None:
+            self._cork += data
+        else:
+            self.output.write(data)
+            self.output.flush()
+
+    def flush_output(self):
+        if self._cork:
+            data = bytes(self._cork)
+            self._cork.clear()
+            self.output.write(data)
+            self.output.flush()
+
+    @contextlib.contextmanager
+    def corked(self):
+        if self._cork is not None:
+            yield self
+            return
+
+        self._cork = bytearray()
+        try:
+            yield self
+        finally:
+            self.flush_output()
+            self._cork = None
 
     def write_byte(self, param: bytes):
-        self.output.write(param[:1])
-        self.output.flush()
+        self.write_raw(param[:1])
 
     def read_string(self) -> str:
-        chars = bytearray()
-        while True:
-            c = self.read_byte()
-            if c == b'\x00':
-                return chars.decode()
-            chars.extend(c)
+        return self.reader.read_until(b'\x00').decode()
 
     def write_string(self, param: str) -> int:
-        self.output.write(param.encode() + b'\x00')
-        self.output.flush()
+        self.write_raw(param.encode() + b'\x00')
         return self.read_int()
 
     def read_int(self) -> int:
-        sz = self.input.read(1)
-        assert 0 < int.from_bytes(sz, self.endianness) < 16
-        value = self.input.read(int.from_bytes(sz, self.endianness))
+        value = self.reader.read_prefixed()
+        assert 0 < len(value) < 16
         return int.from_bytes(value, byteorder=self.endianness)
 
     def write_int(self, param: int):
-        as_bytes = param.to_bytes(bytes_needed(param), self.endianness)
-        self.output.write(len(as_bytes).to_bytes(1, self.endianness))
-        self.output.write(as_bytes)
-        self.output.flush()
+        # negative values, e.g. the -1 of a failed syscall, are sent as two's complement of the target's int
+        if param < 0:
+            as_bytes = param.to_bytes(self.int_length, self.endianness, signed=True)
+        else:
+            as_bytes = param.to_bytes(bytes_needed(param), self.endianness)
+        self.write_raw(len(as_bytes).to_bytes(1, self.endianness) + as_bytes)
+
+    def read_varint(self) -> int:
+        return decode_zigzag(self.reader.read_varint())
+
+    def write_varint(self, param: int):
+        self.write_raw(encode_varint(param))
+
+    def read_location_offset(self) -> int:
+        return self.serial_info.metal_serial_write.address + self.read_varint()
 
     def read_location(self) -> int:
         p =  self.read_int()
@@ -134,45 +285,35 @@ class Engine:
         return p - self.base_pointer
 
     def write_memory(self, input: bytes) -> int:
-        self.write_int(len(input))
-        self.output.write(input)
-        self.output.flush()
+        with self.corked():
+            self.write_int(len(input))
+            self.write_raw(input)
         return self.read_int()
 
     def read_memory(self) -> bytes:
         sz = self.read_int()
-        return self.input.read(sz)
+        return self.reader.read(sz)
     
-    def find_symbol(self, addr: int) -> str:
-        for name, address in self.symbols:
-            if address == addr:
-                return name
-
-    def find_marker(self, addr: int) -> Marker:
-        try:
-            return next(marker for marker in self.serial_info.markers if marker.address == addr)
-        except StopIteration:
-            raise Exception("Can't determine location for 0x{:x}".format(addr))
-
-    def find_macro_expansion(self, marker: Marker) -> MacroExpansion:
-        try:
-            return next(expansion for expansion in self.serial_info.expansions if marker.file == expansion.file and marker.line == expansion.line)
-        except StopIteration:
-            raise Exception("{}({}) Can't find macro expansion.".format(marker.file, marker.line))
-
     def run(self) -> int:
         hooks = [Hook() for Hook in self.macro_hooks]
         exit_code_hook = next(hook for hook in hooks if isinstance(hook, Exit))
 
-        while exit_code_hook.running:
-            next_marker = self.find_marker(self.read_location())
-            macro_expansion = self.find_macro_expansion(next_marker)
+        plan = self.build_dispatch_plan(hooks)
 
+        while exit_code_hook.running:
+            if self.recorder is not None:
+                self.recorder.message(self.reader.offset)
             try:
-                hook = next((hook for hook in hooks if hook.identifier == macro_expansion.name))
-                hook.invoke(self, macro_expansion)
-            except StopIteration:
-                raise Exception("Cannot find hook for macro '{}'".format(macro_expansion.name))
+                address = self.read_location()
+                try:
+                    invoke = plan[address]
+                except KeyError:
+                    raise Exception("Can't determine location for 0x{:x}".format(address))
+                invoke()
+            except FrameGap as e:
+                # the message being decoded is incomplete, the framed input continues at the next one
+                print('***metal.serial***: {}, resynchronizing'.format(e), file=sys.stderr)
+                self.reader.discard()
 
         for hook in hooks:
             hook.exit(exit_code_hook.exit_code)
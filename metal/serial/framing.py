@@ -0,0 +1,141 @@
+import binascii
+import struct
+import typing
+
+from .reader import BufferedInput
+
+# Frames written by a target built with METAL_SERIAL_FRAMED (see src/metal/serial/framing.c):
+#
+#   sync            0xA5 0x5A
+#   header          length u8, sequence u8, message offset u8 (0xFF if no message starts in this frame)
+#   payload         length bytes
+#   crc             u16 little endian, CRC-CCITT with initial value 0xFFFF over header & payload
+#
+# Only the target's output is framed, the host's replies are sent as they are.
+
+frame_sync = b'\xA5\x5A'
+header_struct = struct.Struct('<2sBBB')
+crc_struct = struct.Struct('<H')
+NO_MESSAGE = 0xFF
+
+
+class Gap(typing.NamedTuple):
+    # offset in the decoded stream where the data went missing
+    offset: int
+    # frames missing according to the sequence numbers, modulo 256
+    lost_frames: int
+    # bytes dropped while looking for the next valid frame
+    skipped_bytes: int
+
+
+class FrameGap(Exception):
+    def __init__(self, gap: Gap):
+        super().__init__('Lost {} frame(s) and skipped {} byte(s) of corrupted input at offset {}'.format(
+            gap.lost_frames, gap.skipped_bytes, gap.offset))
+        self.gap = gap
+
+
+class Frame(typing.NamedTuple):
+    sequence: int
+    message: int
+    payload: bytes
+
+
+# Decodes the framed target output into the plain byte stream the engine reads.
+# Corrupted frames are dropped. When data went missing, i.e. the sequence numbers jump, the message being decoded is lost,
+# so the input continues at the next message start and raises FrameGap once, which lets the engine abandon the broken message.
+# Noise between two consecutive frames is only counted in skipped_bytes.
+# Input that doesn't start with a frame is passed through unchanged, unless framed is set explicitly.
+class FramedInput:
+    gaps: typing.List[Gap]
+
+    def __init__(self, input: typing.IO, framed: typing.Optional[bool] = None):
+        self.raw = BufferedInput(input)
+        self.framed = framed
+        self.gaps = []
+        self.skipped_bytes = 0
+        self.sequence: typing.Optional[int] = None
+        self.pending = b''
+        self.decoded = 0
+        self.__gap: typing.Optional[Gap] = None
+
+    def __read_frame(self) -> typing.Tuple[typing.Optional[Frame], int]:
+        skipped = 0
+        try:
+            while True:
+                header = self.raw.peek(header_struct.size)
+                if header[:2] != frame_sync:
+                    data = self.raw.peek(self.raw.available)
+                    start = data.find(frame_sync, 1)
+                    # keep a trailing first sync byte, its partner may still be on its way
+                    count = start if start >= 0 else len(data) - (1 if data.endswith(frame_sync[:1]) else 0)
+                    count = max(count, 1)
+                    self.raw.skip(count)
+                    skipped += count
+                    continue
+
+                _, length, sequence, message = header_struct.unpack(header)
+                size = header_struct.size + length + crc_struct.size
+                data = self.raw.peek(size)
+                crc, = crc_struct.unpack_from(data, size - crc_struct.size)
+                if crc != binascii.crc_hqx(data[2:size - crc_struct.size], 0xFFFF) or (message != NO_MESSAGE and message >= length):
+                    self.raw.skip(1)
+                    skipped += 1
+                    continue
+
+                self.raw.skip(size)
+                return Frame(sequence, message, data[header_struct.size:size - crc_struct.size]), skipped
+        except EOFError:
+            return None, skipped
+
+    def __next_payload(self) -> bytes:
+        while True:
+            frame, skipped = self.__read_frame()
+            if frame is None:
+                return b''
+
+            self.skipped_bytes += skipped
+            if self.sequence is not None and frame.sequence != self.sequence:
+                lost = (frame.sequence - self.sequence) & 0xFF
+                self.__gap = Gap(self.decoded, lost, skipped)
+                self.gaps.append(self.__gap)
+            self.sequence = (frame.sequence + 1) & 0xFF
+
+            if self.__gap is None:
+                return frame.payload
+            if frame.message != NO_MESSAGE:
+                return frame.payload[frame.message:]
+
+    def read1(self, size: int = -1) -> bytes:
+        if self.framed is None:
+            try:
+                self.framed = self.raw.peek(1) == frame_sync[:1]
+            except EOFError:
+                return b''
+
+        if not self.framed:
+            try:
+                self.raw.fill(1)
+            except EOFError:
+                return b''
+            return self.raw.read(min(size, self.raw.available) if size > 0 else self.raw.available)
+
+        if not self.pending:
+            self.pending = self.__next_payload()
+            if self.__gap is not None:
+                gap, self.__gap = self.__gap, None
+                raise FrameGap(gap)
+
+        data = self.pending[:size] if size > 0 else self.pending
+        self.pending = self.pending[len(data):]
+        self.decoded += len(data)
+        return data
+
+    def read(self, size: int = -1) -> bytes:
+        data = bytearray()
+        while size < 0 or len(data) < size:
+            chunk = self.read1(size - len(data) if size >= 0 else -1)
+            if not chunk:
+                break
+            data += chunk
+        return bytes(data)
@@ -1,5 +1,8 @@
+import concurrent.futures
 import json
-from typing import List
+import os
+import sys
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 import argparse
 
@@ -13,18 +16,56 @@ class SerialInfo:
     expansions: List[MacroExpansion]
     markers: List[Marker]
 
+    marker_index: Dict[int, Marker]
+    expansion_index: Dict[Tuple[str, int], MacroExpansion]
+
     def __init__(self, symbols: List[Symbol], metal_serial_write: Symbol, expansions: List[MacroExpansion], markers: List[Marker]):
         self.metal_serial_write = metal_serial_write
         self.expansions = expansions
         self.markers = markers
         self.symbols = symbols
 
-    def to_dict(self):
+        self.build_index()
+
+    def build_index(self):
+        # The first entry wins, so lookups match a linear scan over the lists.
+        self.marker_index = {}
+        for marker in self.markers:
+            self.marker_index.setdefault(marker.address, marker)
+
+        self.expansion_index = {}
+        for expansion in self.expansions:
+            self.expansion_index.setdefault((expansion.file, expansion.line), expansion)
+
+    def find_marker(self, address: int) -> Optional[Marker]:
+        return self.marker_index.get(address)
+
+    def find_macro_expansion(self, marker: Marker) -> Optional[MacroExpansion]:
+        return self.expansion_index.get((marker.file, marker.line))
+
+    # symbols is either 'all', 'none' or a [start, end) address range of symbols to keep.
+    # Markers, the expansions they use and metal_serial_write are always kept, since decoding needs them.
+    def slim(self, symbols: Union[str, Tuple[int, int]] = 'none') -> 'SerialInfo':
+        used = set(id(self.find_macro_expansion(marker)) for marker in self.markers)
+        expansions = [expansion for expansion in self.expansions
+                      if id(expansion) in used and self.expansion_index.get((expansion.file, expansion.line)) is expansion]
+
+        if symbols == 'all':
+            kept_symbols = self.symbols
+        elif symbols == 'none':
+            kept_symbols = []
+        else:
+            start, end = symbols
+            kept_symbols = [symbol for symbol in self.symbols if start <= symbol.address < end]
+
+        return SerialInfo(kept_symbols, self.metal_serial_write, expansions, self.markers)
+
+    def to_dict(self, demangled_names: bool = False):
         return {
-            'metal_serial_write': self.metal_serial_write.to_dict(),
+            'metal_serial_write': self.metal_serial_write.to_dict(demangled_names),
             'expansions': [ex.to_dict() for ex in self.expansions],
             'markers': [marker.to_dict() for marker in self.markers],
-            'symbols': [symbol.to_dict() for symbol in self.symbols],
+            'symbols': [symbol.to_dict(demangled_names) for symbol in self.symbols],
         }
 
     @classmethod
@@ -34,19 +75,70 @@ class SerialInfo:
                     markers=[Marker.from_dict(marker) for marker in data['markers']])
 
 
-def generate(binary: str, defines: List[str] = [], paths: List[str] = [], macros: List[str] = None) -> SerialInfo:
+def preprocess_job(absolute_path: str, markers: List[Marker], defines: List[str], paths: List[str], macros: List[str]) \
+        -> Tuple[List[MacroExpansion], Set[str]]:
+    dependencies: Set[str] = set()
+    expansions = preprocess_compile_unit(absolute_path, paths=paths, macros=list(macros), defines=defines, markers=markers, dependencies=dependencies)
+    return expansions, dependencies
+
+
+def generate(binary: str, defines: List[str] = [], paths: List[str] = [], macros: List[str] = None,
+             cache: Optional['SerialInfoCache'] = None, jobs: int = 1,
+             symbols: Union[str, Tuple[int, int]] = 'none') -> SerialInfo:
 
     if macros is None:
         from metal.serial import default_hooks
         macros = [hook.identifier for hook in default_hooks]
 
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key(binary, defines, paths, macros, symbols)
+        cached = cache.load(cache_key) if cache_key else None
+        if cached is not None:
+            return cached
+
     elf_reader = ELFReader(binary)
 
-    expansions : List[MacroExpansion] = []
+    # preprocess_compile_unit only checks the markers located in the compile unit itself, so only those get sent to a job
+    markers_by_file: Dict[str, List[Marker]] = {}
+    for marker in elf_reader.get_markers():
+        markers_by_file.setdefault(marker.file, []).append(marker)
+
+    # Only compile units that emitted a marker can provide the expansions needed to decode them.
+    compile_units = []
     for cu in elf_reader.compile_units:
-        expansions = expansions + preprocess_compile_unit(cu.absolute_path, paths=paths, macros=macros, defines=defines, markers=elf_reader.get_markers())
+        if not cu.markers:
+            continue
+        if not os.path.isfile(cu.absolute_path):
+            print("***metal.serial***: Can't find source {} of compile unit with serial markers, skipping it".format(cu.absolute_path), file=sys.stderr)
+            continue
+        compile_units.append(cu)
+
+    job_args = [(cu.absolute_path, markers_by_file.get(cu.absolute_path, []), defines, paths, macros) for cu in compile_units]
+
+    if jobs is None or jobs < 1:
+        jobs = os.cpu_count() or 1
+
+    if jobs == 1 or len(job_args) < 2:
+        results = [preprocess_job(*args) for args in job_args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(job_args))) as executor:
+            # map yields in submission order, which keeps the output identical to a serial run
+            results = list(executor.map(preprocess_job, *zip(*job_args)))
+
+    expansions : List[MacroExpansion] = []
+    dependencies: Set[str] = set()
+    for cu_expansions, cu_dependencies in results:
+        expansions.extend(cu_expansions)
+        dependencies.update(cu_dependencies)
+
+    serial_info = SerialInfo(elf_reader.symbols, next(sym for sym in elf_reader.symbols if sym.name == 'metal_serial_write'),expansions, elf_reader.get_markers())
+    serial_info = serial_info.slim(symbols)
+
+    if cache_key:
+        cache.store(cache_key, serial_info, dependencies)
 
-    return SerialInfo(elf_reader.symbols, next(sym for sym in elf_reader.symbols if sym.name == 'metal_serial_write'),expansions, elf_reader.get_markers())
+    return serial_info
 
 
 def main():
@@ -56,10 +148,39 @@ def main():
     parser.add_argument('-I', '--include', nargs='+', help="Include folders for the preprocessor", default=[])
     parser.add_argument('-D', '--define',  nargs='+', help="Defines for the preprocessor", default=[])
     parser.add_argument('-O', '--output',             help='The file to write the generated data to')
+    parser.add_argument('--cache-dir',  help='Directory to cache generated data in, defaults to $METAL_SERIAL_CACHE_DIR',
+                        default=os.environ.get('METAL_SERIAL_CACHE_DIR'))
+    parser.add_argument('--cache-size', help='Maximum size of the cache directory in MiB', type=int, default=256)
+    parser.add_argument('--demangle',   help='Include the demangled symbol names in the output', action='store_true')
+    parser.add_argument('-j', '--jobs',       help='Number of processes used to preprocess compile units, 0 uses all cores', type=int, default=1)
+    parser.add_argument('-F', '--format',     help='The output format, binary files can be memory mapped by the interpreter',
+                        choices=['json', 'binary'], default='json')
+    parser.add_argument('--symbols',    help='Which symbols of the binary to keep, decoding only needs the markers',
+                        choices=['none', 'all'], default='none')
+    parser.add_argument('--symbol-range', nargs=2, metavar=('START', 'END'), type=lambda x: int(x, 0),
+                        help='Only keep the symbols in the address range [START, END)')
+    parser.add_argument('--no-tokens',  help='Leave the tokenized macro arguments out of binary output', action='store_true')
 
     args = parser.parse_args()
 
-    res = json.dumps(generate(args.binary, args.define, args.include).to_dict())
+    cache = None
+    if args.cache_dir:
+        from metal.serial.cache import SerialInfoCache
+        cache = SerialInfoCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+    serial_info = generate(args.binary, args.define, args.include, cache=cache, jobs=args.jobs,
+                           symbols=tuple(args.symbol_range) if args.symbol_range else args.symbols)
+
+    if args.format == 'binary':
+        from metal.serial.binary_format import write_binary
+        if args.output:
+            with open(args.output, "wb") as f:
+                write_binary(serial_info, f, tokens=not args.no_tokens)
+        else:
+            write_binary(serial_info, sys.stdout.buffer, tokens=not args.no_tokens)
+        return
+
+    res = json.dumps(serial_info.to_dict(args.demangle))
 
     if args.output:
         with open(args.output, "w") as f:
@@ -2,10 +2,16 @@ import typing
 
 class MacroHook:
     identifier: str
+    # hooks that hold back output set this, the engine then calls flush_output before dispatching any other hook,
+    # so whatever that hook prints comes after it
+    buffers_output = False
 
     def invoke(self, engine: 'Engine', macro_expansion: 'MacroExpansion'):
         raise NotImplementedError
 
+    def flush_output(self):
+        pass
+
     def exit(self, exit_code: int):
         pass
 
@@ -36,3 +42,13 @@ class Exit(MacroHook):
         return self.exit_code is None
 
 
+# Hooks for the AsyncEngine, invoke is a coroutine that uses the engine's async reads.
+# Plain MacroHooks still work with the AsyncEngine, they get run in a worker thread.
+class AsyncMacroHook(MacroHook):
+    async def invoke(self, engine: 'AsyncEngine', macro_expansion: 'MacroExpansion'):
+        raise NotImplementedError
+
+
+class AsyncExit(Exit, AsyncMacroHook):
+    async def invoke(self, engine: 'AsyncEngine', macro_expansion: 'MacroExpansion'):
+        self.exit_code = await engine.read_int()
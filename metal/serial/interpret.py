@@ -1,9 +1,17 @@
 import argparse
+import io
 import json
+import os
 import sys
 
-from metal.serial import Engine
+from metal.serial import Engine, newlib
+from metal.serial.default_hooks import default_hooks
+from metal.serial.unit import Unit
+from metal.serial.binary_format import load_serial_info
 from metal.serial.generate import SerialInfo
+from metal.serial.replay import CaptureReader, CaptureWriter, DiscardOutput, Replay, ReplayReporter, VerifyingOutput
+from metal.unit import JsonLinesSink, Reporter, Retention
+from metal.vfs import VirtualFileSystem
 
 def main():
     parser = argparse.ArgumentParser()
@@ -11,13 +19,100 @@ def main():
     parser.add_argument('-S', '--serial-info',  required=True, help='The serial information perviously generated')
     parser.add_argument('-I', '--input',  help="The file for input data, defaults to stdin")
     parser.add_argument('-O', '--output', help="The output ,defaults to null.")
+    parser.add_argument('-R', '--replies', help="Recorded host replies to check the replies against when replaying a capture")
+    parser.add_argument('-C', '--capture', help="Replay a capture written with --record, checking the replies against it")
+    parser.add_argument('--start-message', type=int, help="Replay the capture starting at this message number")
+    parser.add_argument('--start-time', type=float, help="Replay the capture starting at this many seconds into the session")
+    parser.add_argument('--record', help="Record both directions of the session into this capture file")
+    parser.add_argument('--host-files', action='store_true', help="Run the target's file operations on the host's file system even if the session isn't live")
+    parser.add_argument('--vfs-load', help="Run the target's file operations in memory, starting with the files of this directory or tarball")
+    parser.add_argument('--vfs-diff', help="Write the paths the session added, removed or modified in memory to this JSON file, - for stdout")
+    parser.add_argument('--vfs-export', help="Write the files the session added or modified in memory into this directory")
+    parser.add_argument('--write-through', action='store_true', help="Don't buffer the target's unchecked writes, by default only terminals are written through")
+    parser.add_argument('--background-writes', action='store_true', help="Execute the target's unchecked file operations on a background thread")
+    parser.add_argument('--jsonl', help="Stream the test results into this file as JSON lines while the session runs")
+    parser.add_argument('--summary-only', action='store_true', help="Only keep the counters of the test scopes, not every single check")
+    parser.add_argument('--retention', choices=[Retention.all, Retention.failures, Retention.sample], default=Retention.all,
+                        help="Keep all checks, only the failures or the failures and a sample of the passing checks per location")
+    parser.add_argument('--sample-size', type=int, help="Passing checks kept per location with --retention sample")
 
     args = parser.parse_args()
+    in_memory = args.vfs_load or args.vfs_diff or args.vfs_export
+    if in_memory and args.host_files:
+        parser.error('--host-files can\'t be combined with the --vfs options')
 
-    serial_info = SerialInfo.from_dict(json.load(open(args.serial_info)))
+    serial_info = load_serial_info(args.serial_info)
 
-    engine = Engine(input=open(args.input, 'rb') if args.input else sys.stdin,
-                    output=open(args.output, 'wb') if args.output else None, serial_info=serial_info)
+    # Results should show up while the input is still being decoded, even if stdout is a pipe.
+    sys.stdout.reconfigure(line_buffering=True)
+
+    start = None
+    if args.capture:
+        reader = CaptureReader(args.capture)
+        if args.start_message is not None:
+            start = reader.find_message(args.start_message)
+        elif args.start_time is not None:
+            start = reader.find_time(int(args.start_time * 1e9))
+        if start is None and (args.start_message is not None or args.start_time is not None):
+            raise Exception('The capture {} has no message to start at'.format(args.capture))
+        replay = Replay(reader, start)
+        input, output = replay.input, replay.output
+    else:
+        input = open(args.input, 'rb') if args.input else sys.stdin.buffer
+        if args.output:
+            output = open(args.output, 'wb')
+        elif args.replies:
+            output = VerifyingOutput(open(args.replies, 'rb'))
+        else:
+            output = DiscardOutput()
+
+    # starting past the first message, test cases can exit that were entered before
+    reporter = ReplayReporter() if start is not None and start.number > 0 else Reporter()
+    reporter.summary_only = args.summary_only
+    if args.jsonl:
+        reporter.jsonl_sink = JsonLinesSink(open(args.jsonl, 'w'))
+    hooks = [hook for hook in default_hooks if hook is not Unit] + [lambda: Unit(reporter, args.retention, args.sample_size)]
+
+    # Only a live session, with a target answering through -O, runs its file operations on this host.
+    # Decoding a log or replaying a capture mustn't create, overwrite or delete files here again, nor read from stdin,
+    # which might be the input itself. So their file operations go to memory and only the writes to stdout & stderr get through.
+    # The --vfs options run any session in memory.
+    live = args.output and not args.capture and not (args.input and os.path.isfile(args.input))
+    os_ = os
+    if in_memory or (not live and not args.host_files):
+        os_ = VirtualFileSystem(stdin=None if live and args.input else io.BytesIO())
+        if args.vfs_load:
+            if os.path.isdir(args.vfs_load):
+                os_.load_directory(args.vfs_load)
+            else:
+                os_.load_tar(args.vfs_load)
+    if os_ is not os or args.write_through or args.background_writes:
+        hooks = [newlib.build_newlib_hook(os_, write_through=True if args.write_through else None, background_writes=args.background_writes)
+                 if hook is newlib.Syscall else hook for hook in hooks]
+
+    recorder = CaptureWriter(open(args.record, 'wb')) if args.record else None
+    try:
+        engine = Engine(input=input, output=output, serial_info=serial_info, macro_hooks=hooks, recorder=recorder)
+        exit_code = engine.run()
+    finally:
+        if recorder:
+            recorder.close()
+        if reporter.jsonl_sink:
+            reporter.jsonl_sink.close()
+        # what the session did to its files, even if it ended in an exception
+        if args.vfs_diff == '-':
+            print(json.dumps(os_.changes()))
+        elif args.vfs_diff:
+            with open(args.vfs_diff, 'w') as f:
+                json.dump(os_.changes(), f)
+        if args.vfs_export:
+            os_.export(args.vfs_export)
+
+    if engine.gaps:
+        print('***metal.serial***: {} gap(s) in the framed input, {} frame(s) lost'.format(
+            len(engine.gaps), sum(gap.lost_frames for gap in engine.gaps)), file=sys.stderr)
+
+    sys.exit(exit_code)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,16 +1,238 @@
+import atexit
 import errno
 import os
+import queue
 import sys
+import threading
+import time
 import typing
+import weakref
 
-from metal.newlib import Flags, map_errno, map_open_flags, map_file_mode
+from metal.newlib import Flags, MappedReads, error_number, map_errno, map_open_flags, map_file_mode
 from metal.serial import Engine
 from metal.serial.hooks import MacroHook
 from metal.serial.preprocessor import MacroExpansion
 
 
-def build_newlib_hook(os_: os):
-    
+# Runs the syscalls the target doesn't wait for (unchecked & blocked mode) on a worker thread, in the order they were submitted,
+# so a slow file system doesn't hold up decoding the target's output.
+# At most max_pending operations are queued, after that submitting waits for the worker.
+# Failures are printed and collected in errors, since there's no reply to report them with.
+class BackgroundWriter:
+    def __init__(self, max_pending: int = 256):
+        self.queue = queue.Queue(max_pending)
+        self.errors: typing.List[typing.Tuple[int, Exception]] = []
+        # operations submitted but not done yet, per fd
+        self.pending: typing.Dict[int, int] = {}
+        self.condition = threading.Condition()
+        self.thread: typing.Optional[threading.Thread] = None
+
+    def __work(self):
+        while True:
+            fd, error_message, function, args = self.queue.get()
+            try:
+                function(*args)
+            except Exception as e:
+                self.errors.append((fd, e))
+                print("{} : {}".format(error_message, e), file=sys.stderr)
+            finally:
+                with self.condition:
+                    self.pending[fd] -= 1
+                    if not self.pending[fd]:
+                        del self.pending[fd]
+                    self.condition.notify_all()
+
+    def submit(self, fd: int, error_message: str, function: typing.Callable[..., None], *args):
+        with self.condition:
+            self.pending[fd] = self.pending.get(fd, 0) + 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__work, name='metal-serial-writer', daemon=True)
+                self.thread.start()
+        self.queue.put((fd, error_message, function, args))
+
+    # waits until everything submitted for fd is done, e.g. before a call the target waits for
+    def drain(self, fd: int):
+        with self.condition:
+            self.condition.wait_for(lambda: fd not in self.pending)
+
+    def drain_all(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.pending)
+
+
+# Collects the writes the target doesn't wait for (unchecked & blocked mode) per fd,
+# so a target flushing byte- or line-wise doesn't cost a host syscall for every write.
+# fds found in host_fds are the target's own ones (unchecked mode), they're translated when the write is executed.
+# A buffer is written once it holds `size` bytes or the oldest buffered write is `interval` seconds old (checked by a timer,
+# so a target that stops making syscalls doesn't hold its output back), before anything else touches its fd and on exit,
+# so the output stays byte-identical.
+# Terminals are written through, unless write_through is set explicitly (True for every fd, False for none).
+# With a BackgroundWriter the buffers and other operations without reply (see run) are handed to its worker,
+# flush & flush_all then also wait for the worker, as they precede calls that depend on the result.
+class WriteCoalescer:
+    def __init__(self, os_: os, size: int = 64 * 1024, interval: float = 0.1, write_through: typing.Optional[bool] = None,
+                 writer: typing.Optional[BackgroundWriter] = None, host_fds: typing.Optional[typing.Dict[int, int]] = None):
+        self.os_ = os_
+        self.host_fds = host_fds if host_fds is not None else {}
+        self.size = size
+        self.interval = interval
+        self.write_through = write_through
+        self.writer = writer
+        self.buffers: typing.Dict[int, bytearray] = {}
+        self.oldest: typing.Optional[float] = None
+        self.timer: typing.Optional[threading.Timer] = None
+        self.ttys: typing.Dict[int, bool] = {}
+        # sync hooks of several AsyncEngine sessions can run in parallel, the timer runs on its own thread
+        self.lock = threading.Lock()
+        live_coalescers.add(self)
+
+    def __is_write_through(self, fd: int) -> bool:
+        if self.write_through is not None:
+            return self.write_through
+
+        tty = self.ttys.get(fd)
+        if tty is None:
+            try:
+                tty = self.ttys[fd] = bool(self.os_.isatty(self.host_fds.get(fd, fd)))
+            except (AttributeError, OSError):
+                tty = self.ttys[fd] = False
+        return tty
+
+    def __write(self, fd: int, data: bytes):
+        fd = self.host_fds.get(fd, fd)
+        while data:
+            written = self.os_.write(fd, data)
+            if not isinstance(written, int) or written >= len(data):
+                break
+            data = data[written:]
+
+    def __flush(self, fd: int):
+        buffer = self.buffers.pop(fd, None)
+        if not buffer:
+            return
+
+        if self.writer is not None:
+            self.writer.submit(fd, "Error writing to fd {}".format(fd), self.__write, fd, bytes(buffer))
+            return
+
+        try:
+            self.__write(fd, bytes(buffer))
+        except OSError as e:
+            print("Error writing to fd {} : {}".format(fd, e), file=sys.stderr)
+
+    def __flush_all(self):
+        for fd in list(self.buffers):
+            self.__flush(fd)
+        self.oldest = None
+
+    def __arm(self, delay: float):
+        self.timer = threading.Timer(delay, self.__expire)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def __expire(self):
+        with self.lock:
+            self.timer = None
+            if self.oldest is None:
+                return
+            remaining = self.oldest + self.interval - time.monotonic()
+            if remaining > 0:
+                self.__arm(remaining)
+            else:
+                self.__flush_all()
+
+    def write(self, fd: int, data: bytes):
+        with self.lock:
+            if self.__is_write_through(fd):
+                self.__flush(fd)
+                if self.writer is not None:
+                    self.writer.drain(fd)
+                self.os_.write(self.host_fds.get(fd, fd), data)
+                return
+
+            buffer = self.buffers.get(fd)
+            if buffer is None:
+                buffer = self.buffers[fd] = bytearray()
+            buffer += data
+
+            now = time.monotonic()
+            if self.oldest is None:
+                self.oldest = now
+                if self.timer is None:
+                    self.__arm(self.interval)
+            if len(buffer) >= self.size:
+                self.__flush(fd)
+            if now - self.oldest >= self.interval:
+                self.__flush_all()
+
+    # runs an operation the target doesn't wait for after all writes so far, OSErrors get printed with error_message
+    def run(self, fd: int, error_message: str, function: typing.Callable[..., None], *args):
+        with self.lock:
+            self.__flush_all()
+            if self.writer is not None:
+                self.writer.submit(fd, error_message, function, *args)
+                return
+
+        try:
+            function(*args)
+        except OSError as e:
+            print("{} : {}".format(error_message, e), file=sys.stderr)
+
+    def flush(self, fd: int):
+        with self.lock:
+            self.__flush(fd)
+        if self.writer is not None:
+            self.writer.drain(fd)
+
+    # the fd is going away, its number might be reused for something else
+    def forget(self, fd: int):
+        self.ttys.pop(fd, None)
+
+    def close(self, fd: int):
+        self.flush(fd)
+        self.forget(fd)
+
+    # the target's stdout & stderr, before the host prints something itself
+    def flush_stdio(self):
+        with self.lock:
+            self.__flush(Flags.STDOUT_FILENO)
+            self.__flush(Flags.STDERR_FILENO)
+        if self.writer is not None:
+            self.writer.drain(Flags.STDOUT_FILENO)
+            self.writer.drain(Flags.STDERR_FILENO)
+
+    def flush_all(self):
+        with self.lock:
+            self.__flush_all()
+        if self.writer is not None:
+            self.writer.drain_all()
+
+    def flush_expired(self):
+        with self.lock:
+            if self.oldest is not None and time.monotonic() - self.oldest >= self.interval:
+                self.__flush_all()
+
+
+# coalescers that might still hold writes when the process exits, e.g. after a session ended in an exception
+live_coalescers: 'weakref.WeakSet[WriteCoalescer]' = weakref.WeakSet()
+
+
+@atexit.register
+def flush_live_coalescers():
+    for writes in list(live_coalescers):
+        writes.flush_all()
+
+
+def build_newlib_hook(os_: os, write_buffer_size: int = 64 * 1024, write_flush_interval: float = 0.1,
+                      write_through: typing.Optional[bool] = None, background_writes: bool = False, max_pending_writes: int = 256,
+                      map_reads: typing.Optional[bool] = None):
+
+    writer = BackgroundWriter(max_pending_writes) if background_writes else None
+    # target fd -> host fd of the files opened in unchecked mode
+    unchecked_map: typing.Dict[int, int] = {}
+    writes = WriteCoalescer(os_, write_buffer_size, write_flush_interval, write_through, writer, unchecked_map)
+    reads = MappedReads(os_, map_reads)
+
     def write_stat(engine: Engine, st: os_.stat_result):
         engine.write_int(st.st_dev)
         engine.write_int(st.st_ino)
@@ -46,11 +268,12 @@ def build_newlib_hook(os_: os):
     def fstat(engine: Engine):
         try:
             fd = engine.read_int()
+            writes.flush(fd)
             st = os_.fstat(fd)
             engine.write_int(0)
             write_stat(engine, st)
         except OSError as e:
-            engine.write_int(map_errno(int(str(e)), errno, Flags))
+            engine.write_int(map_errno(error_number(e), errno, Flags))
     
     def stat_(engine: Engine):
         try:
@@ -59,7 +282,7 @@ def build_newlib_hook(os_: os):
             engine.write_int(0)
             write_stat(engine, st)
         except OSError as e:
-            engine.write_int(map_errno(int(str(e)), errno, Flags))
+            engine.write_int(map_errno(error_number(e), errno, Flags))
 
     def isatty(engine: Engine):
         try:
@@ -68,65 +291,72 @@ def build_newlib_hook(os_: os):
             engine.write_int(0)
             engine.write_int(isatty_)
         except OSError as e:
-            engine.write_int(map_errno(int(str(e)), errno, Flags))
+            engine.write_int(map_errno(error_number(e), errno, Flags))
     
     def link(engine: Engine):
         try:
             existing = engine.read_string()
             _new = engine.read_string()
+            writes.flush_all()
             os_.link(existing, _new)
             engine.write_int(0)
         except OSError as e:
-            engine.write_int(map_errno(int(str(e)), errno, Flags))
+            engine.write_int(map_errno(error_number(e), errno, Flags))
     
     def symlink(engine: Engine):
         try:
             existing = engine.read_string()
             _new = engine.read_string()
+            writes.flush_all()
             os_.symlink(existing, _new)
             engine.write_int(0)
         except OSError as e:
-            engine.write_int(map_errno(int(str(e)), errno, Flags))
+            engine.write_int(map_errno(error_number(e), errno, Flags))
     
     def unlink(engine: Engine):
         try:
             name = engine.read_string()
+            writes.flush_all()
             os_.unlink(name)
             engine.write_int(0)
         except OSError as e:
-            engine.write_int(map_errno(int(str(e)), errno, Flags))
+            engine.write_int(map_errno(error_number(e), errno, Flags))
 
     def lseek(engine: Engine):
         try:
             file = engine.read_int()
             ptr = engine.read_int()
             dir_ = engine.read_int()
-            engine.write_int(os_.lseek(file, ptr, dir_))
+            writes.flush(file)
+            pos = reads.lseek(file, ptr, dir_)
+            engine.write_int(pos if pos is not None else os_.lseek(file, ptr, dir_))
         except OSError as e:
             engine.write_int(-1)
-            engine.write_int(map_errno(int(str(e)), errno, Flags))
+            engine.write_int(map_errno(error_number(e), errno, Flags))
     
     def open_full(engine: Engine):
         try:
             file = engine.read_string()
             flags = map_open_flags(engine.read_int(), Flags, os_)
             mode = map_file_mode(engine.read_int(),   Flags, os_)
-            engine.write_int(os_.open(file, flags, mode))
+            writes.flush_all()
+            fd = os_.open(file, flags, mode)
+            reads.open(fd, flags)
+            engine.write_int(fd)
         except OSError as e:
             engine.write_int(-1)
-            engine.write_int(map_errno(int(str(e)), errno, Flags))
-    
-    unchecked_map: typing.Dict[int, int] = {}
+            engine.write_int(map_errno(error_number(e), errno, Flags))
     
     def open_unchecked(engine: Engine):
         file = engine.read_string()
-        try:
-            flags = map_open_flags(engine.read_int(), Flags, os_)
-            mode = map_file_mode(engine.read_int(),   Flags, os_)
-            target_fd = engine.read_int()
+        flags = map_open_flags(engine.read_int(), Flags, os_)
+        mode = map_file_mode(engine.read_int(),   Flags, os_)
+        target_fd = engine.read_int()
+
+        def open_host():
             unchecked_map[target_fd] = os_.open(file, flags, mode)
-        except OSError as e:
-            print("Error opening file {} : {}".format(file, e), file=sys.stderr)
+
+        writes.run(target_fd, "Error opening file {}".format(file), open_host)
 
     def open_(engine: Engine, tp: str):
         if tp == 'full':
@@ -137,20 +367,25 @@ def build_newlib_hook(os_: os):
     def close_full(engine: Engine):
         try:
             fd = engine.read_int()
+            writes.close(fd)
+            reads.close(fd)
             os_.close(fd)
             engine.write_int(0)
         except OSError as e:
-            engine.write_int(-1)
-            engine.write_int(map_errno(int(str(e)), errno, Flags))
+            # the target only reads the error number
+            engine.write_int(map_errno(error_number(e), errno, Flags))
     
     def close_unchecked(engine: Engine):
         target_fd = engine.read_int()
-        try:
-            os_.close(unchecked_map[target_fd])
-        except OSError as e:
-            print("Error closing file {} : {}".format(target_fd, e), file=sys.stderr)
-        except KeyError:
-            pass
+
+        # the writes to the file were queued before, so they're done once this runs
+        def close_host():
+            host_fd = unchecked_map.pop(target_fd, None)
+            if host_fd is not None:
+                writes.forget(target_fd)
+                os_.close(host_fd)
+
+        writes.run(target_fd, "Error closing file {}".format(target_fd), close_host)
     
     def close_(engine: Engine, tp: str):
         if tp == 'full':
@@ -162,15 +397,17 @@ def build_newlib_hook(os_: os):
         try:
             fd = engine.read_int()
             dt = engine.read_memory()
+            writes.flush(fd)
+            reads.release(fd)
             engine.write_int(os_.write(fd, dt))
         except OSError as e:
             engine.write_int(-1)
-            engine.write_int(map_errno(int(str(e)), errno, Flags))
+            engine.write_int(map_errno(error_number(e), errno, Flags))
     
     def write_unchecked(engine: Engine):
         fd = engine.read_int()
         dt = engine.read_memory()
-        os_.write(fd, dt)
+        writes.write(fd, dt)
     
     def write(engine: Engine, tp: str):
         if tp == 'full':
@@ -184,28 +421,36 @@ def build_newlib_hook(os_: os):
         try:
             fd = engine.read_int()
             len_ = engine.read_int()
-            buf = os_.read(fd, len_)
+            writes.flush(fd)
+            buf = reads.read(fd, len_)
+            if buf is None:
+                buf = os_.read(fd, len_)
             engine.write_int(0)
             engine.write_memory(buf)
         except OSError as e:
-            engine.write_int(map_errno(int(str(e)), errno, Flags))
+            engine.write_int(map_errno(error_number(e), errno, Flags))
     
     def read_buffered(engine: Engine):
         try:
             fd = engine.read_int()
             len_ = engine.read_int()
-    
-            cur = os_.lseek(fd, 0, os_.SEEK_CUR)
-            end = os_.lseek(fd, 0, os_.SEEK_END)
-    
-            available = end - cur
-            read_len = min(available, len_)
-    
-            buf = os_.read(fd, read_len)
+            writes.flush(fd)
+
+            # a mapped file knows how much is available without asking the os
+            buf = reads.read(fd, len_)
+            if buf is None:
+                cur = os_.lseek(fd, 0, os_.SEEK_CUR)
+                end = os_.lseek(fd, 0, os_.SEEK_END)
+                os_.lseek(fd, cur, os_.SEEK_SET)
+
+                available = end - cur
+                read_len = min(available, len_)
+
+                buf = os_.read(fd, read_len)
             engine.write_int(0)
             engine.write_memory(buf)
         except OSError as e:
-            engine.write_int(map_errno(int(str(e)), errno, Flags))
+            engine.write_int(map_errno(error_number(e), errno, Flags))
     
     def read(engine: Engine, tp: str):
         if tp == 'full':
@@ -230,26 +475,44 @@ def build_newlib_hook(os_: os):
     class Syscall(MacroHook):
         identifier = 'METAL_SERIAL_SYSCALL'
         exit_code: typing.Optional[int]
+        buffers_output = True
     
         def invoke(self, engine: Engine,  macro_expansion: MacroExpansion):
 
+            writes.flush_expired()
+
             vargs = macro_expansion.args[0].split(',')
             func = vargs[0]
             spec = vargs[1] if len(vargs) > 1 else None
             try:
-                if spec is None:
-                    func_map[func](engine)
-                else:
-                    func_map[func](engine, spec.strip())
+                # collect multi-field replies (e.g. stat) into a single write
+                with engine.corked():
+                    if spec is None:
+                        func_map[func](engine)
+                    else:
+                        func_map[func](engine, spec.strip())
             except KeyError:
                 raise Exception("Function {} not found for syscalls".format(func))
             except OSError as e:
                 print('OSerror', e)
     
+        def flush_output(self):
+            writes.flush_stdio()
+
+        def exit(self, exit_code: int):
+            writes.flush_all()
+            reads.release_all()
+
         def __init__(self):
             super().__init__()
     
     return Syscall
 
 
-Syscall = build_newlib_hook(os)
+# The hook on the host's os listed in the default hooks. Each session builds its own,
+# so pending writes, mapped reads & the fds of unchecked mode don't leak between sessions.
+def Syscall() -> MacroHook:
+    return build_newlib_hook(os)()
+
+
+Syscall.identifier = 'METAL_SERIAL_SYSCALL'
@@ -2,7 +2,7 @@ import json
 import os
 import pcpp
 
-from typing import List, Dict, Set, Tuple
+from typing import List, Dict, Optional, Set, Tuple
 
 from .elfreader import Marker
 from .location import Location
@@ -68,7 +68,7 @@ class MacroExpansion:
         return cls(
             data['name'],
             data['args'],
-            [[LexToken.from_dict(tk) for tk in l] for l in data['args_token']],
+            [[LexToken.from_dict(tk) for tk in l] for l in data['args_tokenized']],
             data['file'],
             data['line'])
 
@@ -98,7 +98,7 @@ class Preprocessor(pcpp.Preprocessor):
 
 def preprocess_compile_unit(absolute_path: str,
                             markers: List[Marker], defines: List[str] = [], paths: List[str] = [],
-                            macros: List[str] = None):
+                            macros: List[str] = None, dependencies: Optional[Set[str]] = None):
 
     if macros is None:
         from metal.serial import default_hooks
@@ -117,6 +117,11 @@ def preprocess_compile_unit(absolute_path: str,
     proc.parse(open(absolute_path).read(), absolute_path)
     proc.write(open(os.devnull, 'w'))
 
+    # the source holds the macro expansions, the headers might define the macros used in them
+    if dependencies is not None:
+        dependencies.add(os.path.abspath(absolute_path))
+        dependencies.update(inc.included_abspath for inc in proc.include_times if inc.included_abspath)
+
     for marker in (marker for marker in markers if marker.file == absolute_path):
         exps = [expanded_macro for expanded_macro in proc.expanded_macros if expanded_macro.file == marker.file and expanded_macro.line == marker.line]
 
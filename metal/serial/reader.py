@@ -0,0 +1,130 @@
+import typing
+
+
+# Reads the target's byte stream in large chunks and decodes messages from the buffer.
+# A read only blocks for the bytes the current message still needs, so partially sent messages work.
+class BufferedInput:
+    chunk_size: int
+
+    def __init__(self, input: typing.IO, chunk_size: int = 64 * 1024,
+                 before_block: typing.Optional[typing.Callable[[], None]] = None):
+        self.input = input
+        self.chunk_size = chunk_size
+        self.before_block = before_block
+        self.buffer = bytearray()
+        self.position = 0
+        self.received = 0
+
+        # read1 returns whatever is available (blocking only for the first byte),
+        # other transports are read with the exact amount still missing.
+        self.__read1 = getattr(input, 'read1', None)
+
+    @property
+    def available(self) -> int:
+        return len(self.buffer) - self.position
+
+    # number of bytes of the stream consumed so far
+    @property
+    def offset(self) -> int:
+        return self.received - self.available
+
+    def __read_chunk(self, needed: int) -> bytes:
+        if self.before_block is not None:
+            self.before_block()
+
+        if self.__read1 is not None:
+            return self.__read1(max(needed, self.chunk_size))
+
+        waiting = getattr(self.input, 'in_waiting', 0) or 0
+        return self.input.read(max(needed, waiting))
+
+    def __compact(self):
+        if self.position > self.chunk_size or self.position == len(self.buffer):
+            del self.buffer[:self.position]
+            self.position = 0
+
+    def fill(self, size: int):
+        if self.available >= size:
+            return
+
+        self.__compact()
+        while self.available < size:
+            chunk = self.__read_chunk(size - self.available)
+            if not chunk:
+                raise EOFError('Input ended while {} more bytes were expected'.format(size - self.available))
+            self.buffer += chunk
+            self.received += len(chunk)
+
+    # adds data received elsewhere, e.g. from an asyncio stream
+    def feed(self, data: bytes):
+        self.__compact()
+        self.buffer += data
+        self.received += len(data)
+
+    # position of delimiter relative to the current position, or -1 if it isn't buffered yet
+    def find(self, delimiter: bytes) -> int:
+        end = self.buffer.find(delimiter, self.position)
+        return end - self.position if end >= 0 else -1
+
+    # length of the varint at the current position, or 0 if it isn't buffered completely
+    def varint_length(self) -> int:
+        for i in range(self.position, len(self.buffer)):
+            if not self.buffer[i] & 0x80:
+                return i - self.position + 1
+        return 0
+
+    def __take(self, size: int) -> bytes:
+        start = self.position
+        self.position += size
+        with memoryview(self.buffer) as view:
+            return view[start:self.position].tobytes()
+
+    def read(self, size: int) -> bytes:
+        self.fill(size)
+        return self.__take(size)
+
+    def read_until(self, delimiter: bytes = b'\x00') -> bytes:
+        scanned = 0
+        while True:
+            end = self.buffer.find(delimiter, self.position + scanned)
+            if end >= 0:
+                value = self.__take(end - self.position)
+                self.position += len(delimiter)
+                return value
+
+            # fill may compact the buffer, so remember the scanned range relative to the position
+            scanned = max(self.available - len(delimiter) + 1, 0)
+            self.fill(self.available + 1)
+
+    def read_prefixed(self) -> bytes:
+        self.fill(1)
+        size = self.buffer[self.position]
+        self.fill(1 + size)
+        self.position += 1
+        return self.__take(size)
+
+    # unsigned LEB128, the high bit of each byte marks that another one follows
+    def read_varint(self) -> int:
+        value = 0
+        shift = 0
+        while True:
+            self.fill(1)
+            byte = self.buffer[self.position]
+            self.position += 1
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+
+    def peek(self, size: int) -> bytes:
+        self.fill(size)
+        with memoryview(self.buffer) as view:
+            return view[self.position:self.position + size].tobytes()
+
+    def skip(self, size: int):
+        self.fill(size)
+        self.position += size
+
+    # drops whatever is buffered, e.g. the rest of a message that can't be decoded any more
+    def discard(self):
+        self.position = len(self.buffer)
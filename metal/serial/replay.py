@@ -0,0 +1,350 @@
+import bisect
+import collections
+import struct
+import time
+import typing
+
+from metal.unit import Reporter, loc_str
+
+
+# Output used when replaying a capture: the target isn't there any more, so replies are dropped.
+class DiscardOutput:
+    def write(self, data: bytes) -> int:
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class ReplyMismatch(Exception):
+    pass
+
+
+# Output used when replaying a capture together with the recorded host replies:
+# every reply the hooks produce gets compared against the recording instead of being sent.
+class VerifyingOutput:
+    def __init__(self, recorded: typing.IO):
+        self.recorded = recorded
+        self.offset = 0
+
+    def write(self, data: bytes) -> int:
+        expected = self.recorded.read(len(data))
+        if expected != data:
+            raise ReplyMismatch('Reply at offset {} differs from the recording, expected {!r} but got {!r}'.format(self.offset, expected, bytes(data)))
+        self.offset += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+# Capture files hold both directions of a session as a sequence of records:
+#
+#   header          b'MTLCAP' + u16 version
+#   record          direction u8, timestamp u64 (ns since the start), stream offset u64, length u32, data
+#   index           (message, timestamp, record offset) u64 each, every index_interval messages
+#   footer          index offset u64, index entries u64, b'MTLCIDX1'
+#
+# The stream offset is the position of the record's first byte in the stream of its direction, MESSAGE records store
+# the message number there instead.
+# MESSAGE records are written by the engine each time it starts decoding a message. Their data holds the target & host
+# stream offsets at that point and the file offset of the first record needed to replay from there.
+# A capture without footer, e.g. from a crashed session, is still readable, the index then gets rebuilt by scanning it.
+
+TARGET = 0
+HOST = 1
+MESSAGE = 2
+
+capture_magic = b'MTLCAP'
+capture_version = 1
+capture_header_struct = struct.Struct('<6sH')
+record_struct = struct.Struct('<BQQI')
+message_struct = struct.Struct('<QQQ')
+index_struct = struct.Struct('<QQQ')
+footer_struct = struct.Struct('<QQ8s')
+footer_magic = b'MTLCIDX1'
+default_index_interval = 1024
+
+
+class CaptureRecord(typing.NamedTuple):
+    direction: int
+    timestamp: int
+    stream_offset: int
+    data: bytes
+    offset: int
+
+
+class MessageInfo(typing.NamedTuple):
+    number: int
+    timestamp: int
+    target_offset: int
+    host_offset: int
+    resume_offset: int
+
+
+class CaptureWriter:
+    def __init__(self, file: typing.BinaryIO, index_interval: int = default_index_interval):
+        self.file = file
+        self.index_interval = index_interval
+        self.index: typing.List[typing.Tuple[int, int, int]] = []
+        self.messages = 0
+        self.stream_offsets = [0, 0]
+        self.start = time.monotonic_ns()
+
+        # target records that may still hold bytes the engine hasn't decoded yet: (start, end, file offset)
+        self.__pending_target: typing.Deque[typing.Tuple[int, int, int]] = collections.deque()
+
+        self.file.write(capture_header_struct.pack(capture_magic, capture_version))
+        self.offset = capture_header_struct.size
+
+    def __write(self, direction: int, stream_offset: int, data: bytes, timestamp: typing.Optional[int] = None) -> int:
+        offset = self.offset
+        if timestamp is None:
+            timestamp = time.monotonic_ns() - self.start
+        self.file.write(record_struct.pack(direction, timestamp, stream_offset, len(data)))
+        self.file.write(data)
+        self.offset += record_struct.size + len(data)
+        return offset
+
+    def record(self, direction: int, data: bytes):
+        if not data:
+            return
+        start = self.stream_offsets[direction]
+        offset = self.__write(direction, start, data)
+        self.stream_offsets[direction] += len(data)
+        if direction == TARGET:
+            self.__pending_target.append((start, start + len(data), offset))
+
+    def message(self, target_offset: int):
+        while self.__pending_target and self.__pending_target[0][1] <= target_offset:
+            self.__pending_target.popleft()
+        resume_offset = self.__pending_target[0][2] if self.__pending_target else self.offset
+
+        timestamp = time.monotonic_ns() - self.start
+        offset = self.__write(MESSAGE, self.messages, message_struct.pack(target_offset, self.stream_offsets[HOST], resume_offset), timestamp)
+        if self.messages % self.index_interval == 0:
+            self.index.append((self.messages, timestamp, offset))
+        self.messages += 1
+
+    def close(self):
+        index_offset = self.offset
+        for entry in self.index:
+            self.file.write(index_struct.pack(*entry))
+        self.file.write(footer_struct.pack(index_offset, len(self.index), footer_magic))
+        self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RecordingInput:
+    def __init__(self, input: typing.IO, recorder: CaptureWriter):
+        self.input = input
+        self.recorder = recorder
+        if hasattr(input, 'read1'):
+            self.read1 = self.__read1
+
+    def __read1(self, size: int = -1) -> bytes:
+        data = self.input.read1(size)
+        self.recorder.record(TARGET, data)
+        return data
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.input.read(size)
+        self.recorder.record(TARGET, data)
+        return data
+
+    @property
+    def in_waiting(self) -> int:
+        return getattr(self.input, 'in_waiting', 0)
+
+
+class RecordingOutput:
+    def __init__(self, output: typing.IO, recorder: CaptureWriter):
+        self.output = output
+        self.recorder = recorder
+
+    def write(self, data: bytes) -> int:
+        self.recorder.record(HOST, bytes(data))
+        return self.output.write(data)
+
+    def flush(self):
+        self.output.flush()
+
+
+class CaptureReader:
+    index: typing.List[typing.Tuple[int, int, int]]
+
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        magic, version = capture_header_struct.unpack(self.file.read(capture_header_struct.size))
+        if magic != capture_magic:
+            raise Exception('{} is not a metal.serial capture'.format(path))
+        if version != capture_version:
+            raise Exception('Unsupported capture version {} in {}'.format(version, path))
+
+        self.end = self.file.seek(0, 2)
+        self.index = self.__read_index()
+        if self.index is None:
+            self.index = []
+            for record in self.records():
+                if record.direction == MESSAGE and record.stream_offset % default_index_interval == 0:
+                    self.index.append((record.stream_offset, record.timestamp, record.offset))
+
+    def __read_index(self) -> typing.Optional[typing.List[typing.Tuple[int, int, int]]]:
+        if self.end < capture_header_struct.size + footer_struct.size:
+            return None
+        self.file.seek(self.end - footer_struct.size)
+        index_offset, count, magic = footer_struct.unpack(self.file.read(footer_struct.size))
+        if magic != footer_magic or index_offset + count * index_struct.size + footer_struct.size != self.end:
+            return None
+
+        self.end = index_offset
+        self.file.seek(index_offset)
+        return [index_struct.unpack(self.file.read(index_struct.size)) for _ in range(count)]
+
+    def records(self, offset: int = capture_header_struct.size) -> typing.Iterator[CaptureRecord]:
+        while offset + record_struct.size <= self.end:
+            self.file.seek(offset)
+            direction, timestamp, stream_offset, length = record_struct.unpack(self.file.read(record_struct.size))
+            data = self.file.read(length)
+            if len(data) < length:
+                return
+            yield CaptureRecord(direction, timestamp, stream_offset, data, offset)
+            offset += record_struct.size + length
+
+    def __message(self, record: CaptureRecord) -> MessageInfo:
+        target_offset, host_offset, resume_offset = message_struct.unpack(record.data)
+        return MessageInfo(record.stream_offset, record.timestamp, target_offset, host_offset, resume_offset)
+
+    def messages(self, offset: int = capture_header_struct.size) -> typing.Iterator[MessageInfo]:
+        return (self.__message(record) for record in self.records(offset) if record.direction == MESSAGE)
+
+    def find_message(self, number: int) -> typing.Optional[MessageInfo]:
+        pos = bisect.bisect_right([entry[0] for entry in self.index], number) - 1
+        start = self.index[pos][2] if pos >= 0 else capture_header_struct.size
+        return next((msg for msg in self.messages(start) if msg.number == number), None)
+
+    # the first message decoded at or after timestamp, in nanoseconds since the start of the session
+    def find_time(self, timestamp: int) -> typing.Optional[MessageInfo]:
+        pos = bisect.bisect_right([entry[1] for entry in self.index], timestamp) - 1
+        start = self.index[pos][2] if pos >= 0 else capture_header_struct.size
+        return next((msg for msg in self.messages(start) if msg.timestamp >= timestamp), None)
+
+
+# Feeds an Engine from a capture, the target data goes to input and the host replies written to output are checked
+# against the recording. Starting at a later message replays the connection handshake first and then continues there.
+class Replay:
+    def __init__(self, reader: CaptureReader, start: typing.Optional[MessageInfo] = None):
+        self.reader = reader
+        self.target = bytearray()
+        self.expected = bytearray()
+        self.host_offset = 0
+        self.__stream = self.__data(start)
+
+        self.input = ReplayInput(self)
+        self.output = ReplayOutput(self)
+
+    def __data(self, start: typing.Optional[MessageInfo]) -> typing.Iterator[typing.Tuple[int, bytes]]:
+        if start is None or start.number == 0:
+            for record in self.reader.records():
+                if record.direction != MESSAGE:
+                    yield record.direction, record.data
+            return
+
+        first = self.reader.find_message(0)
+        for record in self.reader.records():
+            if record.direction == TARGET and record.stream_offset < first.target_offset:
+                yield TARGET, record.data[:first.target_offset - record.stream_offset]
+            elif record.direction == MESSAGE:
+                break
+
+        self.host_offset = start.host_offset
+        skip = {TARGET: start.target_offset, HOST: start.host_offset}
+        for record in self.reader.records(start.resume_offset):
+            if record.direction == MESSAGE:
+                continue
+            end = record.stream_offset + len(record.data)
+            if end <= skip[record.direction]:
+                continue
+            yield record.direction, record.data[max(skip[record.direction] - record.stream_offset, 0):]
+
+    def advance(self) -> bool:
+        try:
+            direction, data = next(self.__stream)
+        except StopIteration:
+            return False
+        if direction == TARGET:
+            self.target += data
+        else:
+            self.expected += data
+        return True
+
+    def read(self, size: int) -> bytes:
+        while not self.target:
+            if not self.advance():
+                return b''
+        data = bytes(self.target[:size])
+        del self.target[:size]
+        return data
+
+    def check(self, data: bytes):
+        while len(self.expected) < len(data):
+            if not self.advance():
+                break
+        expected = bytes(self.expected[:len(data)])
+        if expected != data:
+            raise ReplyMismatch('Reply at offset {} differs from the recording, expected {!r} but got {!r}'.format(self.host_offset, expected, bytes(data)))
+        del self.expected[:len(data)]
+        self.host_offset += len(data)
+
+
+# The Reporter for a replay starting past the first message: test cases entered before that point exit without
+# their enter having been seen, those exits are only noted instead of closing scopes that were never opened.
+class ReplayReporter(Reporter):
+    def __init__(self):
+        super().__init__()
+        self.depth = 0
+
+    def call(self, file, line, control, condition, function, description=None):
+        if control == 'enter':
+            self.depth += 1
+        elif control == 'exit':
+            if self.depth == 0:
+                if self.hrf_sink:
+                    self.hrf_sink.write("{} exiting test case {} entered before the replay started\n".format(loc_str(file, line), function))
+                return
+            self.depth -= 1
+        super().call(file, line, control, condition, function, description)
+
+
+class ReplayInput:
+    def __init__(self, replay: Replay):
+        self.replay = replay
+
+    def read1(self, size: int = -1) -> bytes:
+        return self.replay.read(size if size > 0 else 64 * 1024)
+
+    def read(self, size: int = -1) -> bytes:
+        data = bytearray()
+        while size < 0 or len(data) < size:
+            chunk = self.replay.read(size - len(data) if size >= 0 else 64 * 1024)
+            if not chunk:
+                break
+            data += chunk
+        return bytes(data)
+
+
+class ReplayOutput:
+    def __init__(self, replay: Replay):
+        self.replay = replay
+
+    def write(self, data: bytes) -> int:
+        self.replay.check(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
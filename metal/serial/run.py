@@ -0,0 +1,207 @@
+import argparse
+import concurrent.futures
+import io
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from typing import Dict, List, Optional
+
+from metal.serial.binary_format import load_serial_info, write_binary
+from metal.serial.generate import generate
+from metal.unit import Reporter, Retention
+
+
+# Runs many hosted test binaries concurrently on a bounded process pool.
+# The SerialInfo of every distinct binary is generated once, stored in the memory mapped format
+# and shared by all sessions of that binary; each session reports its exit code and Reporter scope tree.
+
+class Target:
+    def __init__(self, spec: str):
+        self.args = shlex.split(spec)
+        self.binary = os.path.abspath(self.args[0])
+        self.spec = spec
+
+
+def generate_job(binary: str, defines: List[str], paths: List[str], cache_dir: Optional[str], cache_size: int, output: str) -> str:
+    cache = None
+    if cache_dir:
+        from metal.serial.cache import SerialInfoCache
+        cache = SerialInfoCache(cache_dir, cache_size)
+
+    serial_info = generate(binary, defines, paths, cache=cache)
+    with open(output, 'wb') as f:
+        write_binary(serial_info, f, tokens=False)
+    return output
+
+
+# SerialInfo loaded by this worker process, keyed by path
+loaded_serial_info: Dict[str, object] = {}
+
+
+def session_job(args: List[str], serial_info_path: str, timeout: Optional[float], summary_only: bool = False,
+                retention: str = Retention.all, sample_size: Optional[int] = None) -> dict:
+    from metal.serial import Engine, default_hooks
+    from metal.serial.unit import Unit
+
+    log = io.StringIO()
+    reporter = Reporter()
+    reporter.hrf_sink = log
+    reporter.summary_only = summary_only
+
+    hooks = [hook for hook in default_hooks if hook is not Unit] + [lambda: Unit(reporter, retention, sample_size)]
+    result = {'args': args, 'exit_code': None, 'error': None}
+
+    start = time.monotonic()
+    p = None
+    timer = None
+    try:
+        # a binary that can't be started or serial info that can't be loaded only fails its own session
+        serial_info = loaded_serial_info.get(serial_info_path)
+        if serial_info is None:
+            serial_info = loaded_serial_info[serial_info_path] = load_serial_info(serial_info_path)
+
+        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+        if timeout:
+            timer = threading.Timer(timeout, p.kill)
+            timer.start()
+        engine = Engine(input=p.stdout, output=p.stdin, serial_info=serial_info, macro_hooks=hooks)
+        result['exit_code'] = engine.run()
+    except Exception as e:
+        result['error'] = 'timeout after {}s'.format(timeout) if timer and not timer.is_alive() else '{}: {}'.format(type(e).__name__, e)
+    finally:
+        if timer:
+            timer.cancel()
+        if p is not None:
+            p.kill()
+            p.wait()
+
+    result['duration'] = time.monotonic() - start
+    result['report'] = reporter.main_scope.to_dict()
+    result['log'] = log.getvalue()
+    return result
+
+
+def passed(result: dict) -> bool:
+    return result['error'] is None and result['exit_code'] == 0
+
+
+def summarize(results: List[dict]) -> dict:
+    summary = {'sessions': len(results), 'passed': 0, 'failed': 0, 'executed': 0, 'warnings': 0, 'errors': 0}
+    for result in results:
+        summary['passed' if passed(result) else 'failed'] += 1
+        for key in ['executed', 'warnings', 'errors']:
+            summary[key] += result['report']['summary'][key]
+    return summary
+
+
+def run(targets: List[Target], defines: List[str], paths: List[str], jobs: int = 0, timeout: Optional[float] = None,
+        cache_dir: Optional[str] = None, cache_size: int = 256 * 1024 * 1024, progress=None, summary_only: bool = False,
+        retention: str = Retention.all, sample_size: Optional[int] = None) -> dict:
+    binaries = sorted({target.binary for target in targets})
+
+    with tempfile.TemporaryDirectory(prefix='metal-serial-run-') as tmp, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+
+        serial_info_paths = {}
+        generated = {executor.submit(generate_job, binary, defines, paths, cache_dir, cache_size,
+                                     os.path.join(tmp, '{}.serial-info'.format(i))): binary
+                     for i, binary in enumerate(binaries)}
+
+        results: List[Optional[dict]] = [None] * len(targets)
+        sessions = {}
+
+        for future in concurrent.futures.as_completed(generated):
+            binary = generated[future]
+            try:
+                serial_info_paths[binary] = future.result()
+            except Exception as e:
+                serial_info_paths[binary] = None
+                error = 'generating serial info failed: {}: {}'.format(type(e).__name__, e)
+                for i, target in enumerate(targets):
+                    if target.binary == binary:
+                        results[i] = {'args': target.args, 'exit_code': None, 'error': error, 'duration': 0.0,
+                                      'report': Reporter().main_scope.to_dict(), 'log': ''}
+                        if progress:
+                            progress(target, results[i])
+                continue
+
+            for i, target in enumerate(targets):
+                if target.binary == binary:
+                    sessions[executor.submit(session_job, [binary] + target.args[1:], serial_info_paths[binary], timeout,
+                                             summary_only, retention, sample_size)] = i
+
+        for future in concurrent.futures.as_completed(sessions):
+            i = sessions[future]
+            results[i] = future.result()
+            if progress:
+                progress(targets[i], results[i])
+
+    return {'summary': summarize(results), 'sessions': results}
+
+
+def print_result(target: Target, result: dict, out=sys.stdout):
+    summary = result['report']['summary']
+    out.write('{} {} exit code: {}, executed: {}, warnings: {}, errors: {} ({:.2f}s){}\n'.format(
+        'PASS' if passed(result) else 'FAIL', target.spec, result['exit_code'],
+        summary['executed'], summary['warnings'], summary['errors'], result['duration'],
+        ', ' + result['error'] if result['error'] else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('targets', nargs='*',          help='The binaries to run, optionally followed by their arguments in quotes')
+    parser.add_argument('-f', '--file',               help='A file listing one target per line')
+    parser.add_argument('-I', '--include', nargs='+', help="Include folders for the preprocessor", default=[])
+    parser.add_argument('-D', '--define',  nargs='+', help="Defines for the preprocessor", default=[])
+    parser.add_argument('-j', '--jobs',    type=int,  help='Number of sessions run at the same time, defaults to the number of cores', default=0)
+    parser.add_argument('-t', '--timeout', type=float, help='Seconds after which a session gets killed')
+    parser.add_argument('-J', '--json',               help='Write the merged results to this JSON file')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print the test output of every session, not only the failed ones')
+    parser.add_argument('--cache-dir',  help='Directory to cache generated data in, defaults to $METAL_SERIAL_CACHE_DIR',
+                        default=os.environ.get('METAL_SERIAL_CACHE_DIR'))
+    parser.add_argument('--summary-only', action='store_true', help='Only keep the counters of the test scopes, not every single check')
+    parser.add_argument('--retention', choices=[Retention.all, Retention.failures, Retention.sample], default=Retention.all,
+                        help='Keep all checks, only the failures or the failures and a sample of the passing checks per location')
+    parser.add_argument('--sample-size', type=int, help='Passing checks kept per location with --retention sample')
+    parser.add_argument('--cache-size', help='Maximum size of the cache directory in MiB', type=int, default=256)
+
+    args = parser.parse_args()
+
+    specs = list(args.targets)
+    if args.file:
+        with open(args.file) as f:
+            specs += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    if not specs:
+        parser.error('no targets given')
+
+    targets = [Target(spec) for spec in specs]
+
+    def progress(target: Target, result: dict):
+        print_result(target, result)
+        if args.verbose or not passed(result):
+            sys.stdout.write(result['log'])
+
+    results = run(targets, args.define, args.include, jobs=args.jobs, timeout=args.timeout,
+                  cache_dir=args.cache_dir, cache_size=args.cache_size * 1024 * 1024, progress=progress,
+                  summary_only=args.summary_only, retention=args.retention, sample_size=args.sample_size)
+
+    summary = results['summary']
+    print('{} of {} sessions passed, executed: {}, warnings: {}, errors: {}'.format(
+        summary['passed'], summary['sessions'], summary['executed'], summary['warnings'], summary['errors']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f)
+
+    sys.exit(0 if summary['failed'] == 0 else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ import typing
 import re
 
 from metal.serial import MacroHook, Engine
+from metal.serial.hooks import AsyncMacroHook
 from metal.serial.preprocessor import MacroExpansion
 from metal.unit import Reporter
 
@@ -16,16 +17,19 @@ class Unit(MacroHook):
     exit_code: typing.Optional[int]
 
     def invoke(self, engine: Engine, macro_expansion: MacroExpansion):
+        type_and_level = engine.read_byte()
+        cond_or_length = engine.read_int()
+        self.report(macro_expansion, type_and_level, cond_or_length)
+
+    def report(self, macro_expansion: MacroExpansion, type_and_level: bytes, cond_or_length: int):
         file = macro_expansion.file
         line = macro_expansion.line
-        
-        type_and_level = engine.read_byte()
+
         args = macro_expansion.args[3:]
 
         level = level_t[(type_and_level[0] & 0b11100000) >> 5]
         type_ = type_t[type_and_level[0] & 0b11111]
 
-        cond_or_length = engine.read_int()
         condition = bool(cond_or_length)
         func = getattr(self.reporter, type_)
 
@@ -58,10 +62,22 @@ class Unit(MacroHook):
         else:
             raise Exception("Unknown check type {}".format(type_))
          
-    def __init__(self, reporter=None):
+    def __init__(self, reporter=None, retention=None, sample_size=None):
         super().__init__()
         if reporter:
             self.reporter = reporter
         else:
             self.reporter = Reporter()
 
+        if retention is not None:
+            self.reporter.retention = retention
+        if sample_size is not None:
+            self.reporter.sample_size = sample_size
+
+
+# Unit for the AsyncEngine, it only reads two values so it runs on the event loop.
+class AsyncUnit(Unit, AsyncMacroHook):
+    async def invoke(self, engine: 'AsyncEngine', macro_expansion: MacroExpansion):
+        type_and_level = await engine.read_byte()
+        cond_or_length = await engine.read_int()
+        self.report(macro_expansion, type_and_level, cond_or_length)
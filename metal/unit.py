@@ -1,5 +1,9 @@
+import array
 import json
+import random
 import sys
+import threading
+import time
 
 
 class Control:
@@ -14,13 +18,113 @@ class Level:
     assertion = "assert"
 
 
+# Which checks a scope keeps, the counters always include all of them
+class Retention:
+    all      = "all"
+    failures = "failures"
+    # failures and a reservoir sample of the passing checks of every location
+    sample   = "sample"
+
+
+# Stores every distinct value once and hands out its index.
+# Values are keyed together with their type, so True & 1 stay apart.
+class InternTable:
+    def __init__(self):
+        self.values = []
+        self.index = {}
+
+    def add(self, value):
+        key = (value.__class__, value)
+        idx = self.index.get(key)
+        if idx is None:
+            idx = self.index[key] = len(self.values)
+            self.values.append(value)
+        return idx
+
+    # returns the interned instance of value, or value itself if it can't be hashed
+    def intern(self, value):
+        try:
+            return self.values[self.add(value)]
+        except TypeError:
+            return value
+
+
+# The checks of a scope stored by column instead of one dict per check.
+# Type, file, level & condition are indices into the InternTable shared by all scopes of a reporter, lines live in an array
+# and the remaining fields are kept as a tuple per check, which is interned as well unless it holds values read at runtime (*_val).
+# Dicts are only rebuilt when the checks are iterated, e.g. by Scope.to_dict.
+class TestColumns:
+    columns = ("type", "file", "line", "level", "condition")
+
+    def __init__(self, table=None):
+        self.table = InternTable() if table is None else table
+        self.type = array.array('I')
+        self.file = array.array('I')
+        self.line = array.array('q')
+        self.level = array.array('I')
+        self.condition = array.array('I')
+        # the key order of each check, so the rebuilt dict looks exactly like the one appended
+        self.shape = array.array('I')
+        self.rest = []
+
+    def __encode_rest(self, data):
+        table = self.table
+        rest = tuple(tuple(value) if isinstance(value, list) else value
+                     for key, value in data.items() if key not in TestColumns.columns)
+        if any(value is not None for key, value in data.items() if key.endswith("_val")):
+            return tuple(table.intern(value) if isinstance(value, str) else value for value in rest)
+        return table.intern(tuple(table.intern(value) for value in rest))
+
+    def append(self, data):
+        table = self.table
+        self.type.append(table.add(data["type"]))
+        self.file.append(table.add(data["file"]))
+        self.line.append(data["line"])
+        self.level.append(table.add(data["level"]))
+        self.condition.append(table.add(data["condition"]))
+        self.shape.append(table.add(tuple(data)))
+        self.rest.append(self.__encode_rest(data))
+
+    def __setitem__(self, idx, data):
+        table = self.table
+        self.type[idx] = table.add(data["type"])
+        self.file[idx] = table.add(data["file"])
+        self.line[idx] = data["line"]
+        self.level[idx] = table.add(data["level"])
+        self.condition[idx] = table.add(data["condition"])
+        self.shape[idx] = table.add(tuple(data))
+        self.rest[idx] = self.__encode_rest(data)
+
+    def __len__(self):
+        return len(self.line)
+
+    def __getitem__(self, idx):
+        values = self.table.values
+        columns = {"type": values[self.type[idx]], "file": values[self.file[idx]], "line": self.line[idx],
+                   "level": values[self.level[idx]], "condition": values[self.condition[idx]]}
+        rest = iter(self.rest[idx])
+        res = {}
+        for key in values[self.shape[idx]]:
+            if key in columns:
+                res[key] = columns[key]
+            else:
+                value = next(rest)
+                res[key] = list(value) if isinstance(value, tuple) else value
+        return res
+
+    def __iter__(self):
+        return (self[idx] for idx in range(len(self)))
+
+
 class Scope:
-    def __init__(self, name):
+    def __init__(self, name, table=None):
         self.executed = 0
         self.errors = 0
         self.warnings = 0
         self.children = []
-        self.tests = []
+        self.tests = TestColumns(table)
+        # (file, line) -> [passing checks seen, indices of the sampled ones in tests]
+        self.samples = {}
         self.cancelled = False
         self.parent = None
         self.name = name
@@ -35,7 +139,8 @@ class Scope:
 
     #def cancel(self, ):
 
-    def append_test(self, data):
+    # updates the counters, returns whether data is a check that gets stored
+    def count_test(self, data):
         if "level" in data and "condition" in data:
             self.executed += 1
             if not data["condition"]:
@@ -43,19 +148,48 @@ class Scope:
                     self.errors += 1
                 elif data["level"] == "expect":
                     self.warnings += 1
+            return True
+        return False
 
+    def append_test(self, data, retention=Retention.all, sample_size=0, rng=random):
+        if not self.count_test(data):
+            return
+        if retention == Retention.all or not data["condition"]:
+            self.tests.append(data)
+        elif retention == Retention.sample:
+            self.sample_test(data, sample_size, rng)
+        elif retention != Retention.failures:
+            raise Exception("Unknown retention {}".format(retention))
+
+    # reservoir sampling, so every passing check of a location has the same chance to be kept
+    def sample_test(self, data, sample_size, rng=random):
+        location = (data["file"], data["line"])
+        sample = self.samples.get(location)
+        if sample is None:
+            sample = self.samples[location] = [0, []]
+        sample[0] += 1
+
+        if len(sample[1]) < sample_size:
+            sample[1].append(len(self.tests))
             self.tests.append(data)
+        else:
+            idx = rng.randrange(sample[0])
+            if idx < sample_size:
+                self.tests[sample[1][idx]] = data
+
+    def summary(self):
+        return {
+            "executed": self.executed,
+            "warnings": self.warnings,
+            "errors": self.errors
+        }
 
     def to_dict(self):
         res = {
-            "summary": {
-                "executed": self.executed,
-                "warnings": self.warnings,
-                "errors": self.errors
-            },
+            "summary": self.summary(),
             "cancelled": self.cancelled,
             "children": [ch.to_dict() for ch in self.children],
-            "tests":    self.tests
+            "tests":    list(self.tests)
         }
         if self.description:
             res["description"] = self.description
@@ -63,8 +197,55 @@ class Scope:
 
 
 class MainScope(Scope):
-    def __init__(self):
-        super().__init__('<main>')
+    def __init__(self, table=None):
+        super().__init__('<main>', table)
+
+
+# Writes one JSON object per line as the records come in.
+# Records are buffered and written once buffer_records of them are pending or the oldest one is flush_interval seconds old
+# (checked by a timer, so a session that stalls after a burst doesn't hold its last records back),
+# so a crashing target loses at most that much.
+class JsonLinesSink:
+    def __init__(self, output, buffer_records=1024, flush_interval=1.0):
+        self.output = output
+        self.buffer_records = buffer_records
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.timer = None
+        # the timer flushes from its own thread
+        self.lock = threading.Lock()
+
+    def __flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.buffer:
+            self.output.write('\n'.join(self.buffer) + '\n')
+            self.buffer.clear()
+        self.output.flush()
+
+    def __expire(self):
+        with self.lock:
+            self.timer = None
+            self.__flush()
+
+    def write(self, record):
+        line = json.dumps(record)
+        with self.lock:
+            self.buffer.append(line)
+            if len(self.buffer) >= self.buffer_records:
+                self.__flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self.__expire)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.__flush()
+
+    def close(self):
+        self.flush()
 
 
 def loc_str(file, line):
@@ -80,9 +261,25 @@ class Reporter:
         self.hrf_sink = sys.stdout
         self.print_level = 'warning' # all, warning error
         self.json_sink = None
+        self.jsonl_sink = None
+        # only keep the counters of a scope, not the individual checks
+        self.summary_only = False
+        self.retention = Retention.all
+        # passing checks kept per location with Retention.sample
+        self.sample_size = 16
+        # seeded, so the same run keeps the same samples
+        self.random = random.Random(0)
 
         self.__scope_stack = [MainScope()]
 
+    def append_test(self, data):
+        if self.jsonl_sink:
+            self.jsonl_sink.write(dict(data, event="check", scope=self.current_scope.name))
+        if self.summary_only:
+            self.current_scope.count_test(data)
+        else:
+            self.current_scope.append_test(data, self.retention, self.sample_size, self.random)
+
     def should_print(self, level = Level.info, condition = 1):
         if self.hrf_sink is None:
             return False
@@ -95,6 +292,10 @@ class Reporter:
 
         return (not condition) and level == Level.assertion
 
+    @property
+    def main_scope(self) -> MainScope:
+        return self.__scope_stack[0]
+
     @property
     def current_scope(self):
         return self.__scope_stack[len(self.__scope_stack) - 1]
@@ -103,12 +304,12 @@ class Reporter:
         if self.hrf_sink:
             self.hrf_sink.write("{} critical check failed, cancelling\n".format(loc_str(file, line)))
             self.current_scope.cancelled = True
-        self.current_scope.append_test({"type": "critical", "file": file, "line": line, "control": control})
+        self.append_test({"type": "critical", "file": file, "line": line, "control": control})
 
     def loop(self, file, line, control):
         if self.hrf_sink:
             self.hrf_sink.write("{} for loop cancelled\n".format(loc_str(file, line)))
-        self.current_scope.append_test({"type": "loop", "file": file, "line": line, "control": control})
+        self.append_test({"type": "loop", "file": file, "line": line, "control": control})
 
     def ranged(self, file, line, control, condition_or_length, range_info, range_info_values=None):
         data = {"type": "ranged", "file": file, "line": line, "control": control, "length": condition_or_length, "control": control}
@@ -133,15 +334,17 @@ class Reporter:
         else:
             raise Exception("Unknown control {}".format(control))
 
-        self.current_scope.append_test(data)
+        self.append_test(data)
 
     def call(self, file, line, control, condition, function, description=None):
         if control == 'enter':
-            scp = Scope(function if function else "**unknown**")
+            scp = Scope(function if function else "**unknown**", self.current_scope.tests.table)
             scp.parent = self.current_scope
             if description:
                 scp.description = description
             self.__scope_stack.append(scp)
+            if self.jsonl_sink:
+                self.jsonl_sink.write({"event": "enter", "file": file, "line": line, "scope": scp.name, "description": description})
             self.hrf_sink.write("{} entering test case {}\n"
                                 .format(loc_str(file, line), (" " + description) if description else function))
         elif control == 'exit':
@@ -153,6 +356,10 @@ class Reporter:
                                         ("succeeded " if condition == 0 else "failed "),
                                         sc.executed, sc.warnings, sc.errors))
 
+            if self.jsonl_sink:
+                self.jsonl_sink.write({"event": "exit", "file": file, "line": line, "scope": sc.name, "condition": condition,
+                                       "cancelled": sc.cancelled, "summary": sc.summary()})
+
             self.__scope_stack.pop()
             self.__scope_stack[len(self.__scope_stack) - 1] += sc
         else:
@@ -161,24 +368,24 @@ class Reporter:
     def log(self, file, line, message):
         if self.hrf_sink:
             self.hrf_sink.write("{} log: {}\n".format(loc_str(file, line), message))
-        self.current_scope.append_test({"type": "log", "file": file, "line": line, "message": message})
+        self.append_test({"type": "log", "file": file, "line": line, "message": message})
 
     def checkpoint(self, file, line):
         if self.should_print():
             self.hrf_sink.write("{} checkpoint\n".format(loc_str(file, line)))
-        self.current_scope.append_test({"type": "checkpoint", "file": file, "line": line})
+        self.append_test({"type": "checkpoint", "file": file, "line": line})
 
     def message(self, file, line, level, condition, message):
         if self.hrf_sink:
             self.hrf_sink.write("{} message: {}\n".format(message_str(file, line, level, condition), message))
-        self.current_scope.append_test({"type": "message", "file": file, "line": line, "message": message, "level": level, "condition": condition})
+        self.append_test({"type": "message", "file": file, "line": line, "message": message, "level": level, "condition": condition})
 
     def plain  (self, file, line, level, condition, description, value=None):
         if self.hrf_sink and value:
             self.hrf_sink.write("{} [plain]: {}: [{}]\n".format(message_str(file, line, level, condition), description, value))
         elif self.hrf_sink:
             self.hrf_sink.write("{} [plain]: {}\n".format(message_str(file, line, level, condition), description))
-        self.current_scope.append_test({"type": "plain", "file": file, "line": line, "description": description, "level": level, "condition": condition})
+        self.append_test({"type": "plain", "file": file, "line": line, "description": description, "level": level, "condition": condition})
 
     def equal(self, file, line, level, condition, lhs, rhs, lhs_val=None, rhs_val=None):
         ex = '{} == {}'.format(lhs, rhs) if rhs else lhs
@@ -186,7 +393,7 @@ class Reporter:
             self.hrf_sink.write("{} [equal]: {}: [{} == {}]\n".format(message_str(file, line, level, condition), ex, lhs_val, rhs_val))
         elif self.hrf_sink:
             self.hrf_sink.write("{} [equal]: {}\n".format(message_str(file, line, level, condition), ex))
-        self.current_scope.append_test({"type": "equal", "file": file, "line": line, "lhs" : lhs, "rhs": rhs, "level": level, "condition": condition, "lhs_val" : lhs_val, "rhs_val": rhs_val})
+        self.append_test({"type": "equal", "file": file, "line": line, "lhs" : lhs, "rhs": rhs, "level": level, "condition": condition, "lhs_val" : lhs_val, "rhs_val": rhs_val})
 
     def not_equal(self, file, line, level, condition, lhs, rhs, lhs_val=None, rhs_val=None):
         ex = '{} != {}'.format(lhs, rhs) if rhs else lhs
@@ -194,7 +401,7 @@ class Reporter:
             self.hrf_sink.write("{} [not_equal]: {}: [{} != {}]\n".format(message_str(file, line, level, condition), ex, lhs_val, rhs_val))
         elif self.hrf_sink:
             self.hrf_sink.write("{} [not_equal]: {}\n".format(message_str(file, line, level, condition), ex))
-        self.current_scope.append_test({"type": "not_equal", "file": file, "line": line, "lhs" : lhs, "rhs": rhs, "level": level, "condition": condition, "lhs_val" : lhs_val, "rhs_val": rhs_val})
+        self.append_test({"type": "not_equal", "file": file, "line": line, "lhs" : lhs, "rhs": rhs, "level": level, "condition": condition, "lhs_val" : lhs_val, "rhs_val": rhs_val})
 
     def ge(self, file, line, level, condition, lhs, rhs, lhs_val=None, rhs_val=None):
         ex = '{} >= {}'.format(lhs, rhs) if rhs else lhs
@@ -202,7 +409,7 @@ class Reporter:
             self.hrf_sink.write("{} [ge]: {}: [{} >= {}]\n".format(message_str(file, line, level, condition), ex, lhs_val, rhs_val))
         elif self.hrf_sink:
             self.hrf_sink.write("{} [ge]: {}\n".format(message_str(file, line, level, condition), ex))
-        self.current_scope.append_test({"type": "ge", "file": file, "line": line, "lhs" : lhs, "rhs": rhs, "level": level, "condition": condition, "lhs_val" : lhs_val, "rhs_val": rhs_val})
+        self.append_test({"type": "ge", "file": file, "line": line, "lhs" : lhs, "rhs": rhs, "level": level, "condition": condition, "lhs_val" : lhs_val, "rhs_val": rhs_val})
 
     def le(self, file, line, level, condition, lhs, rhs, lhs_val=None, rhs_val=None):
         ex = '{} <= {}'.format(lhs, rhs) if rhs else lhs
@@ -210,7 +417,7 @@ class Reporter:
             self.hrf_sink.write("{} [le]: {}: [{} <= {}]\n".format(message_str(file, line, level, condition), ex, lhs_val, rhs_val))
         elif self.hrf_sink:
             self.hrf_sink.write("{} [le]: {}\n".format(message_str(file, line, level, condition), ex))
-        self.current_scope.append_test({"type": "le", "file": file, "line": line, "lhs" : lhs, "rhs": rhs, "level": level, "condition": condition, "lhs_val" : lhs_val, "rhs_val": rhs_val})
+        self.append_test({"type": "le", "file": file, "line": line, "lhs" : lhs, "rhs": rhs, "level": level, "condition": condition, "lhs_val" : lhs_val, "rhs_val": rhs_val})
 
     def greater(self, file, line, level, condition, lhs, rhs, lhs_val=None, rhs_val=None):
         ex = '{} > {}'.format(lhs, rhs) if rhs else lhs
@@ -218,7 +425,7 @@ class Reporter:
             self.hrf_sink.write("{} [greater]: {}: [{} > {}]\n".format(message_str(file, line, level, condition), ex, lhs_val, rhs_val))
         elif self.hrf_sink:
             self.hrf_sink.write("{} [greater]: {}\n".format(message_str(file, line, level, condition), ex))
-        self.current_scope.append_test({"type": "greater", "file": file, "line": line, "lhs" : lhs, "rhs": rhs, "level": level, "condition": condition, "lhs_val" : lhs_val, "rhs_val": rhs_val})
+        self.append_test({"type": "greater", "file": file, "line": line, "lhs" : lhs, "rhs": rhs, "level": level, "condition": condition, "lhs_val" : lhs_val, "rhs_val": rhs_val})
 
     def lesser(self, file, line, level, condition, lhs, rhs, lhs_val=None, rhs_val=None):
         ex = '{} < {}'.format(lhs, rhs) if rhs else lhs
@@ -226,7 +433,7 @@ class Reporter:
             self.hrf_sink.write("{} [lesser]: {}: [{} < {}]\n".format(message_str(file, line, level, condition), ex, lhs_val, rhs_val))
         elif self.hrf_sink:
             self.hrf_sink.write("{} [lesser]: {}\n".format(message_str(file, line, level, condition), ex))
-        self.current_scope.append_test({"type": "lesser", "file": file, "line": line, "lhs" : lhs, "rhs": rhs, "level": level, "condition": condition, "lhs_val" : lhs_val, "rhs_val": rhs_val})
+        self.append_test({"type": "lesser", "file": file, "line": line, "lhs" : lhs, "rhs": rhs, "level": level, "condition": condition, "lhs_val" : lhs_val, "rhs_val": rhs_val})
 
     def close(self, file, line, level, condition, lhs, rhs, tolerance, lhs_val=None, rhs_val=None, tolerance_val=None):
         expression = lhs
@@ -237,7 +444,7 @@ class Reporter:
             self.hrf_sink.write("{} [close]: {}: [{} = {}  +- {}]\n".format(message_str(file, line, level, condition), expression, lhs_val, rhs_val, tolerance_val))
         elif self.hrf_sink:
             self.hrf_sink.write("{} [close]: {}\n".format(message_str(file, line, level, condition), expression))
-        self.current_scope.append_test({"type": "close", "file": file, "line": line, "lhs" : lhs, "rhs": rhs, "level": level, "condition": condition, "lhs_val" : lhs_val, "rhs_val": rhs_val, "tolerance": tolerance, "tolerance_val": tolerance_val})
+        self.append_test({"type": "close", "file": file, "line": line, "lhs" : lhs, "rhs": rhs, "level": level, "condition": condition, "lhs_val" : lhs_val, "rhs_val": rhs_val, "tolerance": tolerance, "tolerance_val": tolerance_val})
 
     def close_relative(self, file, line, level, condition, lhs, rhs, tolerance, lhs_val=None, rhs_val=None, tolerance_val=None):
 
@@ -249,14 +456,14 @@ class Reporter:
             self.hrf_sink.write("{} [close_relative]: {}: [{} = {} +- ~ {}]\n".format(message_str(file, line, level, condition), expression, lhs_val, rhs_val, tolerance_val))
         elif self.hrf_sink:
             self.hrf_sink.write("{} [close_relative]: {}\n".format(message_str(file, line, level, condition), expression))
-        self.current_scope.append_test({"type": "close", "file": file, "line": line, "lhs" : lhs, "rhs": rhs, "level": level, "condition": condition, "lhs_val" : lhs_val, "rhs_val": rhs_val, "tolerance": tolerance, "tolerance_val": tolerance_val})
+        self.append_test({"type": "close", "file": file, "line": line, "lhs" : lhs, "rhs": rhs, "level": level, "condition": condition, "lhs_val" : lhs_val, "rhs_val": rhs_val, "tolerance": tolerance, "tolerance_val": tolerance_val})
 
     def predicate(self, file, line, level, condition, function, args, function_val=None, args_val=None):
         if self.hrf_sink and function_val and args_val:
             self.hrf_sink.write("{} [predicate]: {}({}): [{}({})]\n".format(message_str(file, line, level, condition), function, ', '.join(args),  function_val, ', '.join(args_val)))
         elif self.hrf_sink:
             self.hrf_sink.write("{} [predicate]: {}({})\n".format(message_str(file, line, level, condition), function, ', '.join(args)))
-        self.current_scope.append_test({"type": "close", "file": file, "line": line, "function": function, "args": args, "level": level, "condition": condition, "function_val": function_val, "args_val": args_val})
+        self.append_test({"type": "close", "file": file, "line": line, "function": function, "args": args, "level": level, "condition": condition, "function_val": function_val, "args_val": args_val})
 
     def report(self, file, line, condition):
         if self.hrf_sink:
@@ -265,3 +472,7 @@ class Reporter:
 
         if self.json_sink:
             self.json_sink.write(json.dumps(self.__scope_stack[0].to_dict()))
+
+        if self.jsonl_sink:
+            self.jsonl_sink.write({"event": "report", "file": file, "line": line, "summary": self.__scope_stack[0].summary()})
+            self.jsonl_sink.flush()
@@ -1,4 +1,5 @@
-from typing import Optional, Union, Tuple, Sequence, TextIO, List
+import random
+from typing import Optional, Union, Tuple, Sequence, TextIO, List, Iterator, Any
 
 
 class Control:
@@ -12,8 +13,33 @@ class Level:
     assertion: Level
     warning  : Level
 
+class InternTable:
+    values: List[Any]
+
+    def add(self, value: Any) -> int: ...
+    def intern(self, value: Any) -> Any: ...
+
+
+class TestColumns:
+    def __init__(self, table: Optional[InternTable] = None): ...
+
+    table: InternTable
+
+    def append(self, data: dict): ...
+    def __len__(self) -> int: ...
+    def __getitem__(self, idx: int) -> dict: ...
+    def __setitem__(self, idx: int, data: dict): ...
+    def __iter__(self) -> Iterator[dict]: ...
+
+
+class Retention:
+    all:      str
+    failures: str
+    sample:   str
+
+
 class Scope:
-    def __init__(self, name: str): ...
+    def __init__(self, name: str, table: Optional[InternTable] = None): ...
     def __iadd__(self, rhs: Scope): ...
     def to_dict(self) -> dict: ...
 
@@ -21,17 +47,36 @@ class Scope:
     errors: int
     warnings: int
     children: List[Scope]
-    tests = []
+    tests: TestColumns
     cancelled: bool
     parent: Optional[Scope]
     name: str
     description: Optional[str]
 
-    def append_test(self, param: dict): ...
+    def count_test(self, param: dict) -> bool: ...
+    samples: dict
+
+    def append_test(self, param: dict, retention: str = Retention.all, sample_size: int = 0, rng: random.Random = random): ...
+    def sample_test(self, param: dict, sample_size: int, rng: random.Random = random): ...
+    def summary(self) -> dict: ...
+
+
+class JsonLinesSink:
+    def __init__(self, output: TextIO, buffer_records: int = 1024, flush_interval: float = 1.0): ...
+
+    output: TextIO
+    buffer_records: int
+    flush_interval: float
+
+    def write(self, record: dict): ...
+    def flush(self): ...
+    def close(self): ...
 
 
 class Reporter:
 
+    def append_test(self, data: dict): ...
+
     def should_print(self, level = Level.info, condition = 1) -> bool: ...
 
     def critical(self, file: str, line: int, mode: Control, function: Optional[str]): ...
@@ -69,8 +114,16 @@ class Reporter:
     hrf_sink: Optional[TextIO]
     print_level : str
     json_sink: Optional[TextIO]
+    jsonl_sink: Optional[JsonLinesSink]
+    summary_only: bool
+    retention: str
+    sample_size: int
+    random: random.Random
 
     __scope_stack = List[Scope]
 
+    @property
+    def main_scope(self) -> Scope: ...
+
     @property
     def current_scope(self) -> Scope: ...
\ No newline at end of file
@@ -0,0 +1,517 @@
+import errno
+import os
+import posixpath
+import stat
+import sys
+import tarfile
+import threading
+import time
+import typing
+
+
+# An in-memory file system with the interface of the `os_` module the newlib hooks take,
+# e.g. build_newlib_hook(VirtualFileSystem()) or NewlibBreakpoints(VirtualFileSystem()).
+# Paths are posix paths, relative ones start at the root. fds 0, 1 & 2 are the given streams, files get the lowest free fd above.
+# Errors are raised as OSError with the errno set, just like os does.
+
+class Node:
+    def __init__(self, ino: int, mode: int):
+        self.ino = ino
+        self.mode = mode
+        self.nlink = 0
+        now = time.time_ns()
+        self.atime = now
+        self.mtime = now
+        self.ctime = now
+
+    @property
+    def size(self) -> int:
+        return 0
+
+
+class File(Node):
+    def __init__(self, ino: int, mode: int, data: bytes = b''):
+        super().__init__(ino, stat.S_IFREG | (mode & 0o7777))
+        self.data = bytearray(data)
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+
+class Directory(Node):
+    def __init__(self, ino: int, mode: int):
+        super().__init__(ino, stat.S_IFDIR | (mode & 0o7777))
+        self.entries: typing.Dict[str, Node] = {}
+
+
+class Symlink(Node):
+    def __init__(self, ino: int, target: str):
+        super().__init__(ino, stat.S_IFLNK | 0o777)
+        self.target = target
+
+    @property
+    def size(self) -> int:
+        return len(self.target.encode())
+
+
+class OpenFile:
+    def __init__(self, node: Node, readable: bool, writable: bool, append: bool):
+        self.node = node
+        self.readable = readable
+        self.writable = writable
+        self.append = append
+        self.position = 0
+
+
+class Stream:
+    def __init__(self, stream: typing.Optional[typing.BinaryIO], readable: bool):
+        self.stream = stream
+        self.readable = readable
+        self.writable = not readable
+
+
+def error(code: int, path: typing.Optional[str] = None) -> OSError:
+    if path is None:
+        return OSError(code, os.strerror(code))
+    return OSError(code, os.strerror(code), path)
+
+
+class VirtualFileSystem:
+    stat_result = os.stat_result
+
+    SEEK_SET = os.SEEK_SET
+    SEEK_CUR = os.SEEK_CUR
+    SEEK_END = os.SEEK_END
+
+    O_RDONLY    = os.O_RDONLY
+    O_WRONLY    = os.O_WRONLY
+    O_RDWR      = os.O_RDWR
+    O_ACCMODE   = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
+    O_APPEND    = os.O_APPEND
+    O_CREAT     = os.O_CREAT
+    O_EXCL      = os.O_EXCL
+    O_TRUNC     = os.O_TRUNC
+    # accepted, but without any effect on memory
+    O_NOCTTY    = getattr(os, 'O_NOCTTY',    0)
+    O_NONBLOCK  = getattr(os, 'O_NONBLOCK',  0)
+    O_NDELAY    = getattr(os, 'O_NDELAY',    0)
+    O_SYNC      = getattr(os, 'O_SYNC',      0)
+    O_DSYNC     = getattr(os, 'O_DSYNC',     0)
+    O_CLOEXEC   = getattr(os, 'O_CLOEXEC',   0)
+    O_DIRECT    = getattr(os, 'O_DIRECT',    0)
+    O_NOATIME   = getattr(os, 'O_NOATIME',   0)
+    O_PATH      = getattr(os, 'O_PATH',      0)
+    O_DIRECTORY = getattr(os, 'O_DIRECTORY', 0o200000)
+    O_NOFOLLOW  = getattr(os, 'O_NOFOLLOW',  0o400000)
+
+    S_IFMT   = 0o170000
+    S_IFDIR  = stat.S_IFDIR
+    S_IFCHR  = stat.S_IFCHR
+    S_IFBLK  = stat.S_IFBLK
+    S_IFREG  = stat.S_IFREG
+    S_IFLNK  = stat.S_IFLNK
+    S_IFSOCK = stat.S_IFSOCK
+    S_IFIFO  = stat.S_IFIFO
+    S_ISUID  = stat.S_ISUID
+    S_ISGID  = stat.S_ISGID
+    S_ISVTX  = stat.S_ISVTX
+    S_ENFMT  = stat.S_ISGID
+    S_IREAD  = stat.S_IRUSR
+    S_IWRITE = stat.S_IWUSR
+    S_IEXEC  = stat.S_IXUSR
+    S_IRWXU  = stat.S_IRWXU
+    S_IRUSR  = stat.S_IRUSR
+    S_IWUSR  = stat.S_IWUSR
+    S_IXUSR  = stat.S_IXUSR
+    S_IRWXG  = stat.S_IRWXG
+    S_IRGRP  = stat.S_IRGRP
+    S_IWGRP  = stat.S_IWGRP
+    S_IXGRP  = stat.S_IXGRP
+    S_IRWXO  = stat.S_IRWXO
+    S_IROTH  = stat.S_IROTH
+    S_IWOTH  = stat.S_IWOTH
+    S_IXOTH  = stat.S_IXOTH
+
+    # device number reported by stat
+    device = 0x6d7673
+    max_fds = 1024
+    max_symlinks = 40
+
+    def __init__(self, stdin: typing.Optional[typing.BinaryIO] = None,
+                 stdout: typing.Optional[typing.BinaryIO] = None,
+                 stderr: typing.Optional[typing.BinaryIO] = None,
+                 umask: int = 0o022):
+        self.umask = umask
+        self.uid = os.getuid() if hasattr(os, 'getuid') else 0
+        self.gid = os.getgid() if hasattr(os, 'getgid') else 0
+
+        self.__next_ino = 1
+        self.root = Directory(self.__ino(), 0o755)
+        self.root.nlink = 2
+
+        self.fds: typing.Dict[int, typing.Union[OpenFile, Stream]] = {
+            0: Stream(stdin  if stdin  is not None else getattr(sys.stdin,  'buffer', None), True),
+            1: Stream(stdout if stdout is not None else getattr(sys.stdout, 'buffer', None), False),
+            2: Stream(stderr if stderr is not None else getattr(sys.stderr, 'buffer', None), False),
+        }
+        # the newlib hooks might call in from a background thread
+        self.lock = threading.RLock()
+        self.baseline: typing.Dict[str, typing.Union[bytes, str]] = {}
+
+    def __ino(self) -> int:
+        ino = self.__next_ino
+        self.__next_ino += 1
+        return ino
+
+    # returns the directory containing path, its location & the name in it, following symlinks in the directories.
+    # Relative paths start at base, which is the directory of the link for relative symlink targets.
+    def __walk(self, path: str, depth: int = 0, base: str = '/') -> typing.Tuple[Directory, str, str]:
+        parts = [part for part in posixpath.normpath(posixpath.join(base, path)).split('/') if part]
+        if not parts:
+            return self.root, '/', ''
+
+        directory, location = self.root, '/'
+        for part in parts[:-1]:
+            node, location = self.__lookup(directory, location, part, path, depth)
+            if not isinstance(node, Directory):
+                raise error(errno.ENOTDIR, path)
+            directory = node
+        return directory, location, parts[-1]
+
+    def __parent(self, path: str) -> typing.Tuple[Directory, str]:
+        directory, _, name = self.__walk(path)
+        return directory, name
+
+    # returns the node & its location, i.e. that of the node a symlink resolved to
+    def __lookup(self, directory: Directory, location: str, name: str, path: str, depth: int) -> typing.Tuple[Node, str]:
+        node = directory.entries.get(name)
+        if node is None:
+            raise error(errno.ENOENT, path)
+        if isinstance(node, Symlink):
+            return self.__resolve(node, location, path, depth + 1)
+        return node, posixpath.join(location, name)
+
+    # location is the directory containing the link
+    def __resolve(self, link: Symlink, location: str, path: str, depth: int) -> typing.Tuple[Node, str]:
+        if depth > self.max_symlinks:
+            raise error(errno.ELOOP, path)
+        directory, location, name = self.__walk(link.target, depth, location)
+        if not name:
+            return directory, location
+        return self.__lookup(directory, location, name, path, depth)
+
+    def __node(self, path: str, follow: bool = True) -> Node:
+        directory, location, name = self.__walk(path)
+        if not name:
+            return directory
+        if follow:
+            return self.__lookup(directory, location, name, path, 0)[0]
+        node = directory.entries.get(name)
+        if node is None:
+            raise error(errno.ENOENT, path)
+        return node
+
+    def __open_file(self, fd: int) -> typing.Union[OpenFile, Stream]:
+        try:
+            return self.fds[fd]
+        except KeyError:
+            raise error(errno.EBADF)
+
+    def __add(self, directory: Directory, name: str, node: Node, path: str):
+        if name in directory.entries:
+            raise error(errno.EEXIST, path)
+        directory.entries[name] = node
+        node.nlink += 2 if isinstance(node, Directory) else 1
+        if isinstance(node, Directory):
+            directory.nlink += 1
+        directory.mtime = directory.ctime = time.time_ns()
+
+    def __stat(self, node: Node) -> os.stat_result:
+        return os.stat_result((node.mode, node.ino, self.device, node.nlink, self.uid, self.gid, node.size,
+                               node.atime // 1000000000, node.mtime // 1000000000, node.ctime // 1000000000),
+                              {'st_atime': node.atime / 1e9, 'st_mtime': node.mtime / 1e9, 'st_ctime': node.ctime / 1e9,
+                               'st_atime_ns': node.atime, 'st_mtime_ns': node.mtime, 'st_ctime_ns': node.ctime,
+                               'st_blksize': 4096, 'st_blocks': (node.size + 511) // 512, 'st_rdev': 0})
+
+    def open(self, path: str, flags: int, mode: int = 0o777) -> int:
+        with self.lock:
+            access = flags & self.O_ACCMODE
+            if access == self.O_ACCMODE:
+                raise error(errno.EINVAL, path)
+            readable = access in (self.O_RDONLY, self.O_RDWR)
+            writable = access in (self.O_WRONLY, self.O_RDWR)
+
+            directory, location, name = self.__walk(path)
+            node = directory if not name else directory.entries.get(name)
+
+            if node is None:
+                if not flags & self.O_CREAT:
+                    raise error(errno.ENOENT, path)
+                node = File(self.__ino(), mode & ~self.umask)
+                self.__add(directory, name, node, path)
+            elif flags & self.O_CREAT and flags & self.O_EXCL:
+                raise error(errno.EEXIST, path)
+            elif isinstance(node, Symlink):
+                if flags & self.O_NOFOLLOW:
+                    raise error(errno.ELOOP, path)
+                node = self.__resolve(node, location, path, 1)[0]
+
+            if isinstance(node, Directory):
+                if writable:
+                    raise error(errno.EISDIR, path)
+            elif flags & self.O_DIRECTORY:
+                raise error(errno.ENOTDIR, path)
+            elif flags & self.O_TRUNC and writable:
+                node.data.clear()
+                node.mtime = node.ctime = time.time_ns()
+
+            fd = next((fd for fd in range(3, self.max_fds) if fd not in self.fds), None)
+            if fd is None:
+                raise error(errno.EMFILE, path)
+            self.fds[fd] = OpenFile(node, readable, writable, bool(flags & self.O_APPEND))
+            return fd
+
+    def close(self, fd: int):
+        with self.lock:
+            self.__open_file(fd)
+            del self.fds[fd]
+
+    def read(self, fd: int, n: int) -> bytes:
+        with self.lock:
+            file = self.__open_file(fd)
+            if not file.readable:
+                raise error(errno.EBADF)
+            if isinstance(file, Stream):
+                return file.stream.read(n) if file.stream is not None else b''
+            if isinstance(file.node, Directory):
+                raise error(errno.EISDIR)
+
+            data = bytes(file.node.data[file.position:file.position + n])
+            file.position += len(data)
+            file.node.atime = time.time_ns()
+            return data
+
+    def write(self, fd: int, data: bytes) -> int:
+        with self.lock:
+            file = self.__open_file(fd)
+            if not file.writable:
+                raise error(errno.EBADF)
+            if isinstance(file, Stream):
+                if file.stream is not None:
+                    file.stream.write(data)
+                    file.stream.flush()
+                return len(data)
+
+            buffer = file.node.data
+            if file.append:
+                file.position = len(buffer)
+            end = file.position + len(data)
+            if file.position > len(buffer):
+                buffer.extend(bytes(file.position - len(buffer)))
+            buffer[file.position:end] = data
+            file.position = end
+            file.node.mtime = file.node.ctime = time.time_ns()
+            return len(data)
+
+    def lseek(self, fd: int, offset: int, how: int) -> int:
+        with self.lock:
+            file = self.__open_file(fd)
+            if isinstance(file, Stream):
+                raise error(errno.ESPIPE)
+
+            if how == self.SEEK_SET:
+                position = offset
+            elif how == self.SEEK_CUR:
+                position = file.position + offset
+            elif how == self.SEEK_END:
+                position = file.node.size + offset
+            else:
+                raise error(errno.EINVAL)
+
+            if position < 0:
+                raise error(errno.EINVAL)
+            file.position = position
+            return position
+
+    def isatty(self, fd: int) -> bool:
+        with self.lock:
+            file = self.fds.get(fd)
+            if not isinstance(file, Stream) or file.stream is None:
+                return False
+            isatty = getattr(file.stream, 'isatty', None)
+            return bool(isatty and isatty())
+
+    def fstat(self, fd: int) -> os.stat_result:
+        with self.lock:
+            file = self.__open_file(fd)
+            if isinstance(file, Stream):
+                return os.stat_result((stat.S_IFCHR | 0o620, 0, self.device, 1, self.uid, self.gid, 0, 0, 0, 0))
+            return self.__stat(file.node)
+
+    def stat(self, path: str) -> os.stat_result:
+        with self.lock:
+            return self.__stat(self.__node(path))
+
+    def lstat(self, path: str) -> os.stat_result:
+        with self.lock:
+            return self.__stat(self.__node(path, follow=False))
+
+    def link(self, src: str, dst: str):
+        with self.lock:
+            node = self.__node(src, follow=False)
+            if isinstance(node, Directory):
+                raise error(errno.EPERM, src)
+            directory, name = self.__parent(dst)
+            if not name:
+                raise error(errno.EEXIST, dst)
+            self.__add(directory, name, node, dst)
+            node.ctime = time.time_ns()
+
+    def symlink(self, target: str, path: str):
+        with self.lock:
+            directory, name = self.__parent(path)
+            if not name:
+                raise error(errno.EEXIST, path)
+            self.__add(directory, name, Symlink(self.__ino(), target), path)
+
+    def unlink(self, path: str):
+        with self.lock:
+            directory, name = self.__parent(path)
+            node = directory.entries.get(name) if name else directory
+            if node is None:
+                raise error(errno.ENOENT, path)
+            if isinstance(node, Directory):
+                raise error(errno.EISDIR, path)
+            # open fds keep the data alive, just like on disk
+            del directory.entries[name]
+            node.nlink -= 1
+            directory.mtime = directory.ctime = node.ctime = time.time_ns()
+
+    def mkdir(self, path: str, mode: int = 0o777):
+        with self.lock:
+            directory, name = self.__parent(path)
+            if not name:
+                raise error(errno.EEXIST, path)
+            self.__add(directory, name, Directory(self.__ino(), mode & ~self.umask), path)
+
+    def makedirs(self, path: str, mode: int = 0o777):
+        with self.lock:
+            current = ''
+            for part in [part for part in posixpath.normpath('/' + path).split('/') if part]:
+                current += '/' + part
+                try:
+                    node = self.__node(current)
+                except FileNotFoundError:
+                    self.mkdir(current, mode)
+                    continue
+                if not isinstance(node, Directory):
+                    raise error(errno.ENOTDIR, current)
+
+    def listdir(self, path: str = '/') -> typing.List[str]:
+        with self.lock:
+            node = self.__node(path)
+            if not isinstance(node, Directory):
+                raise error(errno.ENOTDIR, path)
+            return sorted(node.entries)
+
+    def write_file(self, path: str, data: bytes, mode: int = 0o644):
+        with self.lock:
+            self.makedirs(posixpath.dirname(posixpath.normpath('/' + path)))
+            fd = self.open(path, self.O_WRONLY | self.O_CREAT | self.O_TRUNC, mode)
+            try:
+                self.write(fd, data)
+            finally:
+                self.close(fd)
+
+    def read_file(self, path: str) -> bytes:
+        with self.lock:
+            node = self.__node(path)
+            if not isinstance(node, File):
+                raise error(errno.EISDIR if isinstance(node, Directory) else errno.EINVAL, path)
+            return bytes(node.data)
+
+    # copies a directory of the host into prefix, symlinks are kept as they are
+    def load_directory(self, source: str, prefix: str = '/'):
+        with self.lock:
+            self.makedirs(prefix)
+            for root, dirs, files in os.walk(source):
+                target_root = posixpath.join(prefix, os.path.relpath(root, source).replace(os.sep, '/'))
+                for name in dirs + files:
+                    path = os.path.join(root, name)
+                    target = posixpath.normpath(posixpath.join(target_root, name))
+                    if os.path.islink(path):
+                        self.symlink(os.readlink(path), target)
+                    elif os.path.isdir(path):
+                        self.makedirs(target, stat.S_IMODE(os.stat(path).st_mode))
+                    else:
+                        with open(path, 'rb') as f:
+                            self.write_file(target, f.read(), stat.S_IMODE(os.stat(path).st_mode))
+            self.mark()
+
+    def load_tar(self, source: typing.Union[str, typing.BinaryIO], prefix: str = '/'):
+        with self.lock, (tarfile.open(source) if isinstance(source, str) else tarfile.open(fileobj=source)) as tar:
+            self.makedirs(prefix)
+            for member in tar.getmembers():
+                target = posixpath.normpath(posixpath.join(prefix, member.name))
+                if member.isdir():
+                    self.makedirs(target, member.mode)
+                    continue
+
+                self.makedirs(posixpath.dirname(target))
+                if member.issym():
+                    self.symlink(member.linkname, target)
+                elif member.islnk():
+                    self.link(posixpath.join(prefix, member.linkname), target)
+                elif member.isfile():
+                    self.write_file(target, tar.extractfile(member).read(), member.mode)
+            self.mark()
+
+    # path -> contents of all files & the targets of all symlinks
+    def snapshot(self) -> typing.Dict[str, typing.Union[bytes, str]]:
+        with self.lock:
+            result = {}
+            pending = [('', self.root)]
+            while pending:
+                path, directory = pending.pop()
+                for name, node in directory.entries.items():
+                    if isinstance(node, Directory):
+                        pending.append((path + '/' + name, node))
+                    elif isinstance(node, Symlink):
+                        result[path + '/' + name] = node.target
+                    else:
+                        result[path + '/' + name] = bytes(node.data)
+            return result
+
+    # the state changes() compares against, set by the load functions
+    def mark(self):
+        self.baseline = self.snapshot()
+
+    @staticmethod
+    def diff(before: typing.Dict[str, typing.Union[bytes, str]], after: typing.Dict[str, typing.Union[bytes, str]]) \
+            -> typing.Dict[str, typing.List[str]]:
+        return {
+            'added':    sorted(path for path in after if path not in before),
+            'removed':  sorted(path for path in before if path not in after),
+            'modified': sorted(path for path in after if path in before and before[path] != after[path]),
+        }
+
+    def changes(self) -> typing.Dict[str, typing.List[str]]:
+        return self.diff(self.baseline, self.snapshot())
+
+    # writes the files added or modified since mark into a host directory
+    def export(self, directory: str, changed_only: bool = True):
+        with self.lock:
+            snapshot = self.snapshot()
+            changes = self.diff(self.baseline, snapshot)
+            paths = changes['added'] + changes['modified'] if changed_only else sorted(snapshot)
+            for path in paths:
+                target = os.path.join(directory, *path.strip('/').split('/'))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if isinstance(snapshot[path], str):
+                    if os.path.lexists(target):
+                        os.unlink(target)
+                    os.symlink(snapshot[path], target)
+                else:
+                    with open(target, 'wb') as f:
+                        f.write(snapshot[path])
@@ -30,6 +30,7 @@ setup(
     entry_points={
         'console_scripts': ['metal-serial-generate=metal.serial.generate:main',
                             'metal-serial-interpret=metal.serial.interpret:main',
+                            'metal-serial-run=metal.serial.run:main',
                             'metal-flags=metal.flags:print_flags']
     },
     license='APACHE',
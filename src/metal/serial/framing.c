@@ -0,0 +1,81 @@
+/**
+ * @file   framing.c
+ * @date   18.10.2026
+ *
+ * Framed output for METAL_SERIAL_FRAMED, every frame is sent as
+ *
+ *   0xA5 0x5A, length, sequence, message offset, payload[length], crc16 (little endian)
+ *
+ * The message offset is the position of the first message starting in the payload or 0xFF if there's none,
+ * the CRC (CCITT, initial value 0xFFFF) covers everything after the two sync bytes.
+ */
+
+#include <metal/serial/core.h>
+
+#if !defined(METAL_SERIAL_FRAME_SIZE)
+#define METAL_SERIAL_FRAME_SIZE 128
+#endif
+
+#if METAL_SERIAL_FRAME_SIZE > 255
+#error "METAL_SERIAL_FRAME_SIZE can't exceed 255"
+#endif
+
+#define METAL_SERIAL_NO_MESSAGE 0xFFu
+
+static char metal_serial_frame[METAL_SERIAL_FRAME_SIZE];
+static unsigned int metal_serial_frame_length = 0u;
+static unsigned char metal_serial_frame_sequence = 0u;
+static unsigned char metal_serial_frame_message_offset = METAL_SERIAL_NO_MESSAGE;
+
+static unsigned int metal_serial_frame_crc(unsigned int crc, char value)
+{
+    unsigned int bit;
+    crc ^= ((unsigned int)(unsigned char)value) << 8u;
+    for (bit = 0u; bit < 8u; bit++)
+        crc = (crc & 0x8000u) ? ((crc << 1u) ^ 0x1021u) : (crc << 1u);
+    return crc & 0xFFFFu;
+}
+
+static unsigned int metal_serial_frame_send(unsigned int crc, char value)
+{
+    metal_serial_write(value);
+    return metal_serial_frame_crc(crc, value);
+}
+
+void metal_serial_frame_flush()
+{
+    unsigned int idx;
+    unsigned int crc = 0xFFFFu;
+
+    if (metal_serial_frame_length == 0u)
+        return;
+
+    metal_serial_write((char)0xA5);
+    metal_serial_write((char)0x5A);
+    crc = metal_serial_frame_send(crc, (char)metal_serial_frame_length);
+    crc = metal_serial_frame_send(crc, (char)metal_serial_frame_sequence);
+    crc = metal_serial_frame_send(crc, (char)metal_serial_frame_message_offset);
+    for (idx = 0u; idx < metal_serial_frame_length; idx++)
+        crc = metal_serial_frame_send(crc, metal_serial_frame[idx]);
+    metal_serial_write((char)(crc & 0xFFu));
+    metal_serial_write((char)(crc >> 8u));
+
+    metal_serial_frame_sequence++;
+    metal_serial_frame_length = 0u;
+    metal_serial_frame_message_offset = METAL_SERIAL_NO_MESSAGE;
+}
+
+void metal_serial_frame_put(char value)
+{
+    if (metal_serial_frame_length == METAL_SERIAL_FRAME_SIZE)
+        metal_serial_frame_flush();
+    metal_serial_frame[metal_serial_frame_length++] = value;
+}
+
+void metal_serial_frame_message()
+{
+    if (metal_serial_frame_length == METAL_SERIAL_FRAME_SIZE)
+        metal_serial_frame_flush();
+    if (metal_serial_frame_message_offset == METAL_SERIAL_NO_MESSAGE)
+        metal_serial_frame_message_offset = (unsigned char)metal_serial_frame_length;
+}
@@ -198,7 +198,7 @@ int _unlink(char* name)
 int _lseek(int file, int ptr, int dir)
 {
 #if (METAL_SERIAL_SYSCALLS_MODE == METAL_SERIAL_SYSCALLS_MODE_FULL) || __PCPP_ALWAYS_TRUE__
-    METAL_SERIAL_SYSCALL(unlink);
+    METAL_SERIAL_SYSCALL(lseek);
 
     METAL_SERIAL_WRITE_INT(file);
     METAL_SERIAL_WRITE_INT(ptr);
@@ -0,0 +1,65 @@
+import argparse
+import asyncio
+
+from metal.serial import AsyncEngine
+
+from metal.serial.generate import generate
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('binary',           help='The binary that runs on target')
+parser.add_argument('-S', '--source-dir',  required=True, help='The root of the source directory')
+parser.add_argument('-I', '--include', nargs='+', help="Include folders for the preprocessor", default=[])
+parser.add_argument('-D', '--define', nargs='+', help="Defines for the preprocessor", default=[])
+
+args = parser.parse_args()
+
+serial_info = generate(args.binary, args.define, args.include)
+
+
+# the second half runs in a worker thread, like a plain MacroHook would
+def blocking_part(engine):
+    engine.write_int(11)
+    assert engine.read_int() == 33
+
+    assert engine.write_string("overflow") == 6
+    assert engine.read_string() == "erfl"
+
+    engine.write_int(4)
+    assert engine.read_int() == 16
+
+    assert engine.write_memory(b'\x00\x01\x02\x03\x04') == 4
+    assert engine.read_memory() == b'\x03\x02\x01\x00'
+
+
+async def session():
+    p = await asyncio.create_subprocess_exec(args.binary, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+    engine = AsyncEngine(serial_info, p.stdout, p.stdin)
+    await engine.handshake()
+
+    assert engine.init_marker.file.endswith('write.c')
+    assert engine.init_marker.line == 25
+
+    engine.write_byte(b'0')
+    assert await engine.read_byte() == b'9'
+
+    engine.write_int(22)
+    assert await engine.read_int() == 44
+
+    assert await engine.write_string("str") == 3
+    assert await engine.read_string() == "tr"
+
+    await engine.run_sync(blocking_part)
+
+    assert await engine.write_memory(b'1234567890') == 4
+    assert await engine.read_memory() == b'1234'
+
+    exit_code = await engine.run()
+    await p.wait()
+    return exit_code
+
+
+async def main():
+    return await asyncio.wait_for(asyncio.gather(*[session() for _ in range(8)]), 30)
+
+assert asyncio.run(main()) == [123] * 8
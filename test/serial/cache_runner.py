@@ -0,0 +1,64 @@
+import argparse
+import json
+import os
+import tempfile
+
+from metal.serial import default_hooks
+from metal.serial.cache import SerialInfoCache, hash_file
+from metal.serial.generate import generate
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('binary',           help='The binary that runs on target')
+parser.add_argument('-S', '--source-dir',  required=True, help='The root of the source directory')
+parser.add_argument('-I', '--include', nargs='+', help="Include folders for the preprocessor", default=[])
+parser.add_argument('-D', '--define', nargs='+', help="Defines for the preprocessor", default=[])
+
+args = parser.parse_args()
+
+source = os.path.join(os.path.abspath(args.source_dir), 'unit.c')
+
+with tempfile.TemporaryDirectory() as tmp:
+    cache = SerialInfoCache(os.path.join(tmp, 'cache'))
+    serial_info = generate(args.binary, args.define, args.include, cache=cache)
+
+    # the entry depends on the compile unit's source and the headers it included
+    key = SerialInfoCache.key(args.binary, args.define, args.include, [hook.identifier for hook in default_hooks])
+    with open(cache.entry_path(key)) as f:
+        dependencies = json.load(f)['dependencies']
+    assert dependencies[source] == hash_file(source)
+    assert any(path.endswith(os.path.join('metal', 'serial', 'core.h')) for path in dependencies)
+
+    # a hit returns the same data
+    cached = cache.load(key)
+    assert cached is not None
+    assert cached.to_dict() == serial_info.to_dict()
+    assert generate(args.binary, args.define, args.include, cache=cache).to_dict() == serial_info.to_dict()
+
+    # editing a header the entry depends on makes it a miss
+    header = os.path.join(tmp, 'header.h')
+    with open(header, 'w') as f:
+        f.write('#define VALUE 1\n')
+    cache.store('edited', serial_info, [header, source])
+    assert cache.load('edited') is not None
+    with open(header, 'w') as f:
+        f.write('#define VALUE 2\n')
+    assert cache.load('edited') is None
+
+    # damaged entries are misses, not errors
+    for content in ['', '[]', '{}', '{"dependencies": {}}', '{"dependencies": [], "serial_info": {}}', '{"dependencies": {}, "serial_info": {}}']:
+        with open(cache.entry_path('damaged'), 'w') as f:
+            f.write(content)
+        assert cache.load('damaged') is None, content
+
+    # the least recently used entries get evicted beyond max_size
+    small = SerialInfoCache(os.path.join(tmp, 'small'))
+    for i, name in enumerate(['a', 'b', 'c']):
+        small.store(name, serial_info, [])
+        os.utime(small.entry_path(name), (i, i))
+    entry_size = os.path.getsize(small.entry_path('a'))
+
+    assert small.load('a') is not None  # used, so now the most recent one
+    small.max_size = entry_size * 2
+    small.evict()
+    assert sorted(os.listdir(small.directory)) == sorted(os.path.basename(small.entry_path(name)) for name in ['a', 'c'])
@@ -0,0 +1,62 @@
+import argparse
+import io
+
+from metal.serial import Engine, Exit
+from subprocess import PIPE, Popen
+
+from metal.serial.generate import generate
+from metal.serial.framing import frame_sync, header_struct
+from metal.serial.unit import Unit
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('binary',           help='The binary that runs on target')
+parser.add_argument('-S', '--source-dir',  required=True, help='The root of the source directory')
+parser.add_argument('-I', '--include', nargs='+', help="Include folders for the preprocessor", default=[])
+parser.add_argument('-D', '--define', nargs='+', help="Defines for the preprocessor", default=[])
+
+args = parser.parse_args()
+
+serial_info = generate(args.binary, args.define, args.include)
+
+p = Popen(args.binary, stdin=PIPE, stdout=PIPE, close_fds=True)
+data, _ = p.communicate()
+
+assert data.startswith(frame_sync)
+
+engine = Engine(input=io.BufferedReader(io.BytesIO(data)), serial_info=serial_info, macro_hooks=[Exit, Unit])
+assert engine.init_marker.file.endswith('unit.c')
+assert engine.run() == 0
+assert engine.gaps == []
+
+# find the frame boundaries, to damage some in the middle of the session
+frames = []
+offset = 0
+while offset < len(data):
+    frames.append(offset)
+    offset += header_struct.size + data[offset + 2] + 2
+assert offset == len(data)
+
+middle = frames[len(frames) // 2]
+
+corrupted = bytearray(data)
+corrupted[middle + header_struct.size] ^= 0xFF
+engine = Engine(input=io.BufferedReader(io.BytesIO(bytes(corrupted))), serial_info=serial_info, macro_hooks=[Exit, Unit])
+assert engine.run() == 0
+assert len(engine.gaps) == 1
+assert engine.gaps[0].lost_frames == 1
+
+dropped = data[:middle] + data[frames[len(frames) // 2 + 2]:]
+engine = Engine(input=io.BufferedReader(io.BytesIO(dropped)), serial_info=serial_info, macro_hooks=[Exit, Unit])
+assert engine.run() == 0
+assert len(engine.gaps) == 1
+assert engine.gaps[0].lost_frames == 2
+assert engine.gaps[0].skipped_bytes == 0
+
+# noise between consecutive frames, including a false sync, costs no data
+noise = b'\x00\x13\xA5\x00\xA5\x5A\x01\x07\x00'
+noisy = data[:middle] + noise + data[middle:]
+engine = Engine(input=io.BufferedReader(io.BytesIO(noisy)), serial_info=serial_info, macro_hooks=[Exit, Unit])
+assert engine.run() == 0
+assert engine.gaps == []
+assert engine.skipped_bytes == len(noise)
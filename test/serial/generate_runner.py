@@ -0,0 +1,47 @@
+import argparse
+import json
+
+import itanium_demangler
+
+from metal.serial import elfreader
+from metal.serial.elfreader import Symbol
+from metal.serial.generate import generate
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('binary',           help='The binary that runs on target')
+parser.add_argument('-S', '--source-dir',  required=True, help='The root of the source directory')
+parser.add_argument('-I', '--include', nargs='+', help="Include folders for the preprocessor", default=[])
+parser.add_argument('-D', '--define', nargs='+', help="Defines for the preprocessor", default=[])
+
+args = parser.parse_args()
+
+# symbols are demangled on first access only, and just once
+demangled = []
+demangle = elfreader.demangle
+elfreader.demangle = lambda name: demangled.append(name) or demangle(name)
+
+symbol = Symbol('_ZN3foo3barEi', 0x1000, 'T')
+assert demangled == []
+assert symbol.demangled_name == str(itanium_demangler.parse('_ZN3foo3barEi')) == 'foo::bar(int)'
+assert symbol.demangled_name == 'foo::bar(int)'
+assert demangled == ['_ZN3foo3barEi']
+assert Symbol('_ZN3foo3barEi', 0x1000, 'T', 'given').demangled_name == 'given'
+
+# generating doesn't demangle anything, unless the names get written
+full = generate(args.binary, args.define, args.include, symbols='all')
+assert demangled == ['_ZN3foo3barEi']
+assert all('demangled_name' not in symbol for symbol in full.to_dict()['symbols'])
+assert all('demangled_name' in symbol for symbol in full.to_dict(True)['symbols'])
+assert len(demangled) > 1
+elfreader.demangle = demangle
+
+serial_info = generate(args.binary, args.define, args.include, jobs=1, symbols='all')
+
+# the binary has more than one compile unit with markers, so the pool actually gets used
+assert len({marker.file for marker in serial_info.markers}) > 1
+
+# preprocessing on a pool produces exactly what a serial run does
+for jobs in [2, 0]:
+    parallel = generate(args.binary, args.define, args.include, jobs=jobs, symbols='all')
+    assert json.dumps(parallel.to_dict()) == json.dumps(serial_info.to_dict())
@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from metal.serial import Engine, Exit
+from subprocess import PIPE, Popen
+
+from metal.serial.binary_format import write_binary
+from metal.serial.generate import generate
+
+from metal.serial.newlib import build_newlib_hook
+from metal.serial.replay import TARGET, CaptureReader, CaptureWriter
+from metal.vfs import VirtualFileSystem
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('binary',           help='The binary that runs on target')
+parser.add_argument('-S', '--source-dir',  required=True, help='The root of the source directory')
+parser.add_argument('-I', '--include', nargs='+', help="Include folders for the preprocessor", default=[])
+parser.add_argument('-D', '--define', nargs='+', help="Defines for the preprocessor", default=[])
+
+args = parser.parse_args()
+
+serial_info = generate(args.binary, args.define, args.include)
+
+
+def interpret(cwd, *options, stdin=None):
+    return subprocess.run([sys.executable, '-c', 'from metal.serial.interpret import main; main()', '-S', info_path] + list(options),
+                          cwd=cwd, stdin=stdin, stdout=PIPE, env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    info_path = os.path.join(tmp, 'serial-info')
+    with open(info_path, 'wb') as f:
+        write_binary(serial_info, f)
+
+    # a live session writing into test-file, recording what the target sent
+    vfs = VirtualFileSystem()
+    vfs.write_file('test-file', b'')
+    capture = os.path.join(tmp, 'session.cap')
+    p = Popen(args.binary, stdin=PIPE, stdout=PIPE, close_fds=True)
+    with CaptureWriter(open(capture, 'wb')) as recorder:
+        engine = Engine(input=p.stdout, output=p.stdin, serial_info=serial_info,
+                        macro_hooks=[Exit, build_newlib_hook(vfs)], recorder=recorder)
+        assert engine.init_marker.file.endswith('newlib_unchecked.c')
+        assert engine.run() == 0
+    assert vfs.read_file('test-file') == b'Writing to fd_\n'
+
+    log = os.path.join(tmp, 'target.log')
+    with open(log, 'wb') as f:
+        f.write(b''.join(record.data for record in CaptureReader(capture).records() if record.direction == TARGET))
+
+
+    def decode(*options, stdin=None):
+        cwd = tempfile.mkdtemp(dir=tmp)
+        with open(os.path.join(cwd, 'test-file'), 'wb'):
+            pass
+        p = interpret(cwd, *options, stdin=stdin)
+        assert p.returncode == 0
+        assert p.stdout.startswith(b'Writing stdout\n')
+        assert os.listdir(cwd) == ['test-file']
+        with open(os.path.join(cwd, 'test-file'), 'rb') as f:
+            return f.read()
+
+
+    # decoding the log offline, from a file or from stdin, doesn't repeat the file operations on the host
+    assert decode('-I', log) == b''
+    with open(log, 'rb') as stdin:
+        assert decode(stdin=stdin) == b''
+    # unless asked to
+    assert decode('-I', log, '--host-files') == b'Writing to fd_\n'
+
+    # in memory, starting from a directory and reporting what the session changed
+    files = os.path.join(tmp, 'files')
+    os.mkdir(files)
+    with open(os.path.join(files, 'test-file'), 'wb'):
+        pass
+    export = os.path.join(tmp, 'export')
+    diff = os.path.join(tmp, 'diff.json')
+    assert decode('-I', log, '--vfs-load', files, '--vfs-diff', diff, '--vfs-export', export) == b''
+    with open(diff) as f:
+        assert json.load(f) == {'added': [], 'removed': [], 'modified': ['/test-file']}
+    assert os.listdir(export) == ['test-file']
+    with open(os.path.join(export, 'test-file'), 'rb') as f:
+        assert f.read() == b'Writing to fd_\n'
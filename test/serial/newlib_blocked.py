@@ -1,12 +1,13 @@
 import argparse
 import os
+import time
 
 from metal.serial import Engine, Exit
 from subprocess import PIPE, Popen
 
 from metal.serial.generate import generate
 
-from metal.serial.newlib import build_newlib_hook
+from metal.serial.newlib import WriteCoalescer, build_newlib_hook
 
 parser = argparse.ArgumentParser()
 
@@ -46,4 +47,40 @@ engine = Engine(input=p.stdout, output=p.stdin, serial_info=serial_info,
 
 assert engine.init_marker.file.endswith('newlib_blocked.c')
 assert engine.run() == 0
-assert oss.cnt == 2
\ No newline at end of file
+assert oss.cnt == 2
+
+# the target's output is written out before any other hook runs, so it stays in order with what that hook prints
+class CheckedExit(Exit):
+    def invoke(self, engine, macro_expansion):
+        assert oss.cnt == 2
+        super().invoke(engine, macro_expansion)
+
+
+oss = os_stub()
+p = Popen(args.binary, stdin=PIPE, stdout=PIPE, close_fds=True)
+engine = Engine(input=p.stdout, output=p.stdin, serial_info=serial_info,
+                macro_hooks=[CheckedExit, build_newlib_hook(oss)])
+assert engine.run() == 0
+assert oss.cnt == 2
+
+
+# buffered writes go out after the interval, even if nothing else happens
+class pipe_stub:
+    def __init__(self):
+        self.written = []
+
+    def isatty(self, fd):
+        return False
+
+    def write(self, fd, data):
+        self.written.append((fd, data))
+        return len(data)
+
+
+pipe = pipe_stub()
+writes = WriteCoalescer(pipe, interval=0.05)
+writes.write(1, b'held ')
+writes.write(1, b'back\n')
+assert pipe.written == []
+time.sleep(0.5)
+assert pipe.written == [(1, b'held back\n')]
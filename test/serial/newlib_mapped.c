@@ -0,0 +1,89 @@
+/**
+ * @file   newlib_mapped.c
+ * @date   18.10.2026
+ *
+ * Runs against the host's file system, in a directory containing input.bin with 3000 bytes of i % 251.
+ */
+
+#include <metal/serial/core.h>
+#include <metal/serial/syscalls.h>
+#include <stdio.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <errno.h>
+#include <assert.h>
+
+// the hooks expect the flags of newlib, not the ones of the host's libc
+#define NEWLIB_O_RDONLY 0x0000
+
+#define INPUT_SIZE 3000
+
+int _open (char* file, int flags, int mode);
+int _read (int file, char* ptr, int len);
+int _write(int file, char* ptr, int len);
+int _lseek(int file, int ptr, int dir);
+int _close(int);
+
+char metal_serial_read() { return fgetc(stdin);}
+void metal_serial_write(char c) { fputc(c, stdout);}
+
+
+int main(int argc, char ** args)
+{
+    freopen(NULL, "rb", stdin);
+    freopen(NULL, "wb", stdout);
+
+    setvbuf(stdin, NULL, _IONBF, 0);
+    setvbuf(stdout, NULL, _IONBF, 0);
+
+    METAL_SERIAL_INIT();
+
+    char buf[100];
+
+    // the first file read goes through the target's read buffer
+    int fd = _open("input.bin", NEWLIB_O_RDONLY, 0);
+    assert(fd >= 3);
+
+    int total = 0;
+    int len;
+    while ((len = _read(fd, buf, sizeof(buf))) > 0)
+    {
+        for (int i = 0; i < len; i++)
+            assert((unsigned char)buf[i] == (total + i) % 251);
+        total += len;
+    }
+    assert(len == 0);
+    assert(total == INPUT_SIZE);
+
+    // any other one is read directly
+    int fd2 = _open("input.bin", NEWLIB_O_RDONLY, 0);
+    assert(fd2 > fd);
+
+    assert(_read(fd2, buf, 10) == 10);
+    assert(buf[9] == 9);
+    assert(_lseek(fd2, 0, SEEK_CUR) == 10);
+    assert(_lseek(fd2, 0, SEEK_END) == INPUT_SIZE);
+    assert(_read(fd2, buf, 10) == 0);
+
+    assert(_lseek(fd2, INPUT_SIZE - 5, SEEK_SET) == INPUT_SIZE - 5);
+    assert(_read(fd2, buf, 10) == 5);
+    assert((unsigned char)buf[4] == (INPUT_SIZE - 1) % 251);
+
+    assert(_lseek(fd2, 300, SEEK_SET) == 300);
+    assert(_read(fd2, buf, 1) == 1);
+    assert((unsigned char)buf[0] == 300 % 251);
+
+    // the file is read only, the position is handed back to the host fd before the write fails
+    errno = 0;
+    assert(_write(fd2, buf, 2) == -1); // single bytes get buffered
+    assert(errno == EBADF);
+    assert(_lseek(fd2, 0, SEEK_CUR) == 301);
+    assert(_read(fd2, buf, 1) == 1);
+    assert((unsigned char)buf[0] == 301 % 251);
+
+    assert(_close(fd2) == 0);
+    assert(_close(fd) == 0);
+
+    METAL_SERIAL_EXIT(0);
+    return 0;
+}
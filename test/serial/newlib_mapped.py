@@ -0,0 +1,66 @@
+import argparse
+import os
+import tempfile
+
+from metal.serial import Engine, Exit
+from subprocess import PIPE, Popen
+
+from metal.serial.generate import generate
+
+from metal.newlib import MappedReads
+from metal.serial.newlib import build_newlib_hook
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('binary',           help='The binary that runs on target')
+parser.add_argument('-S', '--source-dir',  required=True, help='The root of the source directory')
+parser.add_argument('-I', '--include', nargs='+', help="Include folders for the preprocessor", default=[])
+parser.add_argument('-D', '--define', nargs='+', help="Defines for the preprocessor", default=[])
+
+args = parser.parse_args()
+
+serial_info = generate(args.binary, args.define, args.include)
+
+
+# forwards to os, counting the reads that didn't come from a mapping
+class counting_os:
+    def __init__(self):
+        self.reads = 0
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+    def read(self, fd, n):
+        self.reads += 1
+        return os.read(fd, n)
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    with open(os.path.join(tmp, 'input.bin'), 'wb') as f:
+        f.write(bytes(i % 251 for i in range(3000)))
+
+    # the host opens the files, relative to its own working directory
+    binary = os.path.abspath(args.binary)
+    os.chdir(tmp)
+
+    oss = counting_os()
+    p = Popen(binary, stdin=PIPE, stdout=PIPE, close_fds=True)
+    engine = Engine(input=p.stdout, output=p.stdin, serial_info=serial_info,
+                    macro_hooks=[Exit, build_newlib_hook(oss, map_reads=True)])
+
+    assert engine.init_marker.file.endswith('newlib_mapped.c')
+    assert engine.run() == 0
+    # only the read after the failed write goes to the fd
+    assert oss.reads == 1
+
+    # closing must not fail while a slice handed out by read is still alive
+    reads = MappedReads()
+    for finish in (reads.close, reads.release):
+        fd = os.open('input.bin', os.O_RDONLY)
+        reads.open(fd, os.O_RDONLY)
+        chunk = reads.read(fd, 100)
+        finish(fd)
+        assert chunk == bytes(range(100))
+        if finish == reads.release:
+            assert os.lseek(fd, 0, os.SEEK_CUR) == 100
+        os.close(fd)
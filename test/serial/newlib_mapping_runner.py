@@ -0,0 +1,139 @@
+import errno
+import os
+import random
+import stat
+
+from metal.newlib import Flags, errno_codes, map_errno, map_file_mode, map_open_flags, map_seek_flags
+from metal.vfs import VirtualFileSystem
+
+
+# The translations as they were done on every call before they got compiled into tables, as the reference.
+
+def reference_file_mode(value, from_=Flags, to=stat):
+    out = 0
+    if value & from_.S_IRWXU:  out |= to.S_IREAD | to.S_IWRITE
+    if value & from_.S_IRUSR:  out |= to.S_IREAD
+    if value & from_.S_IWUSR:  out |= to.S_IWRITE
+    if value & from_.S_IREAD:  out |= to.S_IREAD
+    if value & from_.S_IWRITE: out |= to.S_IWRITE
+    if value & from_.S_IRWXU:  out |= to.S_IRWXU
+    if value & from_.S_IRUSR:  out |= to.S_IRUSR
+    if value & from_.S_IWUSR:  out |= to.S_IWUSR
+    if value & from_.S_IXUSR:  out |= to.S_IXUSR
+    if value & from_.S_IRWXG:  out |= to.S_IRWXG
+    if value & from_.S_IRGRP:  out |= to.S_IRGRP
+    if value & from_.S_IWGRP:  out |= to.S_IWGRP
+    if value & from_.S_IXGRP:  out |= to.S_IXGRP
+    if value & from_.S_IRWXO:  out |= to.S_IRWXO
+    if value & from_.S_IROTH:  out |= to.S_IROTH
+    if value & from_.S_IWOTH:  out |= to.S_IWOTH
+    if value & from_.S_IXOTH:  out |= to.S_IXOTH
+    if value & from_.S_ISUID:  out |= to.S_ISUID
+    if value & from_.S_ISGID:  out |= to.S_ISGID
+    if value & from_.S_ISVTX:  out |= to.S_ISVTX
+    if value & from_.S_IEXEC:  out |= to.S_IEXEC
+    if value & from_.S_ENFMT:  out |= to.S_ENFMT
+    if value & from_.S_IFMT:   out |= to.S_IFMT
+    if value & from_.S_IFDIR:  out |= to.S_IFDIR
+    if value & from_.S_IFCHR:  out |= to.S_IFCHR
+    if value & from_.S_IFBLK:  out |= to.S_IFBLK
+    if value & from_.S_IFREG:  out |= to.S_IFREG
+    if value & from_.S_IFLNK:  out |= to.S_IFLNK
+    if value & from_.S_IFSOCK: out |= to.S_IFSOCK
+    if value & from_.S_IFIFO:  out |= to.S_IFIFO
+    return out
+
+
+def reference_seek_flags(value, from_=Flags, to=os):
+    out = 0
+    if value & from_.SEEK_SET: out |= to.SEEK_SET
+    if value & from_.SEEK_CUR: out |= to.SEEK_CUR
+    if value & from_.SEEK_END: out |= to.SEEK_END
+    return out
+
+
+def reference_open_flags(value, from_=Flags, to=os):
+    out = 0
+    if hasattr(to, "O_BINARY"): out |= to.O_BINARY
+    if value & from_.O_APPEND   : out |= to.O_APPEND
+    if value & from_.O_CREAT    : out |= to.O_CREAT
+    if value & from_.O_EXCL     : out |= to.O_EXCL
+    if value & from_.O_RDONLY   : out |= to.O_RDONLY
+    if value & from_.O_WRONLY   : out |= to.O_WRONLY
+    if value & from_.O_RDWR     : out |= to.O_RDWR
+    if value & from_.O_NOCTTY   : out |= to.O_NOCTTY
+    if value & from_.O_NONBLOCK : out |= to.O_NONBLOCK
+    if value & from_.O_SYNC     : out |= to.O_SYNC
+    if value & from_.O_CLOEXEC  : out |= to.O_CLOEXEC
+    if value & from_.O_DIRECT   : out |= to.O_DIRECT
+    if value & from_.O_DIRECTORY: out |= to.O_DIRECTORY
+    if value & from_.O_DSYNC    : out |= to.O_DSYNC
+    if value & from_.O_NOATIME  : out |= to.O_NOATIME
+    if value & from_.O_NDELAY   : out |= to.O_NDELAY
+    if value & from_.O_PATH     : out |= to.O_PATH
+    if value & from_.O_TRUNC    : out |= to.O_TRUNC
+    return out
+
+
+def reference_errno(value, from_=Flags, to=errno):
+    try:
+        ec = next(ec for ec in errno_codes if hasattr(from_, ec) and value == getattr(from_, ec))
+        if not hasattr(to, ec):
+            return to.EBADMSG
+        return getattr(to, ec)
+    except StopIteration:
+        return to.EBADMSG
+
+
+# bits the target module has no (integer) constant for fail, for both
+def outcome(function, *args):
+    try:
+        return function(*args)
+    except (AttributeError, TypeError) as e:
+        return type(e)
+
+
+def same(mapped, reference, values, *args):
+    for value in values:
+        assert outcome(mapped, value, *args) == outcome(reference, value, *args), (mapped.__name__, value)
+
+
+rng = random.Random(0)
+bits = [1 << i for i in range(32)]
+combinations = [0, 0xFFFFFFFF] + bits + [rng.getrandbits(32) for _ in range(2000)]
+
+
+# a target module that lacks some of the names, like the os of another platform
+class partial_os:
+    O_APPEND = os.O_APPEND
+    O_CREAT  = os.O_CREAT
+    O_EXCL   = os.O_EXCL
+    O_RDONLY = os.O_RDONLY
+    O_WRONLY = os.O_WRONLY
+    O_RDWR   = os.O_RDWR
+    O_TRUNC  = os.O_TRUNC
+    O_BINARY = 0x8000
+
+
+class partial_errno:
+    EPERM   = 101
+    ENOENT  = 102
+    EBADMSG = 199
+
+
+# every combination twice, the second time from the cache
+for _ in range(2):
+    same(map_file_mode, reference_file_mode, list(range(0o200000)) + combinations)
+    same(map_file_mode, reference_file_mode, combinations, Flags, VirtualFileSystem)
+    same(map_seek_flags, reference_seek_flags, range(8))
+    same(map_open_flags, reference_open_flags, combinations)
+    same(map_open_flags, reference_open_flags, combinations, Flags, VirtualFileSystem)
+    same(map_open_flags, reference_open_flags, combinations, Flags, partial_os)
+    # unknown numbers, negative ones and the ones beyond the table included
+    same(map_errno, reference_errno, range(-5, 2100))
+    same(map_errno, reference_errno, range(-5, 2100), Flags, partial_errno)
+
+assert map_errno(Flags.ENOENT) == errno.ENOENT
+assert map_errno(12345) == errno.EBADMSG
+assert map_errno(Flags.EACCES, Flags, partial_errno) == partial_errno.EBADMSG
+assert map_open_flags(Flags.O_WRONLY | Flags.O_CREAT, Flags, partial_os) == os.O_WRONLY | os.O_CREAT | partial_os.O_BINARY
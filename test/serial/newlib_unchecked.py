@@ -46,7 +46,7 @@ class os_stub:
             assert msg == b"Writing stdout\n"
         if fd == 2:
             assert msg == b"Writing stderr\n"
-        if fd == 3:
+        if fd == 7:
             assert msg == b"Writing to fd_\n"
 
         self.write_cnt = self.write_cnt + 1
@@ -57,11 +57,12 @@ class os_stub:
         assert mode == 0
         self.open_cnt  = self.open_cnt + 1
 
-        self.fds.append(3)
-        return 3
+        # the host fd differs from the target's 3
+        self.fds.append(7)
+        return 7
 
     def close(self, fd):
-        assert fd == 3
+        assert fd == 7
         self.close_cnt = self.close_cnt + 1
 
 oss = os_stub()
@@ -71,4 +72,20 @@ engine = Engine(input=p.stdout, output=p.stdin, serial_info=serial_info,
 assert engine.init_marker.file.endswith('newlib_unchecked.c')
 assert engine.run() == 0
 assert oss.write_cnt == 3
-assert oss.open_cnt == 1
\ No newline at end of file
+assert oss.open_cnt == 1
+# the same on a background thread, exit waits for it
+oss = os_stub()
+p = Popen(args.binary, stdin=PIPE, stdout=PIPE, close_fds=True)
+engine = Engine(input=p.stdout, output=p.stdin, serial_info=serial_info,
+                macro_hooks=[Exit, build_newlib_hook(oss, background_writes=True)])
+
+assert engine.run() == 0
+assert oss.write_cnt == 3
+assert oss.open_cnt == 1
+assert oss.close_cnt == 1
+
+# the default hook is built per session, so sessions don't share pending writes or fds
+from metal.serial import newlib
+first, second = newlib.Syscall(), newlib.Syscall()
+assert type(first) is not type(second)
+assert first.identifier == second.identifier == newlib.Syscall.identifier
@@ -0,0 +1,94 @@
+/**
+ * @file   newlib_vfs.c
+ * @date   18.10.2026
+ *
+ * Runs against metal.vfs.VirtualFileSystem, preloaded with fixtures/input.txt containing "hello fixture\n".
+ */
+
+#include <metal/serial/core.h>
+#include <metal/serial/syscalls.h>
+#include <stdio.h>
+#include <string.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <errno.h>
+#include <assert.h>
+#include <sys/stat.h>
+
+// the hooks expect the flags of newlib, not the ones of the host's libc
+#define NEWLIB_O_RDONLY 0x0000
+#define NEWLIB_O_WRONLY 0x0001
+#define NEWLIB_O_CREAT  0x0200
+#define NEWLIB_O_TRUNC  0x0400
+#define NEWLIB_O_EXCL   0x0800
+
+int _open (char* file, int flags, int mode);
+int _read (int file, char* ptr, int len);
+int _write(int file, char* ptr, int len);
+int _close(int);
+int _isatty(int file);
+int _stat(const char* file, struct stat* st);
+int _fstat(int fd, struct stat* st);
+
+int _link(char* existing, char* _new);
+int _symlink(char* existing, char* _new);
+int _unlink(char* existing);
+
+char metal_serial_read() { return fgetc(stdin);}
+void metal_serial_write(char c) { fputc(c, stdout);}
+
+
+int main(int argc, char ** args)
+{
+    freopen(NULL, "rb", stdin);
+    freopen(NULL, "wb", stdout);
+
+    setvbuf(stdin, NULL, _IONBF, 0);
+    setvbuf(stdout, NULL, _IONBF, 0);
+
+    METAL_SERIAL_INIT();
+
+    char buf[32];
+    struct stat st;
+
+    int fd = _open("fixtures/input.txt", NEWLIB_O_RDONLY, 0);
+    assert(fd == 3);
+    assert(_read(fd, buf, 6) == 6);
+    assert(memcmp(buf, "hello ", 6) == 0);
+
+    assert(_fstat(fd, &st) == 0);
+    assert(st.st_size == 14);
+    assert(_isatty(fd) == 0);
+    assert(_close(fd) == 0);
+
+    errno = 0;
+    assert(_close(fd) != 0);
+    assert(errno == EBADF);
+
+    errno = 0;
+    assert(_open("missing.txt", NEWLIB_O_RDONLY, 0) == -1);
+    assert(errno == ENOENT);
+
+    int out = _open("results/out.txt", NEWLIB_O_WRONLY | NEWLIB_O_CREAT | NEWLIB_O_TRUNC, 0644);
+    assert(out == 3);
+    assert(_write(out, "result: 42\n", 11) == 11);
+    assert(_close(out) == 0);
+
+    errno = 0;
+    assert(_open("results/out.txt", NEWLIB_O_WRONLY | NEWLIB_O_CREAT | NEWLIB_O_EXCL, 0644) == -1);
+    assert(errno == EEXIST);
+
+    assert(_link("results/out.txt", "results/copy.txt") == 0);
+    assert(_symlink("results/out.txt", "latest.txt") == 0);
+    assert(_stat("latest.txt", &st) == 0);
+    assert(st.st_size == 11);
+
+    assert(_unlink("fixtures/input.txt") == 0);
+    errno = 0;
+    assert(_stat("fixtures/input.txt", &st) != 0);
+    assert(errno == ENOENT);
+
+    METAL_SERIAL_EXIT(0);
+
+    return 0;
+}
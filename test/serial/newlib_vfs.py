@@ -0,0 +1,60 @@
+import argparse
+import io
+import tarfile
+
+from metal.serial import Engine, Exit
+from subprocess import PIPE, Popen
+
+from metal.serial.generate import generate
+
+from metal.serial.newlib import build_newlib_hook
+from metal.vfs import VirtualFileSystem
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('binary',           help='The binary that runs on target')
+parser.add_argument('-S', '--source-dir',  required=True, help='The root of the source directory')
+parser.add_argument('-I', '--include', nargs='+', help="Include folders for the preprocessor", default=[])
+parser.add_argument('-D', '--define', nargs='+', help="Defines for the preprocessor", default=[])
+
+args = parser.parse_args()
+
+serial_info = generate(args.binary, args.define, args.include)
+
+fixtures = io.BytesIO()
+with tarfile.open(fileobj=fixtures, mode='w') as tar:
+    data = b'hello fixture\n'
+    info = tarfile.TarInfo('fixtures/input.txt')
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+    # relative links resolve from the directory they're in
+    data = b'42\n'
+    info = tarfile.TarInfo('fixtures/data/value.txt')
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+    for name, target in [('fixtures/value.txt', 'data/value.txt'), ('fixtures/data/again.txt', '../value.txt'), ('fixtures/current', 'data')]:
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.SYMTYPE
+        info.linkname = target
+        tar.addfile(info)
+fixtures.seek(0)
+
+vfs = VirtualFileSystem()
+vfs.load_tar(fixtures)
+vfs.makedirs('results')
+assert vfs.read_file('fixtures/value.txt') == b'42\n'
+assert vfs.read_file('fixtures/data/again.txt') == b'42\n'
+assert vfs.read_file('fixtures/current/value.txt') == b'42\n'
+vfs.mark()
+
+p = Popen(args.binary, stdin=PIPE, stdout=PIPE, close_fds=True)
+engine = Engine(input=p.stdout, output=p.stdin, serial_info=serial_info,
+                macro_hooks=[Exit, build_newlib_hook(vfs)])
+
+assert engine.init_marker.file.endswith('newlib_vfs.c')
+assert engine.run() == 0
+
+assert vfs.changes() == {'added': ['/latest.txt', '/results/copy.txt', '/results/out.txt'], 'removed': ['/fixtures/input.txt'], 'modified': []}
+assert vfs.read_file('results/copy.txt') == b'result: 42\n'
+assert vfs.stat('results/out.txt').st_nlink == 2
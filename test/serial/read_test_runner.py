@@ -1,9 +1,13 @@
 import argparse
+import json
+import os
+import tempfile
 
 from metal.serial import Engine
 from subprocess import PIPE, Popen
 
-from metal.serial.generate import generate
+from metal.serial.binary_format import MappedSerialInfo, load_serial_info, write_binary
+from metal.serial.generate import SerialInfo, generate
 
 parser = argparse.ArgumentParser()
 
@@ -14,7 +18,35 @@ parser.add_argument('-D', '--define', nargs='+', help="Defines for the preproces
 
 args = parser.parse_args()
 
-serial_info = generate(args.binary, args.define, args.include)
+serial_info = generate(args.binary, args.define, args.include, symbols='all')
+
+# the binary format has to load back the same markers, expansions & symbols as the JSON one, with and without tokens
+assert serial_info.markers and serial_info.expansions and serial_info.symbols
+expected = SerialInfo.from_dict(json.loads(json.dumps(serial_info.to_dict()))).to_dict()
+with tempfile.TemporaryDirectory() as tmp:
+    for tokens in [True, False]:
+        path = os.path.join(tmp, 'serial-info')
+        with open(path, 'wb') as f:
+            write_binary(serial_info, f, tokens=tokens)
+
+        loaded = load_serial_info(path)
+        assert isinstance(loaded, MappedSerialInfo)
+        assert loaded.has_tokens == tokens
+
+        actual = loaded.to_dict()
+        expected_expansions = expected['expansions'] if tokens else [dict(ex, args_tokenized=[]) for ex in expected['expansions']]
+        assert actual['metal_serial_write'] == expected['metal_serial_write']
+        assert actual['markers'] == expected['markers']
+        assert actual['expansions'] == expected_expansions
+        assert actual['symbols'] == expected['symbols']
+
+        for marker in serial_info.markers:
+            assert loaded.find_marker(marker.address).to_dict() == serial_info.find_marker(marker.address).to_dict()
+            expansion = serial_info.find_macro_expansion(marker)
+            assert (loaded.find_macro_expansion(marker) is None) == (expansion is None)
+            if expansion is not None:
+                assert loaded.find_macro_expansion(marker).args == expansion.args
+        del loaded
 
 p = Popen(args.binary, stdin=PIPE, stdout=PIPE, close_fds=True)
 engine = Engine(input=p.stdout, output=p.stdin, serial_info=serial_info)
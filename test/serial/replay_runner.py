@@ -0,0 +1,95 @@
+import argparse
+import io
+import os
+import tempfile
+
+from metal.serial import Engine, Exit
+from subprocess import PIPE, Popen
+
+from metal.serial.generate import generate
+
+from metal.serial.replay import CaptureReader, CaptureWriter, Replay, ReplayReporter, ReplyMismatch, VerifyingOutput
+from metal.serial.unit import Unit
+from metal.unit import Reporter
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('binary',           help='The binary that runs on target')
+parser.add_argument('-S', '--source-dir',  required=True, help='The root of the source directory')
+parser.add_argument('-I', '--include', nargs='+', help="Include folders for the preprocessor", default=[])
+parser.add_argument('-D', '--define', nargs='+', help="Defines for the preprocessor", default=[])
+
+args = parser.parse_args()
+
+serial_info = generate(args.binary, args.define, args.include)
+
+
+# answers every report, which the recording of the session never did
+class ReplyingUnit(Unit):
+    def invoke(self, engine, macro_expansion):
+        super().invoke(engine, macro_expansion)
+        engine.write_int(1)
+
+
+def replay(path, start=None, reporter=None, unit=Unit):
+    reporter = reporter or Reporter()
+    reporter.hrf_sink = io.StringIO()
+    capture = Replay(CaptureReader(path), start)
+    engine = Engine(input=capture.input, output=capture.output, serial_info=serial_info,
+                    macro_hooks=[Exit, lambda: unit(reporter)])
+    return engine.run(), reporter
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'session.cap')
+
+    # record a live session, with a small index interval so the lookups have to use it
+    live = Reporter()
+    live.hrf_sink = io.StringIO()
+    p = Popen(args.binary, stdin=PIPE, stdout=PIPE, close_fds=True)
+    with CaptureWriter(open(path, 'wb'), index_interval=16) as recorder:
+        engine = Engine(input=p.stdout, output=p.stdin, serial_info=serial_info,
+                        macro_hooks=[Exit, lambda: Unit(live)], recorder=recorder)
+        assert engine.init_marker.file.endswith('unit.c')
+        assert engine.run() == 0
+    messages = recorder.messages
+    assert messages > 40
+
+    reader = CaptureReader(path)
+    assert len(reader.index) == (messages + 15) // 16
+    assert [msg.number for msg in reader.messages()] == list(range(messages))
+
+    message = reader.find_message(40)
+    assert message.number == 40
+    assert reader.find_message(messages) is None
+    assert reader.find_time(message.timestamp).timestamp == message.timestamp
+    assert reader.find_time(0).number == 0
+
+    # from the start the replay reports exactly what the live session did
+    exit_code, reporter = replay(path)
+    assert exit_code == 0
+    assert reporter.main_scope.summary() == live.main_scope.summary()
+    assert reporter.hrf_sink.getvalue() == live.hrf_sink.getvalue()
+
+    # starting at message 40 only reports what came after it
+    exit_code, reporter = replay(path, message, ReplayReporter())
+    assert exit_code == 0
+    assert 0 < reporter.main_scope.executed < live.main_scope.executed
+    # the message lies within a test case the replay never saw the enter of
+    assert 'entered before the replay started' in reporter.hrf_sink.getvalue()
+
+    # a reply the recording doesn't have
+    try:
+        replay(path, unit=ReplyingUnit)
+        assert False, 'the reply should not match the recording'
+    except ReplyMismatch:
+        pass
+
+# recorded replies given separately
+output = VerifyingOutput(io.BytesIO(b'\x01\x2a\x01\x2b'))
+output.write(b'\x01\x2a')
+try:
+    output.write(b'\x01\x2c')
+    assert False, 'the reply should not match the recording'
+except ReplyMismatch:
+    pass
@@ -0,0 +1,57 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from metal.serial.run import Target, run, session_job
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('binaries', nargs='+',        help='The binaries that run on target')
+parser.add_argument('-S', '--source-dir',  required=True, help='The root of the source directory')
+parser.add_argument('-I', '--include', nargs='+', help="Include folders for the preprocessor", default=[])
+parser.add_argument('-D', '--define', nargs='+', help="Defines for the preprocessor", default=[])
+
+args = parser.parse_args()
+
+# every binary twice, the second session reuses the generated serial info
+targets = [Target(binary) for binary in args.binaries] * 2
+results = run(targets, args.define, args.include, jobs=4, timeout=60)
+
+summary = results['summary']
+assert summary['sessions'] == len(targets)
+assert summary['passed'] == len(targets)
+assert summary['failed'] == 0
+assert summary['executed'] == sum(result['report']['summary']['executed'] for result in results['sessions'])
+assert all(result['exit_code'] == 0 for result in results['sessions'])
+assert results['sessions'][0]['report'] == results['sessions'][len(args.binaries)]['report']
+
+with tempfile.TemporaryDirectory() as tmp:
+    output = os.path.join(tmp, 'results.json')
+    p = subprocess.run([sys.executable, '-c', 'from metal.serial.run import main; main()', '-j', '2', '-J', output, '-I'] + args.include +
+                       ['--'] + args.binaries, stdout=subprocess.PIPE)
+    assert p.returncode == 0
+    assert p.stdout.decode().splitlines()[-1].startswith('{0} of {0} sessions passed'.format(len(args.binaries)))
+    with open(output) as f:
+        assert json.load(f)['summary']['passed'] == len(args.binaries)
+
+    # a binary that can't be started fails its session, not the whole run
+    not_executable = os.path.join(tmp, 'not_executable')
+    with open(args.binaries[0], 'rb') as src, open(not_executable, 'wb') as dst:
+        dst.write(src.read())
+    os.chmod(not_executable, 0o644)
+
+    results = run([Target(not_executable), Target(args.binaries[0])], args.define, args.include, jobs=2, timeout=60)
+    failed, passed = results['sessions']
+    assert failed['exit_code'] is None and failed['error'].startswith('PermissionError')
+    assert passed['exit_code'] == 0 and passed['error'] is None
+    assert results['summary']['failed'] == 1
+
+    # so do serial info that can't be loaded
+    damaged = os.path.join(tmp, 'damaged.serial-info')
+    with open(damaged, 'w') as f:
+        f.write('{"symbols": [')
+    result = session_job([args.binaries[0]], damaged, 60)
+    assert result['exit_code'] is None and result['error'].startswith('JSONDecodeError')
@@ -1,14 +1,20 @@
 import argparse
+import collections
 import errno
+import io
+import json
 import os
+import random
+import time
 
 from metal.serial import Engine, Exit, MacroHook
 from subprocess import PIPE, Popen
 
-from metal.serial.generate import generate
+from metal.serial.generate import SerialInfo, generate
 
 from metal.serial.preprocessor import MacroExpansion
 from metal.serial.unit import Unit
+from metal.unit import JsonLinesSink, Reporter, Retention, Scope
 
 parser = argparse.ArgumentParser()
 
@@ -22,7 +28,122 @@ args = parser.parse_args()
 serial_info = generate(args.binary, args.define, args.include)
 
 p = Popen(args.binary, stdin=PIPE, stdout=PIPE, close_fds=True)
-engine = Engine(input=p.stdout, output=p.stdin, serial_info=serial_info, macro_hooks=[Exit, Unit])
+
+jsonl = io.StringIO()
+reporter = Reporter()
+reporter.jsonl_sink = JsonLinesSink(jsonl, buffer_records=16)
+reporter.summary_only = True
+
+engine = Engine(input=p.stdout, output=p.stdin, serial_info=serial_info, macro_hooks=[Exit, lambda: Unit(reporter)])
 
 assert engine.init_marker.file.endswith('unit.c')
-assert engine.run() == 0
\ No newline at end of file
+assert engine.run() == 0
+
+records = [json.loads(line) for line in jsonl.getvalue().splitlines()]
+checks = [record for record in records if record['event'] == 'check' and 'level' in record]
+assert len(checks) == reporter.main_scope.executed > 0
+assert records[-1]['event'] == 'report' and records[-1]['summary'] == reporter.main_scope.summary()
+assert sum(record['event'] == 'enter' for record in records) == sum(record['event'] == 'exit' for record in records)
+
+
+def stored_tests(scope):
+    return len(scope.tests) + sum(stored_tests(child) for child in scope.children)
+
+
+assert stored_tests(reporter.main_scope) == 0
+
+# records of a session that stalls after a burst get written by the timer
+stalled = io.StringIO()
+sink = JsonLinesSink(stalled, buffer_records=1024, flush_interval=0.05)
+for i in range(3):
+    sink.write({'event': 'check', 'index': i})
+assert stalled.getvalue() == ''
+deadline = time.monotonic() + 5
+while not stalled.getvalue() and time.monotonic() < deadline:
+    time.sleep(0.01)
+assert [json.loads(line)['index'] for line in stalled.getvalue().splitlines()] == [0, 1, 2]
+sink.close()
+
+def session(retention=Retention.all, sample_size=None, info=serial_info):
+    reporter = Reporter()
+    reporter.hrf_sink = io.StringIO()
+    p = Popen(args.binary, stdin=PIPE, stdout=PIPE, close_fds=True)
+    engine = Engine(input=p.stdout, output=p.stdin, serial_info=info,
+                    macro_hooks=[Exit, lambda: Unit(reporter, retention, sample_size)])
+    assert engine.run() == 0
+    return reporter.main_scope.to_dict()
+
+
+def summaries(scope):
+    return [scope['summary']] + [summary for child in scope['children'] for summary in summaries(child)]
+
+
+def checks(scope):
+    return scope['tests'] + [test for child in scope['children'] for test in checks(child)]
+
+
+# the counters stay exact whatever gets stored, failures are always kept
+everything = session(Retention.all)
+failures = session(Retention.failures)
+assert summaries(failures) == summaries(everything)
+assert checks(failures) == [test for test in checks(everything) if not test['condition']]
+assert checks(failures)
+
+sampled = session(Retention.sample, 1)
+assert summaries(sampled) == summaries(everything)
+assert [test for test in checks(sampled) if not test['condition']] == checks(failures)
+assert 0 < len(checks(sampled)) < len(checks(everything))
+
+
+def sampled_per_location(scope):
+    locations = collections.Counter((test['file'], test['line']) for test in scope['tests'] if test['condition'])
+    return max([*locations.values(), *(sampled_per_location(child) for child in scope['children'])], default=0)
+
+
+assert sampled_per_location(sampled) == 1
+assert sampled_per_location(everything) > 1
+# the seeded sample is the same every run
+assert session(Retention.sample, 1) == sampled
+
+
+
+# a single location, checked far more often than the sample holds
+def check(condition):
+    return {'type': 'plain', 'file': 'test.c', 'line': 42, 'level': 'expect', 'condition': condition}
+
+
+def sample(seed, sample_size=5):
+    scope = Scope('test')
+    rng = random.Random(seed)
+    for i in range(1000):
+        scope.append_test(dict(check(i % 100 != 0), index=i), Retention.sample, sample_size, rng)
+    return scope
+
+
+scope = sample(0)
+assert scope.summary() == {'executed': 1000, 'warnings': 10, 'errors': 0}
+assert len(scope.tests) == 5 + 10
+assert sorted(test['index'] for test in scope.tests if not test['condition']) == list(range(0, 1000, 100))
+assert list(scope.tests) == list(sample(0).tests)
+assert [test['index'] for test in sample(1).tests] != [test['index'] for test in scope.tests]
+# every passing check got a chance, not only the first ones
+assert max(test['index'] for test in scope.tests if test['condition']) > 5
+
+
+# the slim serial info generated by default drops the symbol table, but decodes the same
+full = generate(args.binary, args.define, args.include, symbols='all')
+assert len(serial_info.symbols) == 0 < len(full.symbols)
+assert serial_info.to_dict() == full.slim().to_dict()
+assert all(serial_info.find_macro_expansion(marker).to_dict() == full.find_macro_expansion(marker).to_dict() for marker in full.markers)
+assert session(info=serial_info) == session(info=full) == everything
+
+# expansions no marker uses are dropped too
+unused = MacroExpansion.from_dict(dict(full.expansions[0].to_dict(), line=-1))
+padded = SerialInfo(full.symbols, full.metal_serial_write, full.expansions + [unused], full.markers)
+assert [expansion.to_dict() for expansion in padded.slim().expansions] == [expansion.to_dict() for expansion in serial_info.expansions]
+
+start, end = full.metal_serial_write.address, full.metal_serial_write.address + 1
+in_range = full.slim((start, end))
+assert 'metal_serial_write' in [symbol.name for symbol in in_range.symbols]
+assert all(start <= symbol.address < end for symbol in in_range.symbols) and len(in_range.symbols) < len(full.symbols)
+assert session(info=in_range) == everything